@@ -4,177 +4,62 @@ Analysis code corresponding to the ATLAS Run 2 dijet TLA search
 See https://arxiv.org/abs/2509.01219 for details.
 
 """
-from modules.common_tools import bookHistWeighted
-
-def analysis(dataframe):
-    cutflow_dict = dict()
-    cutflow_dict["J50"] = dict()
-    cutflow_dict["J100"] = dict()
-
-    # initialise dictionary to hold rdfs for each signal region
-    region_dict = {"J100": None, "J50": None}
-
-    initial_yield = dataframe.Sum("mcEventWeight")
-    cutflow_dict["J50"]["initial"] = initial_yield
-    cutflow_dict["J100"]["initial"] = initial_yield
-
-    # make a multiplicity cut requiring 2 jets / event
-    dataframe = dataframe.Filter("Jet_size >= 2", "At least 2 jets")
-    cutflow_dict["J50"]["At least 2 jets"] = dataframe.Sum("mcEventWeight")
-    cutflow_dict["J100"]["At least 2 jets"] = dataframe.Sum("mcEventWeight")
-
-    # define per jet quantities for the leading 2 jets
-    for i_jet in range(0, 2):
-        dataframe = dataframe.Define(
-            f"Jet{i_jet}_pt", f"Jet.PT[{i_jet}]"
-        )
-        dataframe = dataframe.Define(
-            f"Jet{i_jet}_eta", f"Jet.Eta[{i_jet}]"
-        )
-        dataframe = dataframe.Define(
-            f"Jet{i_jet}_phi", f"Jet.Phi[{i_jet}]"
-        )
-        dataframe = dataframe.Define(
-            f"Jet{i_jet}_mass", f"Jet.Mass[{i_jet}]"
-        )
-    
-    # now apply eta and pT cuts for the two leading jets
-    dataframe = dataframe.Filter(
-        "Jet0_pt > 85. && Jet1_pt > 85. && fabs(Jet0_eta) < 2.4 && fabs(Jet1_eta) < 2.4", 
-        "Jet pT and eta cuts"
-    )
-    cutflow_dict["J50"]["Jet pT and eta cuts"] = dataframe.Sum("mcEventWeight")
-    cutflow_dict["J100"]["Jet pT and eta cuts"] = dataframe.Sum("mcEventWeight")
-
-    # apply TileGap veto
-    dataframe = dataframe.Filter(
-        "!( (fabs(Jet0_eta) > 1 && fabs(Jet0_eta) < 1.6) || (fabs(Jet1_eta) > 1 && fabs(Jet1_eta) < 1.6) )",
-        "TileGap veto"
-    )
-    cutflow_dict["J50"]["TileGap veto"] = dataframe.Sum("mcEventWeight")
-    cutflow_dict["J100"]["TileGap veto"] = dataframe.Sum("mcEventWeight")
-
-    # define the mjj variable from 4-vectors of the two leading jets
-    # ROOT::Math::PtEtaPhiMVector v1(10. /*pt*/, 0.1 /*eta*/, 0.24 /*phi*/, 5 /*M*/);
-    dataframe = dataframe.Define(
-        "Jet0_p4",
-        """
-        ROOT::Math::PtEtaPhiMVector tmp(Jet0_pt, Jet0_eta, Jet0_phi, Jet0_mass);
-        return tmp;
-        """
-    )
-    dataframe = dataframe.Define(
-        "Jet1_p4",
-        """
-        ROOT::Math::PtEtaPhiMVector tmp(Jet1_pt, Jet1_eta, Jet1_phi, Jet1_mass);
-        return tmp;
-        """
-    )
-
-    # apply rapidity difference cut
-    dataframe = dataframe.Define(
-        "y_star",
-        "return 0.5 * fabs(Jet0_p4.Rapidity() - Jet1_p4.Rapidity());"
-    )
-    dataframe = dataframe.Filter(
-        "y_star < 0.6",
-        "y_star cut"
-    )
-    cutflow_dict["J50"]["y_star cut"] = dataframe.Sum("mcEventWeight")
-    cutflow_dict["J100"]["y_star cut"] = dataframe.Sum("mcEventWeight")
-
-    # define the dijet invariant mass
-    dataframe = dataframe.Define(
-        "mjj",
-        "return (Jet0_p4 + Jet1_p4).M();"
-    )
-
-    # now apply the mjj cut that determines the signal region
-    region_dict["J100"] = dataframe.Filter(
-        "mjj > 481.",
-        "mjj > 481 GeV for J100 SR"
-    )
-    cutflow_dict["J100"]["mjj cut"] = region_dict["J100"].Sum("mcEventWeight")
-    
-    region_dict["J50"] = dataframe.Filter(
-        "mjj > 344.",
-        "mjj > 344 GeV for J50 SR"
-    )
-    cutflow_dict["J50"]["mjj cut"] = region_dict["J50"].Sum("mcEventWeight")        
-
-    return region_dict, cutflow_dict
+from modules.analysis_spec import (
+    AnalysisSpec, Cut, Threshold, Veto, SignalRegion, Histogram,
+    DIJET_KINEMATIC_HISTOGRAMS, compile_rdf, book_histograms,
+)
+
+SPEC = AnalysisSpec(
+    name="run2_atlas_tla_dijet",
+    cuts=(
+        # eta and pT cuts for the two leading jets
+        Cut(
+            "Jet pT and eta cuts",
+            (
+                Threshold("Jet0_pt", ">", 85.),
+                Threshold("Jet1_pt", ">", 85.),
+                Threshold("Jet0_eta", "<", 2.4, absolute=True),
+                Threshold("Jet1_eta", "<", 2.4, absolute=True),
+            ),
+        ),
+        # TileGap veto
+        Cut(
+            "TileGap veto",
+            (
+                Veto("Jet0_eta", 1., 1.6, absolute=True),
+                Veto("Jet1_eta", 1., 1.6, absolute=True),
+            ),
+        ),
+        # rapidity difference cut
+        Cut("y_star cut", (Threshold("y_star", "<", 0.6),)),
+    ),
+    # the mjj cut determines the signal region
+    signal_regions=(
+        SignalRegion("J50", Cut("mjj cut", (Threshold("mjj", ">", 344.),), "mjj > 344 GeV for J50 SR")),
+        SignalRegion("J100", Cut("mjj cut", (Threshold("mjj", ">", 481.),), "mjj > 481 GeV for J100 SR")),
+    ),
+    histograms=DIJET_KINEMATIC_HISTOGRAMS + (
+        # same binning as the truncation window histograms, so that the windows
+        # can be recomputed from h_mjj (see modules/reinterpretation.py)
+        Histogram("h_mjj", "mjj distribution; m_jj [GeV]; Entries", 6000, 0., 6000., "mjj"),
+    ),
+)
+
+def analysis(dataframe, preselection=None, statistics=None, n_weights=0):
+    """
+    Build the selection for the ATLAS Run 2 dijet TLA analysis. Returns the RDF nodes
+    for each signal region and the booked cutflow yields, filling statistics
+    with the extended cutflow statistics if given.
+    """
+    return compile_rdf(SPEC, dataframe, preselection=preselection, statistics=statistics, n_weights=n_weights)
 
-def histograms(dataframe):
+def histograms(dataframe, n_weights=0):
     """
     Book histograms for the ATLAS Run 2 dijet TLA analysis. 
     Returns a list of RDF histogram pointers that can be 
     written to a file.
     """
-    histograms = list()
-
-    # fill histograms for jet kinematics 
-    for i_jet in range(0, 2):
-        # jet pT
-        histograms.append(bookHistWeighted(
-            dataframe,
-            f"h_jet{i_jet}_pt",
-            f"Jet {i_jet} pT distribution; Jet {i_jet} pT [GeV]; Entries",
-            600,
-            0.,
-            3000.,
-            f"Jet{i_jet}_pt",
-            "mcEventWeight"
-        ))
-
-        # jet eta
-        histograms.append(bookHistWeighted(
-            dataframe,
-            f"h_jet{i_jet}_eta",
-            f"Jet {i_jet} eta distribution; Jet {i_jet} eta; Entries",
-            60,
-            -3.,
-            3.,
-            f"Jet{i_jet}_eta",
-            "mcEventWeight"
-        ))
-
-        # jet phi
-        histograms.append(bookHistWeighted(
-            dataframe,
-            f"h_jet{i_jet}_phi",
-            f"Jet {i_jet} phi distribution; Jet {i_jet} phi; Entries",
-            64,
-            -3.2,
-            3.2,
-            f"Jet{i_jet}_phi",
-            "mcEventWeight"
-        ))
-
-    # y_star
-    histograms.append(bookHistWeighted(
-        dataframe,
-        "h_y_star",
-        "y* distribution; y*; Entries",
-        60,
-        0.,
-        3.,
-        "y_star",
-        "mcEventWeight"
-    ))
-
-    # mjj
-    histograms.append(bookHistWeighted(
-        dataframe,
-        "h_mjj",
-        "mjj distribution; m_jj [GeV]; Entries",
-        4000,
-        0.,
-        4000.,
-        "mjj",
-        "mcEventWeight"
-    ))
-
-    return histograms
+    return book_histograms(SPEC, dataframe, n_weights=n_weights)
 
 if __name__ == "__main__":
     import ROOT
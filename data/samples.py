@@ -6,6 +6,10 @@ HAHM and DMsimp_s_spin1 models generated with MadGraph5_aMC@NLO.
 It is intended to be used to identify the correct ROOT files 
 to load for analysis and to locate metadata.
 
+The ntuple of a sample can be a single path, a glob pattern or a list of
+paths and patterns, which are resolved and opened as a chain through
+modules/sample_catalogue.py.
+
 """
 
 samples = {
@@ -0,0 +1,595 @@
+"""
+
+Declarative description of the dijet analyses.
+
+An analysis is described by an AnalysisSpec holding:
+- an ordered list of cuts applied after the dijet preselection and
+  shared by all signal regions
+- the signal regions, each defined by a final cut (normally on mjj)
+- the 1D histograms to fill in every signal region
+- any derived variables needed on top of the leading-dijet columns
+
+The same spec can be compiled into:
+- a RDataFrame graph (compile_rdf / book_histograms) with the same
+  cutflow and histogram structure as the hand-written analyses
+- a vectorised NumPy pipeline (ArrayAnalysis) acting on arrays of the
+  leading-dijet columns, which does not need ROOT or Delphes
+
+"""
+from dataclasses import dataclass
+import numpy as np
+import boost_histogram as bh
+
+# name of the normalised event weight column defined in load_delhes_rdf
+WEIGHT_COLUMN = "mcEventWeight"
+# and of its square, used for the statistical uncertainties of the yields
+WEIGHT2_COLUMN = "mcEventWeight2"
+# normalised weight vector (e.g. scale/PDF weights) and the index of each
+# weight, defined in load_delhes_rdf when a weight vector branch is given
+WEIGHT_VECTOR_COLUMN = "mcEventWeights"
+WEIGHT_INDEX_COLUMN = "mcEventWeightIndex"
+
+# cutflow entries filled before the analysis specific cuts
+INITIAL_STEP = "initial"
+PRESELECTION_STEP = "At least 2 jets"
+
+COMPARISONS = {
+    ">": np.greater,
+    ">=": np.greater_equal,
+    "<": np.less,
+    "<=": np.less_equal,
+}
+
+@dataclass(frozen=True)
+class Threshold:
+    """
+    Requirement of the form `variable op value`, optionally applied
+    to the absolute value of the variable.
+    """
+    variable: str
+    op: str
+    value: float
+    absolute: bool = False
+
+    def __post_init__(self):
+        if self.op not in COMPARISONS:
+            raise ValueError(f"comparison {self.op} not recognised, should be one of {list(COMPARISONS)}")
+
+    def to_cpp(self):
+        variable = f"fabs({self.variable})" if self.absolute else self.variable
+        return f"{variable} {self.op} {self.value}"
+
+    def evaluate(self, arrays:dict):
+        values = np.abs(arrays[self.variable]) if self.absolute else arrays[self.variable]
+        return COMPARISONS[self.op](values, self.value)
+
+@dataclass(frozen=True)
+class Veto:
+    """
+    Requirement rejecting events where the variable (or its absolute
+    value) lies inside the open interval (low, high).
+    """
+    variable: str
+    low: float
+    high: float
+    absolute: bool = False
+
+    def to_cpp(self):
+        variable = f"fabs({self.variable})" if self.absolute else self.variable
+        return f"!({variable} > {self.low} && {variable} < {self.high})"
+
+    def evaluate(self, arrays:dict):
+        values = np.abs(arrays[self.variable]) if self.absolute else arrays[self.variable]
+        return ~((values > self.low) & (values < self.high))
+
+@dataclass(frozen=True)
+class Cut:
+    """
+    A single step of the cutflow. All requirements must be satisfied
+    for an event to pass. The name is used as the cutflow key and the
+    description (if given) as the name of the RDF filter.
+    """
+    name: str
+    requirements: tuple
+    description: str = ""
+
+    def to_cpp(self):
+        return " && ".join(f"({requirement.to_cpp()})" for requirement in self.requirements)
+
+    def evaluate(self, arrays:dict):
+        return np.logical_and.reduce([requirement.evaluate(arrays) for requirement in self.requirements])
+
+    def label(self):
+        return self.description if self.description != "" else self.name
+
+@dataclass(frozen=True)
+class SignalRegion:
+    name: str
+    cut: Cut
+
+@dataclass(frozen=True)
+class Histogram:
+    name: str
+    title: str
+    nbins: int
+    low: float
+    high: float
+    variable: str
+
+@dataclass(frozen=True)
+class Variable:
+    """
+    Derived per-event variable, given both as a C++ expression for RDF
+    and as a function of the array dictionary for the NumPy pipeline.
+    """
+    name: str
+    expression: str
+    function: object
+
+@dataclass(frozen=True)
+class AnalysisSpec:
+    name: str
+    cuts: tuple
+    signal_regions: tuple
+    histograms: tuple
+    variables: tuple = ()
+
+    def cut_names(self, signal_region:str):
+        """
+        Return the ordered cutflow keys for a signal region.
+        """
+        sr = self.get_signal_region(signal_region)
+        return [INITIAL_STEP, PRESELECTION_STEP] + [cut.name for cut in self.cuts] + [sr.cut.name]
+
+    def get_signal_region(self, signal_region:str):
+        for sr in self.signal_regions:
+            if sr.name == signal_region:
+                return sr
+        raise KeyError(f"signal region {signal_region} not defined for analysis {self.name}")
+
+# kinematic histograms common to the dijet analyses
+# the mjj histogram range is analysis specific so it is not included here
+DIJET_KINEMATIC_HISTOGRAMS = tuple(
+    Histogram(
+        f"h_jet{i_jet}_{variable}",
+        f"Jet {i_jet} {label} distribution; Jet {i_jet} {label}{unit}; Entries",
+        nbins, low, high,
+        f"Jet{i_jet}_{variable}",
+    )
+    for i_jet in range(0, 2)
+    for variable, label, unit, nbins, low, high in [
+        ("pt", "pT", " [GeV]", 600, 0., 3000.),
+        ("eta", "eta", "", 60, -3., 3.),
+        ("phi", "phi", "", 64, -3.2, 3.2),
+    ]
+) + (
+    Histogram("h_y_star", "y* distribution; y*; Entries", 60, 0., 3., "y_star"),
+)
+
+def acceptance_uncertainty(sumW_pass:float, sumW2_pass:float, sumW_total:float, sumW2_total:float)->float:
+    """
+    Statistical uncertainty of a weighted acceptance sumW_pass / sumW_total,
+    using the normal approximation for weighted events passing a subset of
+    the selection.
+    """
+    if sumW_total <= 0:
+        return 0.0
+    acceptance = sumW_pass / sumW_total
+    variance = ((1 - 2 * acceptance) * sumW2_pass + acceptance**2 * sumW2_total) / sumW_total**2
+    return float(np.sqrt(max(variance, 0.0)))
+
+def cutflow_acceptances(sr_cutflows:dict, xsec_factor:float, sr_statistics:dict=None)->dict:
+    """
+    Compute the acceptance and expected cross-section for each signal region
+    from evaluated cutflows, where xsec_factor is the sample cross-section
+    including the branching ratio and filter efficiency (see get_xsec_factor
+    in modules/metadata.py).
+
+    If the evaluated cutflow statistics (see compile_rdf) are given, the
+    statistical uncertainties and the number of raw and effective events
+    passing the selection are also included.
+    """
+    sr_acceptances = dict()
+    for sr in sr_cutflows:
+        initial_events = sr_cutflows[sr][INITIAL_STEP]
+        final_events = sr_cutflows[sr][(list(sr_cutflows[sr].keys()))[-1]] # last cut
+        # in the acceptance calculation all factors of the cross-section, BR, etc
+        # should cancel out, so they need to be applied to the signal cross-section
+        # again later on
+        acceptance = final_events / initial_events if initial_events > 0 else 0.0
+        sr_acceptances[sr] = {
+            "acceptance": acceptance,
+            "expected_xsec_pb": acceptance * xsec_factor,
+        }
+        if sr_statistics is not None:
+            steps = sr_statistics[sr]["cutflow"]
+            initial = steps[INITIAL_STEP]
+            final = steps[list(steps.keys())[-1]]
+            uncertainty = acceptance_uncertainty(final["sumW"], final["sumW2"], initial["sumW"], initial["sumW2"])
+            sr_acceptances[sr].update({
+                "acceptance_stat_uncertainty": uncertainty,
+                "expected_xsec_pb_stat_uncertainty": uncertainty * xsec_factor,
+                "raw_events": final["raw"],
+                "effective_events": final["sumW"]**2 / final["sumW2"] if final["sumW2"] > 0 else 0.0,
+            })
+            if "weight_vector" in sr_statistics[sr]:
+                sr_acceptances[sr]["weight_variations"] = weight_vector_acceptances(
+                    sr_statistics[sr]["weight_vector"], xsec_factor
+                )
+    return sr_acceptances
+
+def envelope(values)->list:
+    return [float(np.min(values)), float(np.max(values))] if len(values) > 0 else [0.0, 0.0]
+
+def weight_vector_acceptances(weight_sums:dict, xsec_factor:float)->dict:
+    """
+    Compute the acceptance and expected cross-section for each weight of the
+    weight vector from the evaluated sums of each weight after every cutflow
+    step. The first weight is taken as the nominal one, so the expected
+    cross-sections include the change in the total cross-section predicted by
+    the other weights (e.g. for scale variations).
+    """
+    initial = np.asarray(weight_sums[INITIAL_STEP])
+    final = np.asarray(weight_sums[list(weight_sums.keys())[-1]])
+    with np.errstate(invalid="ignore", divide="ignore"):
+        acceptance = np.where(initial > 0, final / initial, 0.0)
+    expected_xsec = xsec_factor * final / initial[0] if len(initial) > 0 and initial[0] > 0 else np.zeros_like(final)
+    return {
+        "acceptance": acceptance.tolist(),
+        "expected_xsec_pb": expected_xsec.tolist(),
+        "acceptance_envelope": envelope(acceptance),
+        "expected_xsec_pb_envelope": envelope(expected_xsec),
+    }
+
+################################################################################
+##### RDataFrame backend
+def _book_step_statistics(dataframe, sumW=None):
+    """
+    Book the weighted yield, sum of squared weights and raw number of
+    events passing a RDF node, reusing an already booked weighted yield if given.
+    """
+    return {
+        "sumW": dataframe.Sum(WEIGHT_COLUMN) if sumW is None else sumW,
+        "sumW2": dataframe.Sum(WEIGHT2_COLUMN),
+        "raw": dataframe.Count(),
+    }
+
+def book_weight_vector_sums(dataframe, n_weights:int, name:str="h_weight_vector_sums"):
+    """
+    Book the sum of each weight of the weight vector over the events passing
+    a RDF node, as a histogram over the weight index filled from the RVec
+    columns so that all the weights are accumulated in a single action.
+    """
+    return dataframe.Histo1D(
+        (name, "Sum of weights; weight index; Sum of weights", n_weights, -0.5, n_weights - 0.5),
+        WEIGHT_INDEX_COLUMN,
+        WEIGHT_VECTOR_COLUMN
+    )
+
+def compile_rdf(spec:AnalysisSpec, dataframe, preselection=None, statistics:dict=None, n_weights:int=0):
+    """
+    Build the RDF graph for an analysis spec.
+
+    Parameters
+    ----------
+    spec : AnalysisSpec
+        Analysis to compile.
+    dataframe : ROOT.RDF.RNode
+        Sample RDF as returned by load_delhes_rdf.
+    preselection : ROOT.RDF.RNode, optional
+        Shared dijet preselection node for this sample, created from
+        dataframe when not given.
+    statistics : dict, optional
+        If given, filled for each signal region with the booked sumW, sumW2
+        and raw event count after each cutflow step ("cutflow") and after
+        all cuts but one ("n_minus_one"). These share the filters of the
+        cutflow and are evaluated in the same event loop.
+    n_weights : int, optional
+        Size of the weight vector. If non-zero, the sums of each weight after
+        every cutflow step are also booked in statistics ("weight_vector").
+
+    Returns
+    -------
+    tuple(dict, dict)
+        RDF nodes for each signal region and the booked cutflow yields for
+        each signal region, as returned by the analysis() functions.
+    """
+    # imported here so that the array backend can be used on machines
+    # without ROOT or a Delphes build
+    from modules.common_tools import dijet_preselection, define_columns
+
+    cutflow_dict = {sr.name: dict() for sr in spec.signal_regions}
+    region_dict = dict()
+
+    initial_node = dataframe
+    initial_yield = dataframe.Sum(WEIGHT_COLUMN)
+    if preselection is None:
+        preselection = dijet_preselection(dataframe)
+    dataframe = define_columns(
+        preselection,
+        {variable.name: variable.expression for variable in spec.variables}
+    )
+    preselection_node = dataframe
+
+    # the yields are shared by all signal regions up to the
+    # cut defining each region
+    step_yields = {
+        INITIAL_STEP: initial_yield,
+        PRESELECTION_STEP: dataframe.Sum(WEIGHT_COLUMN),
+    }
+    cut_nodes = dict()
+    for cut in spec.cuts:
+        dataframe = dataframe.Filter(cut.to_cpp(), cut.label())
+        cut_nodes[cut.name] = dataframe
+        step_yields[cut.name] = dataframe.Sum(WEIGHT_COLUMN)
+
+    for sr in spec.signal_regions:
+        cutflow_dict[sr.name].update(step_yields)
+        region_dict[sr.name] = dataframe.Filter(sr.cut.to_cpp(), sr.cut.label())
+        cutflow_dict[sr.name][sr.cut.name] = region_dict[sr.name].Sum(WEIGHT_COLUMN)
+
+    if statistics is not None:
+        step_nodes = {INITIAL_STEP: initial_node, PRESELECTION_STEP: preselection_node}
+        step_nodes.update(cut_nodes)
+        step_statistics = {
+            step: _book_step_statistics(node, step_yields[step])
+            for step, node in step_nodes.items()
+        }
+        for sr in spec.signal_regions:
+            cutflow_statistics = dict(step_statistics)
+            cutflow_statistics[sr.cut.name] = _book_step_statistics(region_dict[sr.name], cutflow_dict[sr.name][sr.cut.name])
+
+            # N-1 yields branch from the preselection with all other cuts of the signal region applied
+            chain = list(spec.cuts) + [sr.cut]
+            n_minus_one = dict()
+            for cut in chain:
+                others = [other for other in chain if other is not cut]
+                # without other cuts (no shared cuts) the N-1 yield is the preselection one
+                node = preselection_node
+                if len(others) > 0:
+                    node = node.Filter(" && ".join(f"({other.to_cpp()})" for other in others))
+                n_minus_one[cut.name] = _book_step_statistics(node)
+
+            statistics[sr.name] = {"cutflow": cutflow_statistics, "n_minus_one": n_minus_one}
+
+        if n_weights > 0:
+            step_weight_sums = {
+                step: book_weight_vector_sums(node, n_weights)
+                for step, node in step_nodes.items()
+            }
+            for sr in spec.signal_regions:
+                statistics[sr.name]["weight_vector"] = dict(step_weight_sums)
+                statistics[sr.name]["weight_vector"][sr.cut.name] = book_weight_vector_sums(region_dict[sr.name], n_weights)
+
+    return region_dict, cutflow_dict
+
+def booked_results(results)->list:
+    """
+    Return a flat list of the RDF results in a nested dictionary of booked
+    results (e.g. cutflows or cutflow statistics), to pass to RunGraphs.
+    """
+    if isinstance(results, dict):
+        return [result for value in results.values() for result in booked_results(value)]
+    if isinstance(results, (list, tuple)):
+        return [result for value in results for result in booked_results(value)]
+    return [] if isinstance(results, (float, int)) else [results]
+
+def evaluate_results(results):
+    """
+    Return a copy of a nested dictionary of booked RDF results with
+    each result replaced by its value.
+    """
+    if isinstance(results, dict):
+        return {key: evaluate_results(value) for key, value in results.items()}
+    if isinstance(results, (float, int)):
+        return results
+    value = results.GetValue()
+    if hasattr(value, "GetNbinsX"):
+        # sums over the weight vector booked with book_weight_vector_sums
+        return [value.GetBinContent(i_bin) for i_bin in range(1, value.GetNbinsX() + 1)]
+    return value if isinstance(value, float) else int(value)
+
+def scale_statistics(statistics:dict, factor:float)->dict:
+    """
+    Return a copy of evaluated cutflow statistics (see compile_rdf) with the
+    weights scaled by factor, e.g. to normalise the sample after the event loop.
+    """
+    scaled = dict()
+    for key, value in statistics.items():
+        if key == "weight_vector":
+            scaled[key] = {step: [factor * weight_sum for weight_sum in sums] for step, sums in value.items()}
+        elif isinstance(value, dict):
+            scaled[key] = scale_statistics(value, factor)
+        elif key == "sumW":
+            scaled[key] = factor * value
+        elif key == "sumW2":
+            scaled[key] = factor**2 * value
+        else:
+            scaled[key] = value
+    return scaled
+
+def book_histograms(spec:AnalysisSpec, dataframe, n_weights:int=0):
+    """
+    Book the weighted histograms of an analysis spec on a RDF node.
+    Returns a list of RDF histogram pointers.
+
+    If n_weights is non-zero, a 2D histogram with the weight index on the
+    y-axis (named <histogram>_weights) is also booked for each histogram,
+    filling all the weights of the weight vector at once.
+    """
+    hists = [
+        dataframe.Histo1D(
+            (hist.name, hist.title, hist.nbins, hist.low, hist.high),
+            hist.variable,
+            WEIGHT_COLUMN
+        )
+        for hist in spec.histograms
+    ]
+    if n_weights > 0:
+        from modules.common_tools import define_columns
+        # broadcast each variable to the size of the weight vector
+        dataframe = define_columns(dataframe, {
+            f"{hist.variable}_weights": f"return ROOT::RVec<double>({WEIGHT_VECTOR_COLUMN}.size(), {hist.variable});"
+            for hist in spec.histograms
+        })
+        hists += [
+            dataframe.Histo2D(
+                (f"{hist.name}_weights", ";".join(hist.title.split(";")[:2] + [" weight index"]), hist.nbins, hist.low, hist.high, n_weights, -0.5, n_weights - 0.5),
+                f"{hist.variable}_weights",
+                WEIGHT_INDEX_COLUMN,
+                WEIGHT_VECTOR_COLUMN
+            )
+            for hist in spec.histograms
+        ]
+    return hists
+
+################################################################################
+##### NumPy backend
+def dijet_kinematics(arrays:dict):
+    """
+    Compute the derived leading-dijet columns (rapidities, y_star and mjj)
+    from the Jet{i}_pt/eta/phi/mass arrays, matching DIJET_COLUMNS in
+    modules/common_tools.py. Entries for events with fewer than two jets
+    should be NaN and propagate as NaN.
+    """
+    px, py, pz, energy = list(), list(), list(), list()
+    with np.errstate(invalid="ignore", divide="ignore"):
+        for i_jet in range(0, 2):
+            pt = arrays[f"Jet{i_jet}_pt"]
+            eta = arrays[f"Jet{i_jet}_eta"]
+            phi = arrays[f"Jet{i_jet}_phi"]
+            mass = arrays[f"Jet{i_jet}_mass"]
+            px.append(pt * np.cos(phi))
+            py.append(pt * np.sin(phi))
+            pz.append(pt * np.sinh(eta))
+            energy.append(np.sqrt((pt * np.cosh(eta))**2 + mass**2))
+            arrays[f"Jet{i_jet}_rapidity"] = 0.5 * np.log((energy[-1] + pz[-1]) / (energy[-1] - pz[-1]))
+
+        arrays["y_star"] = 0.5 * np.abs(arrays["Jet0_rapidity"] - arrays["Jet1_rapidity"])
+
+        # follow ROOT::Math conventions and return -sqrt(-m2) for negative m2
+        m2 = (energy[0] + energy[1])**2 - (px[0] + px[1])**2 - (py[0] + py[1])**2 - (pz[0] + pz[1])**2
+        arrays["mjj"] = np.sign(m2) * np.sqrt(np.abs(m2))
+
+    return arrays
+
+class ArrayAnalysis:
+    """
+    Vectorised NumPy implementation of an analysis spec.
+
+    Events are processed in batches through process(), which accumulates the
+    weighted cutflow yields and fills boost-histograms for each signal region.
+    Each batch is a dictionary of flat arrays containing at least Jet_size and
+    the Jet{i}_pt/eta/phi/mass columns (NaN for missing jets).
+
+    """
+
+    def __init__(self, spec:AnalysisSpec):
+        self.spec = spec
+        self.sumW = {
+            sr.name: {cut: 0.0 for cut in spec.cut_names(sr.name)}
+            for sr in spec.signal_regions
+        }
+        self.stats = {
+            sr.name: {
+                "cutflow": {cut: {"sumW": 0.0, "sumW2": 0.0, "raw": 0} for cut in spec.cut_names(sr.name)},
+                "n_minus_one": {cut.name: {"sumW": 0.0, "sumW2": 0.0, "raw": 0} for cut in list(spec.cuts) + [sr.cut]},
+            }
+            for sr in spec.signal_regions
+        }
+        self.hists = {
+            sr.name: {
+                hist.name: bh.Histogram(
+                    bh.axis.Regular(hist.nbins, hist.low, hist.high),
+                    storage=bh.storage.Weight()
+                )
+                for hist in spec.histograms
+            }
+            for sr in spec.signal_regions
+        }
+
+    def masks(self, arrays:dict):
+        """
+        Return the cumulative selection mask after each cutflow step for
+        each signal region, adding any missing derived variables to arrays.
+        """
+        if "mjj" not in arrays:
+            dijet_kinematics(arrays)
+        for variable in self.spec.variables:
+            if variable.name not in arrays:
+                arrays[variable.name] = variable.function(arrays)
+
+        step_masks = {
+            INITIAL_STEP: np.ones(len(arrays["Jet_size"]), dtype=bool),
+            PRESELECTION_STEP: arrays["Jet_size"] >= 2,
+        }
+        mask = step_masks[PRESELECTION_STEP]
+        for cut in self.spec.cuts:
+            mask = mask & cut.evaluate(arrays)
+            step_masks[cut.name] = mask
+
+        sr_masks = dict()
+        for sr in self.spec.signal_regions:
+            sr_masks[sr.name] = dict(step_masks)
+            sr_masks[sr.name][sr.cut.name] = mask & sr.cut.evaluate(arrays)
+        return sr_masks
+
+    def n_minus_one_masks(self, arrays:dict):
+        """
+        Return the mask of events passing the preselection and all cuts of
+        each signal region but one, for each cut.
+        """
+        preselection = arrays["Jet_size"] >= 2
+        cut_masks = {cut.name: cut.evaluate(arrays) for cut in self.spec.cuts}
+        sr_masks = dict()
+        for sr in self.spec.signal_regions:
+            chain = dict(cut_masks)
+            chain[sr.cut.name] = sr.cut.evaluate(arrays)
+            sr_masks[sr.name] = {
+                cut: np.logical_and.reduce([preselection] + [mask for other, mask in chain.items() if other != cut])
+                for cut in chain
+            }
+        return sr_masks
+
+    def process(self, arrays:dict, weights):
+        sr_masks = self.masks(arrays)
+        sr_n_minus_one = self.n_minus_one_masks(arrays)
+        for sr in sr_masks:
+            for cut, mask in sr_masks[sr].items():
+                self.sumW[sr][cut] += float(np.sum(weights[mask]))
+                self._accumulate(self.stats[sr]["cutflow"][cut], weights[mask])
+            for cut, mask in sr_n_minus_one[sr].items():
+                self._accumulate(self.stats[sr]["n_minus_one"][cut], weights[mask])
+
+            final_mask = sr_masks[sr][self.spec.get_signal_region(sr).cut.name]
+            for hist in self.spec.histograms:
+                self.hists[sr][hist.name].fill(
+                    arrays[hist.variable][final_mask],
+                    weight=weights[final_mask]
+                )
+
+    @staticmethod
+    def _accumulate(step:dict, weights):
+        step["sumW"] += float(np.sum(weights))
+        step["sumW2"] += float(np.sum(weights**2))
+        step["raw"] += len(weights)
+
+    def cutflows(self):
+        """
+        Return the accumulated cutflows in the same format as the
+        evaluated RDF cutflow dictionaries.
+        """
+        return {sr: dict(cutflow) for sr, cutflow in self.sumW.items()}
+
+    def statistics(self):
+        """
+        Return the accumulated cutflow statistics in the same format
+        as the evaluated statistics booked by compile_rdf.
+        """
+        return {
+            sr: {kind: {cut: dict(step) for cut, step in steps.items()} for kind, steps in stats.items()}
+            for sr, stats in self.stats.items()
+        }
+
+    def histograms(self):
+        return self.hists
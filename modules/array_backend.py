@@ -0,0 +1,306 @@
+"""
+
+Array backend for running the dijet analyses without ROOT.
+
+The Delphes ntuples are streamed with uproot in bounded-memory chunks,
+reading only the jet kinematics, the jet multiplicity and the event
+weight. The leading-dijet selection, y* and mjj are computed with
+vectorised array operations (see ArrayAnalysis in modules/analysis_spec.py)
+and the histograms are filled with boost-histogram.
+
+This avoids loading the Delphes dictionaries and the RDF JIT, so it can be
+used for quick studies on machines without a Delphes build. The outputs
+follow the same naming and format as modules/process_sample.py, except that
+the reinterpretation is not available since it relies on RDataFrame.
+
+"""
+import sys
+import argparse
+import importlib
+import json
+import pathlib
+import numpy as np
+import awkward as ak
+import uproot
+from data.samples import samples
+from modules.sample_catalogue import catalogue
+from modules.staging_cache import StagingCache, DEFAULT_CACHE_SIZE_GB
+from modules.logger_setup import logger
+from modules.results_store import ResultsStore, DEFAULT_STORE_NAME
+from modules.analysis_spec import ArrayAnalysis, cutflow_acceptances
+from modules.metadata import metadata_store
+from modules.delphes_branches import JET_BRANCHES, JET_SIZE_BRANCH, WEIGHT_BRANCH
+
+# default chunk size for streaming, bounds the memory used per chunk
+DEFAULT_STEP_SIZE = "100 MB"
+
+def get_branch(arrays, branch_name:str):
+    """
+    Return a branch from a chunk of arrays read with uproot.
+    """
+    # uproot may key split Delphes branches by their full path
+    # (e.g. Jet/Jet.PT) so match on the last component of the name
+    for field in arrays.fields:
+        if field == branch_name or field.split("/")[-1] == branch_name:
+            return arrays[field]
+    raise KeyError(f"branch {branch_name} not found in arrays with fields {arrays.fields}")
+
+def leading_dijet_arrays(arrays)->dict:
+    """
+    Convert a chunk of jagged jet arrays into flat NumPy arrays of the
+    leading-dijet columns, with NaN for missing jets.
+
+    Parameters
+    ----------
+    arrays : ak.Array
+        Chunk of events containing the JET_BRANCHES and JET_SIZE_BRANCH.
+
+    Returns
+    -------
+    dict
+        Flat arrays keyed by the column names used in the analysis specs.
+    """
+    dijet = {"Jet_size": ak.to_numpy(get_branch(arrays, JET_SIZE_BRANCH))}
+    for variable, branch in JET_BRANCHES.items():
+        leading = ak.pad_none(get_branch(arrays, branch), 2, axis=1, clip=True)
+        leading = ak.to_numpy(ak.fill_none(leading, np.nan)).astype(np.float64)
+        for i_jet in range(0, 2):
+            dijet[f"Jet{i_jet}_{variable}"] = leading[:, i_jet]
+    return dijet
+
+def event_weights(arrays)->np.ndarray:
+    """
+    Return the Delphes event weights of a chunk as a flat array.
+    """
+    # Event is stored as a collection with one entry per event, sum over
+    # it to match the RDF Sum over the Event.Weight RVec
+    return ak.to_numpy(ak.sum(get_branch(arrays, WEIGHT_BRANCH), axis=1)).astype(np.float64)
+
+def iterate_chunks(file_path, tree_name:str="Delphes", step_size=DEFAULT_STEP_SIZE):
+    """
+    Stream the jet and event weight branches of one or more Delphes files
+    in chunks of at most step_size, yielding the awkward arrays as read.
+    """
+    files = [file_path] if isinstance(file_path, str) else list(file_path)
+    yield from uproot.iterate(
+        {path: tree_name for path in files},
+        filter_name=list(JET_BRANCHES.values()) + [JET_SIZE_BRANCH, WEIGHT_BRANCH],
+        step_size=step_size,
+        library="ak",
+    )
+
+def iterate_dijet_arrays(file_path, tree_name:str="Delphes", step_size=DEFAULT_STEP_SIZE):
+    """
+    Stream the leading-dijet columns and raw event weights of one or more
+    Delphes files in chunks of at most step_size.
+
+    Yields
+    ------
+    tuple(dict, np.ndarray)
+        Leading-dijet arrays and Event.Weight for each chunk.
+    """
+    for arrays in iterate_chunks(file_path, tree_name, step_size):
+        yield leading_dijet_arrays(arrays), event_weights(arrays)
+
+def run_sample(sample_id:str, specs:dict, tree_name:str="Delphes", step_size=DEFAULT_STEP_SIZE)->dict:
+    """
+    Run the given analysis specs over a sample in a single pass.
+
+    Parameters
+    ----------
+    sample_id : str
+        Sample name as given in data/samples.py.
+    specs : dict
+        Mapping of analysis name to AnalysisSpec.
+
+    Returns
+    -------
+    dict
+        ArrayAnalysis with the accumulated results for each analysis.
+    """
+    weight_factor = metadata_store.weight_factor(sample_id)
+    logger.info("calculated weight factor for sample %s of %s", sample_id, weight_factor)
+
+    results = {name: ArrayAnalysis(spec) for name, spec in specs.items()}
+    n_events = 0
+    for arrays, weights in iterate_dijet_arrays(catalogue.files(sample_id), tree_name, step_size):
+        weights = weight_factor * weights
+        n_events += len(weights)
+        for result in results.values():
+            result.process(arrays, weights)
+    catalogue.release(sample_id)
+    logger.info("processed %s events for sample %s", n_events, sample_id)
+
+    return results
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="Run analyses for a given set of samples using the uproot array backend",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "-s",
+        "--samples",
+        type=str,
+        nargs="+",
+        required=True,
+        help="Names of the samples to process, as given in data/samples.py",
+    )
+    parser.add_argument(
+        "-o",
+        "--output-dir",
+        type=pathlib.Path,
+        required=True,
+        help="Directory to save output files",
+    )
+    parser.add_argument(
+        "-a",
+        "--analyses",
+        type=str,
+        nargs="+",
+        help="List of analyses to run (corresponding to module names in analyses/)",
+        default=["run2_atlas_tla_dijet"]
+    )
+    parser.add_argument(
+        "--step-size",
+        type=str,
+        default=DEFAULT_STEP_SIZE,
+        help="Size of the chunks read at once, either a number of entries or a memory size such as '100 MB'"
+    )
+    parser.add_argument(
+        "--skip-histograms",
+        action="store_true",
+        help="Whether to skip saving the histograms",
+        default=False
+    )
+    parser.add_argument(
+        "--skip-store-cutflows",
+        action="store_true",
+        help="Whether to skip storing the cutflows in JSON files in the output directory",
+        default=False
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=pathlib.Path,
+        default=None,
+        help="Local directory to stage the sample files to before reading them (e.g. on a local SSD)"
+    )
+    parser.add_argument(
+        "--cache-size-gb",
+        type=float,
+        default=DEFAULT_CACHE_SIZE_GB,
+        help="Maximum size of the staging cache, least recently used files are evicted above it"
+    )
+    parser.add_argument(
+        "--results-store",
+        type=pathlib.Path,
+        default=None,
+        help="SQLite results store to add the acceptances and cutflows to (by default results.sqlite in the output directory)"
+    )
+    parser.add_argument(
+        "--legacy-json",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Whether to also write the acceptances and cutflows to one JSON file per sample and analysis"
+    )
+    parser.add_argument(
+        "--file-prefix",
+        type=str,
+        default="",
+        help="Prefix to add to the output files, e.g. to distinguish between different sets of jobs (if empty string, no prefix is added)"
+    )
+    parser.add_argument(
+        "--validation-workers",
+        type=int,
+        default=8,
+        help="Number of threads used to check the sample files before processing"
+    )
+
+    return parser.parse_args()
+
+def main():
+    args = get_args()
+
+    if not args.output_dir.exists():
+        logger.error("output directory %s does not exist", args.output_dir)
+        return 1
+
+    results_store = ResultsStore(args.results_store or args.output_dir / DEFAULT_STORE_NAME)
+
+    if args.cache_dir is not None:
+        catalogue.staging = StagingCache(args.cache_dir, args.cache_size_gb)
+
+    # load the analysis specs
+    specs = dict()
+    for analysis_name in args.analyses:
+        analysis_module = importlib.import_module(f"analyses.{analysis_name}")
+        if not hasattr(analysis_module, "SPEC"):
+            logger.error("analysis module %s does not define a SPEC, cannot run it with the array backend", analysis_name)
+            return 1
+        specs[analysis_name] = analysis_module.SPEC
+
+    # a step size given as a plain number is a number of entries
+    step_size = int(args.step_size) if args.step_size.isdigit() else args.step_size
+    prefix = args.file_prefix + '_' if args.file_prefix != '' else ''
+
+    # check that the files of all samples exist before starting any event loop
+    validation = catalogue.validate(
+        [sample_name for sample_name in args.samples if sample_name in catalogue],
+        workers=args.validation_workers
+    )
+
+    for sample_name in args.samples:
+        if sample_name not in samples:
+            logger.error("sample %s not found in data/samples.py, skipping", sample_name)
+            continue
+        if not validation[sample_name]["valid"]:
+            logger.error("sample %s has missing or unreadable files, skipping", sample_name)
+            continue
+        if not metadata_store.is_valid(sample_name, samples[sample_name]["metadata"]):
+            logger.error("sample %s has missing or invalid metadata, skipping", sample_name)
+            continue
+
+        results = run_sample(sample_name, specs, step_size=step_size)
+
+        for analysis_name, result in results.items():
+            sr_cutflows = result.cutflows()
+            sr_statistics = result.statistics()
+
+            # save the histograms to a ROOT file with directories for
+            # each signal region
+            if not args.skip_histograms:
+                histogram_file = args.output_dir / f"{prefix}histograms_{sample_name}_{analysis_name}.root"
+                logger.info("saving histograms to %s in output directory", histogram_file)
+                with uproot.recreate(histogram_file) as outfile:
+                    for sr, hists in result.histograms().items():
+                        for hist_name, hist in hists.items():
+                            outfile[f"{sr}/{hist_name}"] = hist
+
+            # save the cutflows to the results store and JSON files
+            if not args.skip_store_cutflows:
+                results_store.add_cutflows(sample_name, analysis_name, sr_cutflows, prefix=args.file_prefix)
+                if args.legacy_json:
+                    cutflow_file = args.output_dir / f"{prefix}cutflows_{sample_name}_{analysis_name}.json"
+                    logger.info("saving cutflows to %s in output directory", cutflow_file)
+                    with open(cutflow_file, "w") as f:
+                        json.dump(sr_cutflows, f, indent=4)
+
+                statistics_file = args.output_dir / f"{prefix}cutflow_statistics_{sample_name}_{analysis_name}.json"
+                logger.info("saving cutflow statistics to %s in output directory", statistics_file)
+                with open(statistics_file, "w") as f:
+                    json.dump(sr_statistics, f, indent=4)
+
+            # save the acceptances to the results store and a JSON file
+            sr_acceptances = cutflow_acceptances(sr_cutflows, metadata_store.xsec_factor(sample_name), sr_statistics)
+            results_store.add_acceptances(sample_name, analysis_name, sr_acceptances, prefix=args.file_prefix)
+            if not args.legacy_json:
+                continue
+            acceptance_file = args.output_dir / f"{prefix}acceptances_{sample_name}_{analysis_name}.json"
+            logger.info("saving acceptances to %s in output directory", acceptance_file)
+            with open(acceptance_file, "w") as f:
+                json.dump(sr_acceptances, f, indent=4)
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,137 @@
+"""
+
+Benchmark of the analysis backends on a single sample.
+
+Compares the event throughput (events / second) of:
+- rdf: the RDataFrame path used by modules/process_sample.py
+- numpy: the vectorised array backend in modules/array_backend.py
+- kernel: the fused Numba kernel in modules/dijet_kernel.py
+
+The RDF timing includes the JIT compilation of the graph, and the kernel
+timing is reported both with and without the Numba compilation (the first
+call compiles the kernel unless it is already cached on disk).
+
+Example:
+python modules/benchmark_backends.py -s HAHM_mmed600 -a run2_atlas_tla_dijet -b rdf numpy kernel
+
+"""
+import sys
+import argparse
+import importlib
+import json
+import time
+from data.samples import samples
+from modules.sample_catalogue import catalogue
+from modules.logger_setup import logger
+from modules.metadata import metadata_store
+import modules.array_backend as ab
+
+BACKENDS = ["rdf", "numpy", "kernel"]
+
+def benchmark_rdf(sample_id:str, analysis_module, workers:int=1):
+    # imported here so the other backends can be benchmarked without ROOT
+    import ROOT
+    import modules.common_tools as ct
+
+    if workers > 1:
+        ROOT.ROOT.EnableImplicitMT(workers)
+
+    start = time.perf_counter()
+    rdf = ct.load_delhes_rdf(
+        sample_id,
+        catalogue.files(sample_id),
+        samples[sample_id]["metadata"],
+        progess_bar=False
+    )
+    n_events = rdf.Count()
+    sr_dfs, sr_cutflows = analysis_module.analysis(rdf)
+    results = [n_events]
+    for sr in sr_dfs:
+        results += analysis_module.histograms(sr_dfs[sr])
+        results += list(sr_cutflows[sr].values())
+    ROOT.RDF.RunGraphs(results)
+    return n_events.GetValue(), time.perf_counter() - start
+
+def benchmark_numpy(sample_id:str, spec, step_size):
+    from modules.analysis_spec import ArrayAnalysis
+
+    weight_factor = metadata_store.weight_factor(sample_id)
+
+    start = time.perf_counter()
+    result = ArrayAnalysis(spec)
+    n_events = 0
+    for arrays, weights in ab.iterate_dijet_arrays(catalogue.files(sample_id), step_size=step_size):
+        result.process(arrays, weight_factor * weights)
+        n_events += len(weights)
+    return n_events, time.perf_counter() - start
+
+def benchmark_kernel(sample_id:str, spec, step_size):
+    from modules.dijet_kernel import FusedDijetAnalysis
+
+    weight_factor = metadata_store.weight_factor(sample_id)
+
+    start = time.perf_counter()
+    result = FusedDijetAnalysis(spec)
+    n_events = 0
+    first_chunk = {"events": 0, "seconds": 0.0}
+    for arrays in ab.iterate_chunks(catalogue.files(sample_id), step_size=step_size):
+        weights = weight_factor * ab.event_weights(arrays)
+        chunk_start = time.perf_counter()
+        result.process_chunk(arrays, weights)
+        if n_events == 0:
+            # the first call includes the compilation of the kernel
+            first_chunk = {"events": len(weights), "seconds": time.perf_counter() - chunk_start}
+        n_events += len(weights)
+    return n_events, time.perf_counter() - start, first_chunk
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the event throughput of the analysis backends",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("-s", "--sample", type=str, required=True, help="Sample to run over, as given in data/samples.py")
+    parser.add_argument("-a", "--analysis", type=str, default="run2_atlas_tla_dijet", help="Analysis module in analyses/")
+    parser.add_argument("-b", "--backends", type=str, nargs="+", choices=BACKENDS, default=BACKENDS, help="Backends to benchmark")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="Number of threads for the RDF backend")
+    parser.add_argument("--step-size", type=str, default=ab.DEFAULT_STEP_SIZE, help="Chunk size for the array backends")
+    parser.add_argument("--output", type=str, default=None, help="Optional JSON file to save the results to")
+    args = parser.parse_args()
+
+    if args.sample not in samples:
+        logger.error("sample %s not found in data/samples.py", args.sample)
+        return 1
+
+    analysis_module = importlib.import_module(f"analyses.{args.analysis}")
+    step_size = int(args.step_size) if args.step_size.isdigit() else args.step_size
+
+    results = dict()
+    for backend in args.backends:
+        logger.info("benchmarking %s backend on sample %s", backend, args.sample)
+        if backend == "rdf":
+            n_events, elapsed = benchmark_rdf(args.sample, analysis_module, args.workers)
+            results[backend] = {"events": n_events, "seconds": elapsed}
+        elif backend == "numpy":
+            n_events, elapsed = benchmark_numpy(args.sample, analysis_module.SPEC, step_size)
+            results[backend] = {"events": n_events, "seconds": elapsed}
+        elif backend == "kernel":
+            n_events, elapsed, first_chunk = benchmark_kernel(args.sample, analysis_module.SPEC, step_size)
+            results[backend] = {"events": n_events, "seconds": elapsed, "first_chunk_seconds": first_chunk["seconds"]}
+            if n_events > first_chunk["events"]:
+                results[backend]["events_per_second_after_first_chunk"] = (
+                    (n_events - first_chunk["events"]) / (elapsed - first_chunk["seconds"])
+                )
+        results[backend]["events_per_second"] = results[backend]["events"] / results[backend]["seconds"]
+        logger.info(
+            "%s backend: %s events in %.2f s (%.0f events / s)",
+            backend, results[backend]["events"], results[backend]["seconds"], results[backend]["events_per_second"]
+        )
+
+    print(json.dumps(results, indent=4))
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
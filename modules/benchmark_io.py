@@ -0,0 +1,112 @@
+"""
+
+Benchmark of the read throughput of the Delphes ntuples.
+
+Reads the branches used by the dijet analyses (computing the dijet
+preselection and mjj) with RDataFrame, for local and/or remote copies of
+the same files and for each combination of:
+- TTreeCache size (0 disables the cache)
+- asynchronous prefetching on or off
+- TTreeCache restricted to the dijet branches or filled by the learning phase
+
+and reports the MB read per second and events processed per second. Each
+configuration runs in a fresh process so that ROOT settings and open files
+do not carry over, but note that local files may be served from the page
+cache after the first read.
+
+Example:
+python modules/benchmark_io.py --local /tmp/generated_events_hahm_mmed600_1.root \
+    --remote root://eosuser.cern.ch//eos/user/.../generated_events_hahm_mmed600_1.root \
+    --cache-sizes-mb 0 10 100 --prefetch on off --output io_benchmark.json
+
+"""
+import sys
+import argparse
+import itertools
+import json
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from modules.logger_setup import logger
+from modules.delphes_branches import DIJET_BRANCHES
+
+def run_configuration(files:list, tree_name:str, cache_size_mb:float, prefetch:bool, restrict_branches:bool)->dict:
+    """
+    Read the files once with the given settings and return the timing and bytes read.
+    """
+    import ROOT
+    import modules.common_tools as ct
+
+    ROOT.gEnv.SetValue("TFile.AsyncPrefetching", int(prefetch))
+    bytes_before = ROOT.TFile.GetFileBytesRead()
+    start = time.perf_counter()
+
+    chain = ct.tuned_chain(tree_name, files, cache_size_mb, DIJET_BRANCHES if restrict_branches else None)
+    rdf = ROOT.RDataFrame(chain)
+    n_events = rdf.Count()
+    weights = rdf.Sum("Event.Weight")
+    mjj = ct.dijet_preselection(rdf).Sum("mjj")
+    ROOT.RDF.RunGraphs([n_events, weights, mjj])
+
+    elapsed = time.perf_counter() - start
+    megabytes = (ROOT.TFile.GetFileBytesRead() - bytes_before) / 1024**2
+    return {
+        "events": int(n_events.GetValue()),
+        "seconds": elapsed,
+        "MB": megabytes,
+        "MB_per_second": megabytes / elapsed,
+        "events_per_second": n_events.GetValue() / elapsed,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the read throughput of Delphes ntuples for different TTreeCache and prefetching settings",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("--local", type=str, nargs="+", default=None, help="Local copies of the files")
+    parser.add_argument("--remote", type=str, nargs="+", default=None, help="Remote (EOS-FUSE path or xrootd URL) copies of the files")
+    parser.add_argument("--tree-name", type=str, default="Delphes", help="Name of the Delphes tree")
+    parser.add_argument("--cache-sizes-mb", type=float, nargs="+", default=[0., 10., 30., 100.], help="TTreeCache sizes to test")
+    parser.add_argument("--prefetch", type=str, nargs="+", choices=["on", "off"], default=["off", "on"], help="Prefetching settings to test")
+    parser.add_argument("--branch-restriction", type=str, nargs="+", choices=["on", "off"], default=["off", "on"], help="Whether to restrict the TTreeCache to the dijet branches")
+    parser.add_argument("--output", type=str, default=None, help="Optional JSON file to save the results to")
+    args = parser.parse_args()
+
+    locations = {name: files for name, files in [("local", args.local), ("remote", args.remote)] if files is not None}
+    if len(locations) == 0:
+        logger.error("at least one of --local or --remote should be given")
+        return 1
+
+    results = list()
+    context = multiprocessing.get_context("spawn")
+    for (location, files), cache_size_mb, prefetch, restriction in itertools.product(
+        locations.items(), args.cache_sizes_mb, args.prefetch, args.branch_restriction
+    ):
+        configuration = {
+            "location": location,
+            "cache_size_mb": cache_size_mb,
+            "prefetch": prefetch == "on",
+            "branch_restriction": restriction == "on",
+        }
+        logger.info("running configuration %s", configuration)
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            result = executor.submit(
+                run_configuration, files, args.tree_name,
+                cache_size_mb, configuration["prefetch"], configuration["branch_restriction"]
+            ).result()
+        configuration.update(result)
+        logger.info(
+            "%.1f MB/s, %.0f events/s",
+            configuration["MB_per_second"], configuration["events_per_second"]
+        )
+        results.append(configuration)
+
+    print(json.dumps(results, indent=4))
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -8,21 +8,97 @@ analyses.
 
 """
 import ROOT
-import json
-from data.samples import samples
 from modules.logger_setup import logger
+from modules.metadata import metadata_store
 
 # load Delphes library
 ROOT.gSystem.Load("libDelphes.so")
 
-def load_delhes_rdf(sample_id:str, file_path:str, metadata_path:str, tree_name="Delphes", progess_bar=True):
+# chains passed to RDataFrame must outlive it so references are kept here
+_chains = list()
+# default TTreeCache size of ROOT, used when only the branches to cache are given
+DEFAULT_TREE_CACHE_MB = 30.0
+
+def tuned_chain(tree_name:str, file_path, cache_size_mb:float=None, branches:list=None):
+    """
+    Return a TChain over one or more files with explicit TTreeCache settings.
+
+    Parameters
+    ----------
+    cache_size_mb : float, optional
+        Size of the TTreeCache in MB, 0 disables the cache. Defaults to
+        DEFAULT_TREE_CACHE_MB if branches are given.
+    branches : list, optional
+        Branches to add to the TTreeCache. The learning phase is skipped so
+        only these branches are prefetched from the start.
+    """
+    chain = ROOT.TChain(tree_name)
+    for path in ([file_path] if isinstance(file_path, str) else file_path):
+        chain.Add(path)
+    if branches is not None:
+        if cache_size_mb is None:
+            cache_size_mb = DEFAULT_TREE_CACHE_MB
+        elif cache_size_mb == 0:
+            logger.warning("the TTreeCache is disabled, not restricting it to branches %s", branches)
+            branches = None
+    if cache_size_mb is not None:
+        chain.SetCacheSize(int(cache_size_mb * 1024**2))
+    if branches is not None:
+        # the cache belongs to the file of the current tree, so the first tree
+        # must be loaded before branches can be added to it
+        if chain.LoadTree(0) < 0:
+            logger.warning("cannot load the first tree of chain %s, not restricting the TTreeCache", tree_name)
+        else:
+            for branch in branches:
+                if chain.AddBranchToCache(branch, True) < 0:
+                    logger.warning("failed to add branch %s to the TTreeCache of chain %s", branch, tree_name)
+            if chain.StopCacheLearningPhase() < 0:
+                logger.warning("failed to stop the TTreeCache learning phase of chain %s", tree_name)
+    _chains.append(chain)
+    return chain
+
+def load_delhes_rdf(
+    sample_id:str,
+    file_path:str,
+    metadata_path:str,
+    tree_name="Delphes",
+    progess_bar=True,
+    weight_vector_branch:str=None,
+    cache_size_mb:float=None,
+    prefetch:bool=None,
+    branches:list=None,
+    weight_factor:float=None,
+):
     """
     Load a Delphes ROOT file as a RDataFrame.
 
     Parameters
     ----------
+    file_path : str or list
+        Path of the Delphes ROOT file, or list of files opened as a chain
+        (see SampleCatalogue.files in modules/sample_catalogue.py).
     tree_name : str
         Name of the Delphes tree in the ROOT file.
+    weight_vector_branch : str, optional
+        Branch holding multiple weights per event (e.g. Weight.Weight for the
+        MadGraph scale/PDF weights). If given, the normalised weight vector
+        and the index of each weight are defined as mcEventWeights and
+        mcEventWeightIndex.
+    cache_size_mb : float, optional
+        TTreeCache size in MB (0 disables it), by default RDF picks the size.
+    prefetch : bool, optional
+        Whether to enable asynchronous prefetching of the baskets (TFile.AsyncPrefetching),
+        by default the ROOT configuration is used.
+    branches : list, optional
+        Branches to restrict the TTreeCache to (see tuned_chain).
+    weight_factor : float, optional
+        Factor normalising Event.Weight, by default taken from the metadata
+        file. Use 1.0 to keep the raw weights and normalise the results after
+        the event loop instead (e.g. when the sum of weights is not known yet).
+
+    The cache size and branch restriction are set on the TChain read by RDF,
+    so they only apply without implicit multi-threading, where RDF creates
+    its own chains for each task.
 
     Returns
     -------
@@ -30,21 +106,22 @@ def load_delhes_rdf(sample_id:str, file_path:str, metadata_path:str, tree_name="
         RDataFrame corresponding to the Delphes tree.
     """
 
-    rdf = ROOT.RDataFrame(tree_name, file_path)
+    if prefetch is not None:
+        # needs to be set before the files are opened
+        ROOT.gEnv.SetValue("TFile.AsyncPrefetching", int(prefetch))
+    if cache_size_mb is None and branches is None:
+        rdf = ROOT.RDataFrame(tree_name, file_vector(file_path))
+    else:
+        if ROOT.IsImplicitMTEnabled():
+            logger.warning("TTreeCache size and branch restriction are ignored by RDF with implicit multi-threading")
+        rdf = ROOT.RDataFrame(tuned_chain(tree_name, file_path, cache_size_mb, branches))
     if progess_bar:
         ROOT.RDF.Experimental.AddProgressBar(rdf)
 
-    # load the metadata file to get the sum of weights
-    # and cross-section information
-    with open(metadata_path, 'r') as f:
-        metadata = json.load(f)
-
-    # calculate the weight factor for normalising the event weights
-    # include the BR where this is defined in the metadata file, otherwise assume it is 1
-    # (i.e. the cross-section already includes the BR)
-    weight_factor = (metadata[sample_id]['xsec'] * metadata[sample_id].get('br', 1.0)) / metadata[sample_id]['sumW']
-    if not samples[sample_id].get("uses_pythia8", False):
-        weight_factor = weight_factor * metadata[sample_id].get('filter_eff', 1.0)
+    # weight factor for normalising the event weights from the sum of weights
+    # and cross-section information, the metadata file is only parsed once per process
+    if weight_factor is None:
+        weight_factor = metadata_store.weight_factor(sample_id, metadata_path)
     logger.info("calculated weight factor for sample %s of %s", sample_id, weight_factor)
     
     # define a new column with normalised event weights
@@ -52,9 +129,208 @@ def load_delhes_rdf(sample_id:str, file_path:str, metadata_path:str, tree_name="
         "mcEventWeight",
         f"return {weight_factor} * Event.Weight;"
     )
+    rdf = rdf.Define(
+        "mcEventWeight2",
+        "return mcEventWeight * mcEventWeight;"
+    )
+
+    # the weight vector is normalised with the same factor as the nominal weight
+    if weight_vector_branch is not None:
+        rdf = rdf.Define(
+            "mcEventWeights",
+            f"return {weight_factor} * ROOT::RVec<double>({weight_vector_branch});"
+        )
+        rdf = rdf.Define(
+            "mcEventWeightIndex",
+            "return ROOT::VecOps::Enumerate(mcEventWeights);"
+        )
 
     return rdf
 
+def file_vector(file_path):
+    """
+    Return a single path or a list of paths as a std::vector for RDataFrame.
+    """
+    files = [file_path] if isinstance(file_path, str) else list(file_path)
+    return ROOT.std.vector["std::string"](files)
+
+def get_weight_vector_size(file_path, weight_vector_branch:str, tree_name="Delphes")->int:
+    """
+    Return the number of weights stored per event in a weight vector branch,
+    read from the first entry of the (first) file.
+    """
+    size_leaf = f"{weight_vector_branch.split('.')[0]}_size"
+    if not isinstance(file_path, str):
+        file_path = file_path[0]
+    with ROOT.TFile.Open(file_path) as infile:
+        tree = infile.Get(tree_name)
+        if tree.GetEntries() == 0:
+            return 0
+        tree.GetEntry(0)
+        return int(tree.GetLeaf(size_leaf).GetValue())
+
+# kinematic columns for the two leading jets shared by all dijet analyses
+# NOTE these read Jet.*[1] so they are only valid for events with at least
+# two jets, i.e. downstream of the multiplicity cut in dijet_preselection
+DIJET_JET_COLUMNS = dict()
+for i_jet in range(0, 2):
+    DIJET_JET_COLUMNS[f"Jet{i_jet}_pt"] = f"Jet.PT[{i_jet}]"
+    DIJET_JET_COLUMNS[f"Jet{i_jet}_eta"] = f"Jet.Eta[{i_jet}]"
+    DIJET_JET_COLUMNS[f"Jet{i_jet}_phi"] = f"Jet.Phi[{i_jet}]"
+    DIJET_JET_COLUMNS[f"Jet{i_jet}_mass"] = f"Jet.Mass[{i_jet}]"
+
+# columns derived from the leading jets, defined after any systematic
+# variations of the jets so that the variations propagate through them
+DIJET_DERIVED_COLUMNS = dict()
+for i_jet in range(0, 2):
+    DIJET_DERIVED_COLUMNS[f"Jet{i_jet}_p4"] = f"""
+        ROOT::Math::PtEtaPhiMVector tmp(Jet{i_jet}_pt, Jet{i_jet}_eta, Jet{i_jet}_phi, Jet{i_jet}_mass);
+        return tmp;
+        """
+for i_jet in range(0, 2):
+    DIJET_DERIVED_COLUMNS[f"Jet{i_jet}_rapidity"] = f"return Jet{i_jet}_p4.Rapidity();"
+DIJET_DERIVED_COLUMNS["y_star"] = "return 0.5 * fabs(Jet0_rapidity - Jet1_rapidity);"
+DIJET_DERIVED_COLUMNS["mjj"] = "return (Jet0_p4 + Jet1_p4).M();"
+
+DIJET_COLUMNS = {**DIJET_JET_COLUMNS, **DIJET_DERIVED_COLUMNS}
+
+# expressions of the columns defined through define_columns, used to
+# check that a column is never defined twice with different meanings
+_defined_columns = dict()
+
+def define_columns(df, columns:dict):
+    """
+    Define columns on a RDF node, skipping any column that already exists
+    with the same expression so that identical defines are only evaluated once.
+
+    Parameters
+    ----------
+    df : ROOT.RDF.RNode
+        Node to define the columns on.
+    columns : dict
+        Ordered mapping of column name to expression.
+
+    Returns
+    -------
+    ROOT.RDF.RNode
+        Node with all the requested columns available.
+    """
+    for name, expression in columns.items():
+        if df.HasColumn(name):
+            if _defined_columns.get(name) != expression:
+                raise ValueError(f"column {name} is already defined with a different expression")
+            logger.debug("column %s already defined, reusing it", name)
+            continue
+        df = df.Define(name, expression)
+        _defined_columns[name] = expression
+    return df
+
+# helper smearing the jets for the JER variation. The Gaussian is computed from a
+# hash (splitmix64) of the Delphes event number and the jet index instead of a
+# random engine, so the smearing of an event is the same between runs whatever
+# the order or thread it is processed in (rdfentry_ is not with implicit MT)
+ROOT.gInterpreter.Declare("""
+#include <cmath>
+inline ULong64_t dijet_splitmix64(ULong64_t x) {
+    x += 0x9e3779b97f4a7c15ULL;
+    x = (x ^ (x >> 30)) * 0xbf58476d1ce4e5b9ULL;
+    x = (x ^ (x >> 27)) * 0x94d049bb133111ebULL;
+    return x ^ (x >> 31);
+}
+float dijet_jer_factor(Long64_t event_number, unsigned int i_jet, float resolution) {
+    const ULong64_t hash = dijet_splitmix64(dijet_splitmix64(static_cast<ULong64_t>(event_number)) + i_jet);
+    // Box-Muller transform of two uniforms in (0, 1] from the two halves of the hash
+    const double u1 = ((hash >> 32) + 1.) / 4294967296.;
+    const double u2 = ((hash & 0xffffffffULL) + 1.) / 4294967296.;
+    const double gaus = std::sqrt(-2. * std::log(u1)) * std::cos(2. * M_PI * u2);
+    return std::max(0.f, static_cast<float>(1. + resolution * gaus));
+}
+""")
+
+# leading jet columns scaled by the jet energy scale and resolution variations
+VARIED_JET_COLUMNS = ["Jet0_pt", "Jet1_pt", "Jet0_mass", "Jet1_mass"]
+
+def jet_variations(jes_uncertainty:float=0.02, jer_resolution:float=0.05)->dict:
+    """
+    Return the jet energy scale and resolution variations to apply in
+    dijet_preselection.
+
+    Parameters
+    ----------
+    jes_uncertainty : float
+        Relative uncertainty on the jet energy scale, the pT and mass of both
+        leading jets are scaled up and down by this fraction.
+    jer_resolution : float
+        Relative width of the Gaussian used to smear the pT and mass of the
+        leading jets on top of the Delphes resolution.
+
+    Returns
+    -------
+    dict
+        Mapping of variation name to the variation tags and the expression
+        returning the varied VARIED_JET_COLUMNS, as expected by RDF Vary.
+    """
+    jes_factors = [f"{1 - jes_uncertainty}f", f"{1 + jes_uncertainty}f"]
+    jes_expression = ", ".join(
+        "{" + ", ".join(f"{factor} * {column}" for factor in jes_factors) + "}"
+        for column in VARIED_JET_COLUMNS
+    )
+    # the pT and mass of each jet are smeared by the same factor
+    jer_expression = ", ".join(
+        f"{{dijet_jer_factor(Event.Number[0], {column[len('Jet')]}, {jer_resolution}f) * {column}}}"
+        for column in VARIED_JET_COLUMNS
+    )
+    return {
+        "JES": (["down", "up"], f"return ROOT::RVec<ROOT::RVec<float>>{{{jes_expression}}};"),
+        "JER": (["smear"], f"return ROOT::RVec<ROOT::RVec<float>>{{{jer_expression}}};"),
+    }
+
+def dijet_preselection(df, variations:dict=None):
+    """
+    Apply the multiplicity cut common to all dijet analyses and define
+    the leading-dijet columns on top of it.
+
+    Defines are evaluated lazily and cached per event, so analyses that
+    branch from the returned node share the per-event kinematics instead
+    of each recomputing them.
+
+    Parameters
+    ----------
+    df : ROOT.RDF.RNode
+        Sample RDF as returned by load_delhes_rdf.
+    variations : dict, optional
+        Systematic variations of the leading jets as returned by
+        jet_variations. These are registered with Vary before the derived
+        columns so that the cuts, y_star and mjj of every analysis are
+        also varied, and can be retrieved with VariationsFor.
+
+    Returns
+    -------
+    ROOT.RDF.RNode
+        Node with at least 2 jets per event and DIJET_COLUMNS defined.
+    """
+    df = df.Filter("Jet_size >= 2", "At least 2 jets")
+    df = define_columns(df, DIJET_JET_COLUMNS)
+    if variations is not None:
+        for variation_name, (tags, expression) in variations.items():
+            logger.info("registering jet variation %s with tags %s", variation_name, tags)
+            df = df.Vary(VARIED_JET_COLUMNS, expression, tags, variation_name)
+    return define_columns(df, DIJET_DERIVED_COLUMNS)
+
+def variations_for(result):
+    """
+    Book the systematic variations of a RDF result, must be called
+    before the event loop is run.
+    """
+    return ROOT.RDF.Experimental.VariationsFor(result)
+
+def variation_values(result_map)->dict:
+    """
+    Return the values of a RDF result map as a dictionary keyed by
+    variation (nominal, JES:up, ...).
+    """
+    return {str(key): result_map[key] for key in result_map.GetKeys()}
+
 # histogramming
 def bookHist(df, name, title, nBinsX, binLow, binHigh, var):
     h = df.Histo1D((name, title, nBinsX, binLow, binHigh), var)
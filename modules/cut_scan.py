@@ -0,0 +1,266 @@
+"""
+
+Scan of the analysis acceptance over grids of cut thresholds.
+
+Instead of rerunning the analysis for each variation of the selection,
+the events are read once with the array backend. For each event passing
+the cuts that are not scanned, the position of the event relative to
+each threshold grid is filled into a multi-dimensional histogram. The
+acceptance for every grid point is then obtained from cumulative sums
+of that histogram along each threshold axis.
+
+Two types of scan axes are supported:
+- ThresholdScan replaces the value of Threshold requirements, e.g. both
+  jet pT cuts, y_star < X or the mjj cut defining a signal region
+- VetoScan replaces the range of Veto requirements (e.g. the TileGap)
+  with each of a list of ranges, treated as a categorical axis
+
+Example for the Run 2 TLA J50 region:
+python modules/cut_scan.py -s HAHM_mmed600 -a run2_atlas_tla_dijet -r J50 -o outputs \
+    --pt-grid 70 75 80 85 90 95 100 --y-star-grid 0.4 0.5 0.6 0.7 0.8 --mjj-grid 300 344 400 481
+
+"""
+import sys
+import argparse
+import importlib
+import itertools
+import json
+import pathlib
+from dataclasses import dataclass
+import numpy as np
+from data.samples import samples
+from modules.sample_catalogue import catalogue
+from modules.logger_setup import logger
+from modules.analysis_spec import AnalysisSpec, Threshold, Veto, dijet_kinematics
+from modules.metadata import metadata_store
+import modules.array_backend as ab
+
+@dataclass(frozen=True)
+class ThresholdScan:
+    """
+    Scan of the threshold of all Threshold requirements on the given
+    variables with the given comparison, e.g. both leading jet pT cuts.
+    """
+    name: str
+    variables: tuple
+    op: str
+    values: tuple
+    absolute: bool = False
+
+    def matches(self, requirement):
+        return (
+            isinstance(requirement, Threshold)
+            and requirement.variable in self.variables
+            and requirement.op == self.op
+            and requirement.absolute == self.absolute
+        )
+
+    def bin_index(self, arrays:dict):
+        """
+        Return for each event the number of grid points passed for lower
+        bounds, or the first grid point passed for upper bounds.
+        """
+        values = np.stack([
+            np.abs(arrays[variable]) if self.absolute else arrays[variable]
+            for variable in self.variables
+        ])
+        grid = np.asarray(self.values)
+        # all variables must pass the threshold so the event is limited
+        # by the smallest value for lower bounds and largest for upper bounds
+        if self.op in [">", ">="]:
+            return np.searchsorted(grid, values.min(axis=0), side="left" if self.op == ">" else "right")
+        return np.searchsorted(grid, values.max(axis=0), side="right" if self.op == "<" else "left")
+
+    def accumulate(self, hist, axis:int):
+        """
+        Convert the bin contents along an axis into the yield passing each threshold.
+        """
+        if self.op in [">", ">="]:
+            # events in bin j pass thresholds 0..j-1
+            passed = np.flip(np.cumsum(np.flip(hist, axis=axis), axis=axis), axis=axis)
+            return np.take(passed, range(1, len(self.values) + 1), axis=axis)
+        # events in bin j pass thresholds j..K-1
+        passed = np.cumsum(hist, axis=axis)
+        return np.take(passed, range(0, len(self.values)), axis=axis)
+
+@dataclass(frozen=True)
+class VetoScan:
+    """
+    Scan of the range of all Veto requirements on the given variables,
+    with each entry of ranges given as a (low, high) pair.
+    """
+    name: str
+    variables: tuple
+    ranges: tuple
+    absolute: bool = False
+
+    def matches(self, requirement):
+        return (
+            isinstance(requirement, Veto)
+            and requirement.variable in self.variables
+            and requirement.absolute == self.absolute
+        )
+
+    def passes(self, arrays:dict, i_range:int):
+        low, high = self.ranges[i_range]
+        return np.logical_and.reduce([
+            Veto(variable, low, high, self.absolute).evaluate(arrays)
+            for variable in self.variables
+        ])
+
+class CutScan:
+    """
+    Accumulates the weighted yields needed to compute the acceptance of one
+    signal region of an analysis spec for every point of the scan grid.
+    """
+
+    def __init__(self, spec:AnalysisSpec, signal_region:str, axes:list):
+        self.spec = spec
+        self.signal_region = signal_region
+        self.axes = list(axes)
+        self.threshold_axes = [axis for axis in self.axes if isinstance(axis, ThresholdScan)]
+        self.veto_axes = [axis for axis in self.axes if isinstance(axis, VetoScan)]
+
+        # split the requirements into those replaced by the scan and those kept fixed
+        cuts = list(spec.cuts) + [spec.get_signal_region(signal_region).cut]
+        self.fixed_requirements = list()
+        matched_axes = set()
+        for cut in cuts:
+            for requirement in cut.requirements:
+                matches = [axis.name for axis in self.axes if axis.matches(requirement)]
+                if len(matches) == 0:
+                    self.fixed_requirements.append(requirement)
+                matched_axes.update(matches)
+        for axis in self.axes:
+            if axis.name not in matched_axes:
+                logger.warning("scan axis %s does not replace any cut of analysis %s, it is applied as an extra cut", axis.name, spec.name)
+
+        # threshold axes have one extra bin for events passing none or all of the thresholds
+        self.shape = tuple(len(axis.values) + 1 for axis in self.threshold_axes) + tuple(len(axis.ranges) for axis in self.veto_axes)
+        self.hist = np.zeros(self.shape)
+        self.total_sumW = 0.0
+
+    def process(self, arrays:dict, weights):
+        if "mjj" not in arrays:
+            dijet_kinematics(arrays)
+        for variable in self.spec.variables:
+            if variable.name not in arrays:
+                arrays[variable.name] = variable.function(arrays)
+        self.total_sumW += float(np.sum(weights))
+
+        mask = arrays["Jet_size"] >= 2
+        for requirement in self.fixed_requirements:
+            mask = mask & requirement.evaluate(arrays)
+
+        # flattened index of each event along the threshold axes
+        n_threshold_bins = int(np.prod(self.shape[:len(self.threshold_axes)]))
+        threshold_index = np.zeros(np.count_nonzero(mask), dtype=np.int64)
+        selected = {name: values[mask] for name, values in arrays.items()}
+        for i_axis, axis in enumerate(self.threshold_axes):
+            threshold_index = threshold_index * self.shape[i_axis] + axis.bin_index(selected)
+
+        # the veto ranges are categories, an event can pass several so fill each separately
+        hist = self.hist.reshape(n_threshold_bins, -1)
+        for i_category, ranges in enumerate(itertools.product(*[range(len(axis.ranges)) for axis in self.veto_axes])):
+            passed = np.ones(len(threshold_index), dtype=bool)
+            for axis, i_range in zip(self.veto_axes, ranges):
+                passed &= axis.passes(selected, i_range)
+            hist[:, i_category] += np.bincount(
+                threshold_index[passed],
+                weights=weights[mask][passed],
+                minlength=n_threshold_bins
+            )
+
+    def yields(self):
+        """
+        Return the weighted yield for every point of the scan grid.
+        """
+        passed = self.hist
+        for i_axis, axis in enumerate(self.threshold_axes):
+            passed = axis.accumulate(passed, i_axis)
+        return passed
+
+    def acceptance(self):
+        return self.yields() / self.total_sumW if self.total_sumW > 0 else np.zeros_like(self.yields())
+
+    def to_dict(self):
+        return {
+            "analysis": self.spec.name,
+            "signal_region": self.signal_region,
+            "axes": {
+                axis.name: list(axis.values) if isinstance(axis, ThresholdScan) else [list(r) for r in axis.ranges]
+                for axis in self.threshold_axes + self.veto_axes
+            },
+            "total_sumW": self.total_sumW,
+            "acceptance": self.acceptance().tolist(),
+        }
+
+def run_scan(sample_id:str, scans:list, step_size=ab.DEFAULT_STEP_SIZE):
+    """
+    Fill a list of CutScan objects in a single pass over a sample.
+    """
+    weight_factor = metadata_store.weight_factor(sample_id)
+    for arrays, weights in ab.iterate_dijet_arrays(catalogue.files(sample_id), step_size=step_size):
+        for scan in scans:
+            scan.process(arrays, weight_factor * weights)
+    return scans
+
+def parse_range(value:str):
+    low, high = value.split(":")
+    return (float(low), float(high))
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Scan the acceptance of a dijet analysis over grids of cut thresholds in a single pass",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("-s", "--samples", type=str, nargs="+", required=True, help="Names of the samples to process, as given in data/samples.py")
+    parser.add_argument("-a", "--analysis", type=str, default="run2_atlas_tla_dijet", help="Analysis module in analyses/")
+    parser.add_argument("-r", "--signal-regions", type=str, nargs="+", default=None, help="Signal regions to scan (all if not given)")
+    parser.add_argument("-o", "--output-dir", type=pathlib.Path, required=True, help="Directory to save output files")
+    parser.add_argument("--pt-grid", type=float, nargs="+", default=None, help="Thresholds for the leading jet pT cuts")
+    parser.add_argument("--y-star-grid", type=float, nargs="+", default=None, help="Thresholds for the y_star cut")
+    parser.add_argument("--mjj-grid", type=float, nargs="+", default=None, help="Thresholds for the mjj cut defining the signal region")
+    parser.add_argument("--tilegap-ranges", type=parse_range, nargs="+", default=None, help="|eta| ranges vetoed by the TileGap cut, given as low:high")
+    parser.add_argument("--step-size", type=str, default=ab.DEFAULT_STEP_SIZE, help="Chunk size for reading the samples")
+    parser.add_argument("--file-prefix", type=str, default="", help="Prefix to add to the output files")
+    args = parser.parse_args()
+
+    if not args.output_dir.exists():
+        logger.error("output directory %s does not exist", args.output_dir)
+        return 1
+
+    axes = list()
+    if args.pt_grid is not None:
+        axes.append(ThresholdScan("jet_pt", ("Jet0_pt", "Jet1_pt"), ">", tuple(sorted(args.pt_grid))))
+    if args.y_star_grid is not None:
+        axes.append(ThresholdScan("y_star", ("y_star",), "<", tuple(sorted(args.y_star_grid))))
+    if args.mjj_grid is not None:
+        axes.append(ThresholdScan("mjj", ("mjj",), ">", tuple(sorted(args.mjj_grid))))
+    if args.tilegap_ranges is not None:
+        axes.append(VetoScan("tilegap", ("Jet0_eta", "Jet1_eta"), tuple(args.tilegap_ranges), absolute=True))
+    if len(axes) == 0:
+        logger.error("no scan grids given, nothing to do!")
+        return 1
+
+    spec = importlib.import_module(f"analyses.{args.analysis}").SPEC
+    signal_regions = args.signal_regions if args.signal_regions is not None else [sr.name for sr in spec.signal_regions]
+    step_size = int(args.step_size) if args.step_size.isdigit() else args.step_size
+    prefix = args.file_prefix + '_' if args.file_prefix != '' else ''
+
+    for sample_name in args.samples:
+        if sample_name not in samples:
+            logger.error("sample %s not found in data/samples.py, skipping", sample_name)
+            continue
+        logger.info("running cut scan for sample %s", sample_name)
+        scans = run_scan(sample_name, [CutScan(spec, sr, axes) for sr in signal_regions], step_size=step_size)
+
+        scan_file = args.output_dir / f"{prefix}cut_scan_{sample_name}_{args.analysis}.json"
+        logger.info("saving cut scan to %s in output directory", scan_file)
+        with open(scan_file, "w") as f:
+            json.dump({scan.signal_region: scan.to_dict() for scan in scans}, f, indent=4)
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,240 @@
+"""
+
+Per-event store of the cut decisions of the dijet analyses.
+
+The samples are read once with the array backend and, for every event,
+the outcome of each cut of each analysis is packed into a single bit of a
+64 bit mask, stored together with the normalised event weight and mjj.
+Bits are labelled as:
+- "At least 2 jets" for the dijet preselection
+- "<analysis>:<cut>" for the cuts shared by the signal regions
+- "<analysis>:<signal region>:<cut>" for the cut defining each signal region
+
+Each bit is the outcome of that cut alone, so cutflows in any order, N-1
+yields and overlaps between signal regions can be computed from the store
+with vectorised bit operations instead of re-reading the ntuple.
+
+Example:
+python modules/cut_store.py -s HAHM_mmed600 -a run1_atlas_8tev_dijet run2_atlas_tla_dijet -o outputs
+
+store = CutStore.load("outputs/cut_store_HAHM_mmed600.npz")
+store.cutflow(store.signal_region_cuts("run2_atlas_tla_dijet", "J50")[::-1])
+store.n_minus_one(store.signal_region_cuts("run2_atlas_tla_dijet", "J50"))
+
+"""
+import sys
+import argparse
+import importlib
+import json
+import pathlib
+import numpy as np
+from data.samples import samples
+from modules.sample_catalogue import catalogue
+from modules.logger_setup import logger
+from modules.analysis_spec import PRESELECTION_STEP, dijet_kinematics
+from modules.metadata import metadata_store
+import modules.array_backend as ab
+
+MAX_BITS = 64
+
+def cut_labels(specs:dict)->list:
+    """
+    Return the ordered bit labels for a set of analysis specs.
+    """
+    labels = [PRESELECTION_STEP]
+    for analysis_name, spec in specs.items():
+        labels += [f"{analysis_name}:{cut.name}" for cut in spec.cuts]
+        labels += [f"{analysis_name}:{sr.name}:{sr.cut.name}" for sr in spec.signal_regions]
+    if len(labels) > MAX_BITS:
+        raise ValueError(f"{len(labels)} cuts requested but at most {MAX_BITS} can be stored per event")
+    return labels
+
+def cut_decisions(specs:dict, arrays:dict)->np.ndarray:
+    """
+    Return the bitmask of the cut decisions of each event in a chunk,
+    with bits ordered as in cut_labels.
+    """
+    if "mjj" not in arrays:
+        dijet_kinematics(arrays)
+    decisions = [arrays["Jet_size"] >= 2]
+    for spec in specs.values():
+        for variable in spec.variables:
+            if variable.name not in arrays:
+                arrays[variable.name] = variable.function(arrays)
+        decisions += [cut.evaluate(arrays) for cut in spec.cuts]
+        decisions += [sr.cut.evaluate(arrays) for sr in spec.signal_regions]
+
+    bits = np.zeros(len(arrays["Jet_size"]), dtype=np.uint64)
+    for i_bit, decision in enumerate(decisions):
+        bits |= decision.astype(np.uint64) << np.uint64(i_bit)
+    return bits
+
+class CutStore:
+    """
+    Cut decisions, normalised weights and mjj for every event of a sample.
+    """
+
+    def __init__(self, labels:list, bits:np.ndarray, weights:np.ndarray, mjj:np.ndarray):
+        self.labels = list(labels)
+        self.bits = bits
+        self.weights = weights
+        self.mjj = mjj
+
+    @classmethod
+    def build(cls, sample_id:str, specs:dict, step_size=ab.DEFAULT_STEP_SIZE):
+        """
+        Build the store for a sample in a single pass.
+
+        Parameters
+        ----------
+        sample_id : str
+            Sample name as given in data/samples.py.
+        specs : dict
+            Mapping of analysis name to AnalysisSpec.
+        """
+        labels = cut_labels(specs)
+        weight_factor = metadata_store.weight_factor(sample_id)
+
+        bits, weights, mjj = list(), list(), list()
+        for arrays, chunk_weights in ab.iterate_dijet_arrays(catalogue.files(sample_id), step_size=step_size):
+            bits.append(cut_decisions(specs, arrays))
+            weights.append(weight_factor * chunk_weights)
+            mjj.append(arrays["mjj"])
+        logger.info("stored %s cut decisions for %s events of sample %s", len(labels), sum(len(b) for b in bits), sample_id)
+
+        return cls(
+            labels,
+            np.concatenate(bits) if bits else np.zeros(0, dtype=np.uint64),
+            np.concatenate(weights) if weights else np.zeros(0),
+            np.concatenate(mjj) if mjj else np.zeros(0),
+        )
+
+    def save(self, path):
+        np.savez_compressed(path, labels=np.array(self.labels), bits=self.bits, weights=self.weights, mjj=self.mjj)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as store:
+            return cls(store["labels"].tolist(), store["bits"], store["weights"], store["mjj"])
+
+    def bitmask(self, cuts:list)->np.uint64:
+        """
+        Return the combined bitmask of a list of cut labels.
+        """
+        mask = np.uint64(0)
+        for cut in cuts:
+            if cut not in self.labels:
+                raise KeyError(f"cut {cut} not in store, available cuts are {self.labels}")
+            mask |= np.uint64(1) << np.uint64(self.labels.index(cut))
+        return mask
+
+    def passes(self, cuts:list, preselection:bool=True)->np.ndarray:
+        """
+        Return the events passing all the given cuts (and the dijet
+        preselection, which the analysis cuts rely on, unless disabled).
+        """
+        cuts = ([PRESELECTION_STEP] if preselection else []) + list(cuts)
+        mask = self.bitmask(cuts)
+        return (self.bits & mask) == mask
+
+    def sumW(self, cuts:list, preselection:bool=True)->float:
+        return float(np.sum(self.weights[self.passes(cuts, preselection)]))
+
+    def signal_region_cuts(self, analysis_name:str, signal_region:str)->list:
+        """
+        Return the labels of the cuts defining a signal region, in the
+        order they are applied in the analysis.
+        """
+        prefix = f"{analysis_name}:"
+        shared = [label for label in self.labels if label.startswith(prefix) and label.count(":") == 1]
+        region = [label for label in self.labels if label.startswith(f"{prefix}{signal_region}:")]
+        if len(region) == 0:
+            raise KeyError(f"signal region {signal_region} of analysis {analysis_name} not in store")
+        return shared + region
+
+    def cutflow(self, cuts:list)->dict:
+        """
+        Return the cumulative weighted yields applying the cuts in the given
+        order, in the same format as the analysis cutflows.
+        """
+        cutflow = {"initial": float(np.sum(self.weights))}
+        cumulative = np.uint64(0)
+        for cut in [PRESELECTION_STEP] + [cut for cut in cuts if cut != PRESELECTION_STEP]:
+            cumulative |= self.bitmask([cut])
+            cutflow[cut] = float(np.sum(self.weights[(self.bits & cumulative) == cumulative]))
+        return cutflow
+
+    def n_minus_one(self, cuts:list)->dict:
+        """
+        Return the weighted yield passing all but one of the given cuts, for each cut.
+        """
+        return {
+            cut: self.sumW([other for other in cuts if other != cut])
+            for cut in cuts
+        }
+
+    def n_minus_one_mjj(self, cuts:list, bins)->dict:
+        """
+        Return the N-1 mjj distributions as (counts, edges) for each of the given cuts.
+        """
+        distributions = dict()
+        for cut in cuts:
+            mask = self.passes([other for other in cuts if other != cut])
+            distributions[cut] = np.histogram(self.mjj[mask], bins=bins, weights=self.weights[mask])
+        return distributions
+
+    def overlap(self, cuts_a:list, cuts_b:list)->dict:
+        """
+        Return the weighted yields of events passing both selections or only one of them,
+        e.g. between the signal regions of two analyses.
+        """
+        passes_a = self.passes(cuts_a)
+        passes_b = self.passes(cuts_b)
+        return {
+            "both": float(np.sum(self.weights[passes_a & passes_b])),
+            "only_a": float(np.sum(self.weights[passes_a & ~passes_b])),
+            "only_b": float(np.sum(self.weights[~passes_a & passes_b])),
+        }
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Store the per-event cut decisions of the dijet analyses for a set of samples",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("-s", "--samples", type=str, nargs="+", required=True, help="Names of the samples to process, as given in data/samples.py")
+    parser.add_argument("-a", "--analyses", type=str, nargs="+", default=["run2_atlas_tla_dijet"], help="List of analyses to store (corresponding to module names in analyses/)")
+    parser.add_argument("-o", "--output-dir", type=pathlib.Path, required=True, help="Directory to save output files")
+    parser.add_argument("--step-size", type=str, default=ab.DEFAULT_STEP_SIZE, help="Chunk size for reading the samples")
+    parser.add_argument("--file-prefix", type=str, default="", help="Prefix to add to the output files")
+    args = parser.parse_args()
+
+    if not args.output_dir.exists():
+        logger.error("output directory %s does not exist", args.output_dir)
+        return 1
+
+    specs = {name: importlib.import_module(f"analyses.{name}").SPEC for name in args.analyses}
+    step_size = int(args.step_size) if args.step_size.isdigit() else args.step_size
+    prefix = args.file_prefix + '_' if args.file_prefix != '' else ''
+
+    for sample_name in args.samples:
+        if sample_name not in samples:
+            logger.error("sample %s not found in data/samples.py, skipping", sample_name)
+            continue
+        store = CutStore.build(sample_name, specs, step_size=step_size)
+        store_file = args.output_dir / f"{prefix}cut_store_{sample_name}.npz"
+        logger.info("saving cut decisions to %s in output directory", store_file)
+        store.save(store_file)
+
+        # summarise the default cutflows as a check of the store
+        for analysis_name, spec in specs.items():
+            for sr in spec.signal_regions:
+                logger.info(
+                    "cutflow for %s %s:\n%s",
+                    analysis_name, sr.name,
+                    json.dumps(store.cutflow(store.signal_region_cuts(analysis_name, sr.name)), indent=4)
+                )
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
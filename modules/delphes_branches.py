@@ -0,0 +1,21 @@
+"""
+
+Names of the Delphes branches read by the dijet analyses.
+
+Kept free of any dependency so that they can be imported on the submit
+node (see utils/submit_jobs.py) as well as by the array backend.
+
+"""
+
+# branches needed by the dijet analyses
+JET_BRANCHES = {
+    "pt": "Jet.PT",
+    "eta": "Jet.Eta",
+    "phi": "Jet.Phi",
+    "mass": "Jet.Mass",
+}
+JET_SIZE_BRANCH = "Jet_size"
+WEIGHT_BRANCH = "Event.Weight"
+
+# all the branches read by the dijet analyses
+DIJET_BRANCHES = list(JET_BRANCHES.values()) + [JET_SIZE_BRANCH, WEIGHT_BRANCH]
@@ -0,0 +1,256 @@
+"""
+
+Fused Numba kernel for the dijet analyses.
+
+The kernel makes a single pass over the jagged jet arrays of a chunk of
+events. For each event it applies the multiplicity cut, computes the
+leading-dijet kinematics, evaluates the cuts of an analysis spec and
+accumulates the weighted cutflow and the histograms of every signal region,
+without allocating intermediate arrays for each cut or variable.
+
+The analysis spec is translated into small numeric tables (see
+compile_spec) so the same kernel serves every dijet analysis built from the
+leading-dijet columns in KERNEL_VARIABLES.
+
+"""
+import numpy as np
+import awkward as ak
+import numba
+import boost_histogram as bh
+from modules.analysis_spec import AnalysisSpec, Threshold, Veto
+from modules.array_backend import get_branch, JET_BRANCHES
+
+# per-event variables computed by the kernel, the index in this
+# list is the index used in the requirement and histogram tables
+KERNEL_VARIABLES = [
+    "Jet0_pt", "Jet0_eta", "Jet0_phi", "Jet0_mass",
+    "Jet1_pt", "Jet1_eta", "Jet1_phi", "Jet1_mass",
+    "Jet0_rapidity", "Jet1_rapidity", "y_star", "mjj",
+]
+N_KERNEL_VARIABLES = len(KERNEL_VARIABLES)
+
+# codes for the requirement types in the requirement table
+REQUIREMENT_CODES = {">": 0, ">=": 1, "<": 2, "<=": 3, "veto": 4}
+
+def compile_spec(spec:AnalysisSpec):
+    """
+    Translate an analysis spec into the numeric tables used by the kernel.
+
+    Returns
+    -------
+    tuple(np.ndarray, np.ndarray, np.ndarray, np.ndarray)
+        Requirement table with one row (variable, code, low, high, absolute)
+        per requirement, offsets of the requirements of each step (the shared
+        cuts followed by the cut of each signal region), histogram table with
+        one row (variable, nbins, low, high) per histogram and offsets of each
+        histogram (including under/overflow bins) in the flattened output.
+    """
+    if len(spec.variables) > 0:
+        raise ValueError(f"analysis {spec.name} defines extra variables which are not supported by the fused kernel")
+
+    steps = [cut for cut in spec.cuts] + [sr.cut for sr in spec.signal_regions]
+    requirements = list()
+    requirement_offsets = [0]
+    for cut in steps:
+        for requirement in cut.requirements:
+            if isinstance(requirement, Threshold):
+                requirements.append([
+                    KERNEL_VARIABLES.index(requirement.variable),
+                    REQUIREMENT_CODES[requirement.op],
+                    requirement.value,
+                    requirement.value,
+                    requirement.absolute,
+                ])
+            elif isinstance(requirement, Veto):
+                requirements.append([
+                    KERNEL_VARIABLES.index(requirement.variable),
+                    REQUIREMENT_CODES["veto"],
+                    requirement.low,
+                    requirement.high,
+                    requirement.absolute,
+                ])
+            else:
+                raise ValueError(f"requirement {requirement} not supported by the fused kernel")
+        requirement_offsets.append(len(requirements))
+
+    hist_table = np.array([
+        [KERNEL_VARIABLES.index(hist.variable), hist.nbins, hist.low, hist.high]
+        for hist in spec.histograms
+    ], dtype=np.float64).reshape(-1, 4)
+    hist_offsets = np.concatenate([[0], np.cumsum([hist.nbins + 2 for hist in spec.histograms])]).astype(np.int64)
+
+    return (
+        np.array(requirements, dtype=np.float64).reshape(-1, 5),
+        np.array(requirement_offsets, dtype=np.int64),
+        hist_table,
+        hist_offsets,
+    )
+
+@numba.njit(cache=True)
+def _passes(requirements, start, stop, values):
+    for i_req in range(start, stop):
+        value = values[int(requirements[i_req, 0])]
+        if requirements[i_req, 4] > 0:
+            value = abs(value)
+        code = int(requirements[i_req, 1])
+        if code == 0:
+            passed = value > requirements[i_req, 2]
+        elif code == 1:
+            passed = value >= requirements[i_req, 2]
+        elif code == 2:
+            passed = value < requirements[i_req, 2]
+        elif code == 3:
+            passed = value <= requirements[i_req, 2]
+        else:
+            passed = not (value > requirements[i_req, 2] and value < requirements[i_req, 3])
+        if not passed:
+            return False
+    return True
+
+@numba.njit(cache=True)
+def dijet_kernel(
+    offsets, pt, eta, phi, mass, weights,
+    requirements, requirement_offsets, n_cuts, n_regions,
+    hist_table, hist_offsets,
+    cutflow, hist_sumw, hist_sumw2,
+):
+    """
+    Process a chunk of events, accumulating into cutflow (regions x steps)
+    and hist_sumw / hist_sumw2 (regions x flattened bins) in place.
+    """
+    values = np.empty(N_KERNEL_VARIABLES)
+    for i_event in range(len(weights)):
+        w = weights[i_event]
+        for i_sr in range(n_regions):
+            cutflow[i_sr, 0] += w
+
+        # multiplicity cut
+        first = offsets[i_event]
+        if offsets[i_event + 1] - first < 2:
+            continue
+        for i_sr in range(n_regions):
+            cutflow[i_sr, 1] += w
+
+        # leading dijet kinematics
+        px_sum = 0.0
+        py_sum = 0.0
+        pz_sum = 0.0
+        e_sum = 0.0
+        for i_jet in range(2):
+            jet_pt = pt[first + i_jet]
+            jet_eta = eta[first + i_jet]
+            jet_phi = phi[first + i_jet]
+            jet_mass = mass[first + i_jet]
+            pz = jet_pt * np.sinh(jet_eta)
+            energy = np.sqrt((jet_pt * np.cosh(jet_eta))**2 + jet_mass**2)
+            values[4*i_jet] = jet_pt
+            values[4*i_jet + 1] = jet_eta
+            values[4*i_jet + 2] = jet_phi
+            values[4*i_jet + 3] = jet_mass
+            values[8 + i_jet] = 0.5 * np.log((energy + pz) / (energy - pz))
+            px_sum += jet_pt * np.cos(jet_phi)
+            py_sum += jet_pt * np.sin(jet_phi)
+            pz_sum += pz
+            e_sum += energy
+        values[10] = 0.5 * abs(values[8] - values[9])
+        m2 = e_sum**2 - px_sum**2 - py_sum**2 - pz_sum**2
+        values[11] = np.sqrt(m2) if m2 >= 0 else -np.sqrt(-m2)
+
+        # cuts shared by all signal regions
+        passed = True
+        for i_cut in range(n_cuts):
+            if not _passes(requirements, requirement_offsets[i_cut], requirement_offsets[i_cut + 1], values):
+                passed = False
+                break
+            for i_sr in range(n_regions):
+                cutflow[i_sr, 2 + i_cut] += w
+        if not passed:
+            continue
+
+        # signal region cuts and histogram filling
+        for i_sr in range(n_regions):
+            i_step = n_cuts + i_sr
+            if not _passes(requirements, requirement_offsets[i_step], requirement_offsets[i_step + 1], values):
+                continue
+            cutflow[i_sr, 2 + n_cuts] += w
+            for i_hist in range(hist_table.shape[0]):
+                value = values[int(hist_table[i_hist, 0])]
+                if np.isnan(value):
+                    continue
+                nbins = int(hist_table[i_hist, 1])
+                low = hist_table[i_hist, 2]
+                high = hist_table[i_hist, 3]
+                if value < low:
+                    i_bin = 0
+                elif value >= high:
+                    i_bin = nbins + 1
+                else:
+                    i_bin = 1 + int((value - low) / (high - low) * nbins)
+                hist_sumw[i_sr, hist_offsets[i_hist] + i_bin] += w
+                hist_sumw2[i_sr, hist_offsets[i_hist] + i_bin] += w * w
+
+class FusedDijetAnalysis:
+    """
+    Accumulates the results of an analysis spec with the fused kernel,
+    exposing the same cutflows() and histograms() as ArrayAnalysis.
+    """
+
+    def __init__(self, spec:AnalysisSpec):
+        self.spec = spec
+        (
+            self.requirements,
+            self.requirement_offsets,
+            self.hist_table,
+            self.hist_offsets,
+        ) = compile_spec(spec)
+        n_regions = len(spec.signal_regions)
+        self.cutflow = np.zeros((n_regions, len(spec.cuts) + 3))
+        self.hist_sumw = np.zeros((n_regions, self.hist_offsets[-1]))
+        self.hist_sumw2 = np.zeros((n_regions, self.hist_offsets[-1]))
+
+    def process(self, offsets, pt, eta, phi, mass, weights):
+        dijet_kernel(
+            offsets, pt, eta, phi, mass, weights,
+            self.requirements, self.requirement_offsets,
+            len(self.spec.cuts), len(self.spec.signal_regions),
+            self.hist_table, self.hist_offsets,
+            self.cutflow, self.hist_sumw, self.hist_sumw2,
+        )
+
+    def process_chunk(self, arrays, weights):
+        """
+        Process a chunk of events read by modules.array_backend.iterate_chunks.
+        """
+        self.process(*jagged_jet_arrays(arrays), weights)
+
+    def cutflows(self):
+        cutflows = dict()
+        for i_sr, sr in enumerate(self.spec.signal_regions):
+            cut_names = self.spec.cut_names(sr.name)
+            cutflows[sr.name] = {cut: float(self.cutflow[i_sr, i_cut]) for i_cut, cut in enumerate(cut_names)}
+        return cutflows
+
+    def histograms(self):
+        hists = dict()
+        for i_sr, sr in enumerate(self.spec.signal_regions):
+            hists[sr.name] = dict()
+            for i_hist, hist in enumerate(self.spec.histograms):
+                h = bh.Histogram(bh.axis.Regular(hist.nbins, hist.low, hist.high), storage=bh.storage.Weight())
+                view = h.view(flow=True)
+                view["value"] = self.hist_sumw[i_sr, self.hist_offsets[i_hist]:self.hist_offsets[i_hist + 1]]
+                view["variance"] = self.hist_sumw2[i_sr, self.hist_offsets[i_hist]:self.hist_offsets[i_hist + 1]]
+                hists[sr.name][hist.name] = h
+        return hists
+
+def jagged_jet_arrays(arrays):
+    """
+    Return the jet offsets and flat jet kinematics of a chunk of events
+    as contiguous float64 NumPy arrays for the kernel.
+    """
+    pt = get_branch(arrays, JET_BRANCHES["pt"])
+    offsets = np.concatenate([[0], np.cumsum(ak.to_numpy(ak.num(pt, axis=1)))]).astype(np.int64)
+    flat = [
+        np.ascontiguousarray(ak.to_numpy(ak.flatten(get_branch(arrays, JET_BRANCHES[variable]))), dtype=np.float64)
+        for variable in ["pt", "eta", "phi", "mass"]
+    ]
+    return (offsets, *flat)
@@ -2,19 +2,37 @@
 
 Helper script for retrieving sum of weights metadata.
 
+The sum of weights and number of events of every file are booked together
+and the event loops of all the requested samples run concurrently with
+RunGraphs. The per-file results are cached by adler32 checksum, so files
+that were already processed are not read again, and the new entries are
+merged directly into the metadata file of each sample (see data/samples.py).
+
+Example:
+python modules/get_metadata.py -s all -j 8
+
 """
+import sys
+import glob
+import math
+import os
 import pathlib
 import json
+import tempfile
 import ROOT
 import argparse
 import re
 from bs4 import BeautifulSoup
 from data.samples import samples
+from modules.sample_catalogue import catalogue
+from modules.metadata import update_metadata_file
 from modules.logger_setup import logger
 
 # load Delphes library
 ROOT.gSystem.Load("libDelphes.so")
 
+DEFAULT_CACHE_PATH = pathlib.Path(__file__).resolve().parent.parent / "data" / "sum_of_weights_cache.json"
+
 def extract_unwgt(html):
     soup = BeautifulSoup(html, 'html.parser')
     unwgt_values = []
@@ -37,6 +55,206 @@ def extract_unwgt(html):
     unwgt_count = sum(unwgt_values)
     return unwgt_count
 
+def load_cache(cache_path)->dict:
+    if not pathlib.Path(cache_path).is_file():
+        return dict()
+    with open(cache_path, "r") as f:
+        return json.load(f)
+
+def save_cache(cache_path, cache:dict):
+    cache_path = pathlib.Path(cache_path)
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_path.parent, prefix=f".{cache_path.name}.")
+    with os.fdopen(fd, "w") as f:
+        json.dump(cache, f, indent=4, sort_keys=True)
+    os.replace(tmp_path, cache_path)
+
+def cache_key(record:dict):
+    """
+    Return the key of a file in the sum of weights cache, or None if its checksum is not known.
+    """
+    if record.get("checksum") is None:
+        return None
+    return f"{record['checksum']}:{record['size']}"
+
+def book_file(file_path:str, tree_name:str="Delphes")->dict:
+    """
+    Book the sum of weights and number of events of a file in a single event loop.
+    """
+    df = ROOT.RDataFrame(tree_name, file_path)
+    return {"sumW": df.Sum("Event.Weight"), "entries": df.Count()}
+
+def xsec_info_paths(sample:str)->list:
+    """
+    Return the cross-section info files of a sample: run/xsec_info_<sample>.txt
+    or, for samples generated in several parts (see --events-per-job in
+    utils/submit_jobs.py), run/xsec_info_<sample>_part<N>.txt sorted by part.
+    """
+    xsec_info_path = pathlib.Path(f"run/xsec_info_{sample.lower()}.txt")
+    if xsec_info_path.is_file():
+        return [xsec_info_path]
+    part_paths = glob.glob(f"run/xsec_info_{glob.escape(sample.lower())}_part*.txt")
+    part_index = lambda path: int(re.search(r"_part(\d+)\.txt$", path).group(1))
+    return [pathlib.Path(path) for path in sorted(part_paths, key=part_index)]
+
+def lhe_info_paths(sample:str)->list:
+    """
+    Return the files with the number of LHE events of the jobs generating
+    a sample from a gridpack, run/lhe_info_<sample>_part<N>.txt.
+    """
+    return sorted(glob.glob(f"run/lhe_info_{glob.escape(sample.lower())}_part*.txt"))
+
+def read_xsec_info(sample:str, num_events:int)->dict:
+    """
+    Return the cross-section metadata of a sample from its cross-section
+    info files (see xsec_info_paths), or None if there are none.
+
+    The cross-sections of several parts are combined: the MadGraph ones
+    with an inverse-variance weighted mean, the Pythia8 ones weighted by
+    the number of tried events. The filter efficiency and Pythia8 sum of
+    weights cover all the parts.
+
+    For samples generated from a gridpack the results.html is the one of
+    the gridpack build, whose unweighted events are not the generated
+    ones, so the filter efficiency uses the number of LHE events of the
+    generation jobs (see lhe_info_paths) instead. It is left out if the
+    number of unweighted events is not known.
+    """
+    paths = xsec_info_paths(sample)
+    if len(paths) == 0:
+        logger.warning("cross-section info file run/xsec_info_%s.txt not found, skipping xsec metadata for this sample", sample.lower())
+        return None
+    if len(paths) > 1:
+        logger.info("combining the cross-section info of %s parts of sample %s", len(paths), sample)
+    xsec_infos = list()
+    for path in paths:
+        with open(path, "r") as f:
+            xsec_infos.append(f.read().strip())
+
+    metadata = dict()
+    if not samples[sample].get("uses_pythia8", False):
+        xsecs, xsec_uncerts, unwgt_count = list(), list(), 0.0
+        for xsec_info in xsec_infos:
+            matches = re.findall(r"(?:&nbsp;){6}<b>s= (\d+\.\d+.*) &#177 (\d+\.\d+.*) \Wpb\W.{12}", xsec_info)
+            xsecs.append(float(matches[0][0]))
+            xsec_uncerts.append(float(matches[0][1]))
+            unwgt_count += extract_unwgt(xsec_info)
+        if all(uncert > 0 for uncert in xsec_uncerts):
+            inverse_variances = [1.0 / uncert**2 for uncert in xsec_uncerts]
+            xsec = sum(w * x for w, x in zip(inverse_variances, xsecs)) / sum(inverse_variances)
+            xsec_uncert = 1.0 / math.sqrt(sum(inverse_variances))
+        else:
+            xsec = sum(xsecs) / len(xsecs)
+            xsec_uncert = math.sqrt(sum(uncert**2 for uncert in xsec_uncerts)) / len(xsecs)
+        lhe_paths = lhe_info_paths(sample)
+        if len(lhe_paths) > 0:
+            unwgt_count = 0.0
+            for path in lhe_paths:
+                with open(path, "r") as f:
+                    unwgt_count += float(f.read().strip() or 0)
+            logger.info("using the %s LHE events of %s gridpack jobs for the filter efficiency of sample %s", unwgt_count, len(lhe_paths), sample)
+        # TODO get the filter efficiency here!
+        filter_eff = None
+        if unwgt_count > 0:
+            filter_eff = float(num_events) / unwgt_count
+        else:
+            logger.error("no unweighted events found for sample %s, not setting its filter efficiency", sample)
+    else:
+        # different handling for excited quark samples
+        # which are generated with pythia8
+        # sigma (mb) sigmaErr (mb) nTried nSelected nAccepted sumW
+        tmp_mds = [[float(val) for val in xsec_info.split("\n")[1].split(" ")] for xsec_info in xsec_infos]
+        n_tried = sum(tmp_md[2] for tmp_md in tmp_mds)
+        xsec = sum(tmp_md[0] * tmp_md[2] for tmp_md in tmp_mds) / n_tried * 1e9  # convert from mb to pb
+        xsec_uncert = math.sqrt(sum((tmp_md[1] * tmp_md[2])**2 for tmp_md in tmp_mds)) / n_tried * 1e9  # convert from mb to pb
+        filter_eff = sum(tmp_md[4] for tmp_md in tmp_mds) / n_tried
+        # override sumW with the one from pythia8
+        metadata["sumW"] = sum(tmp_md[-1] for tmp_md in tmp_mds)
+
+    metadata.update({
+        "xsec": xsec,
+        "xsec_uncert": xsec_uncert,
+    })
+    if filter_eff is not None:
+        metadata["filter_eff"] = filter_eff
+    return metadata
+
+def compute_metadata(samples_to_check:list, workers:int=8, cache_path=DEFAULT_CACHE_PATH)->dict:
+    """
+    Return the sum of weights and cross-section metadata of the given samples,
+    summed over all their files. Samples with missing files are skipped.
+    """
+    # check all the files exist before running any event loop, the checksums
+    # identify the files in the cache
+    validation = catalogue.validate(
+        [sample for sample in samples_to_check if sample in catalogue],
+        workers=workers,
+        checksum=True
+    )
+    cache = load_cache(cache_path)
+
+    # book one event loop per file not found in the cache, shared by all the samples using it
+    sample_files = dict()
+    booked = dict()
+    for sample in samples_to_check:
+        if sample not in samples:
+            logger.error("sample ID %s not found in samples dictionary in samples.py", sample)
+            continue
+        if not validation[sample]["valid"]:
+            logger.error("sample ID %s has missing files, skipping", sample)
+            continue
+
+        records = validation[sample]["files"]
+        sample_files[sample] = records
+        pending = [record["path"] for record in records if cache_key(record) not in cache and record["path"] not in booked]
+        if len(pending) == 0:
+            logger.info("using cached sum of weights for sample ID: %s", sample)
+            continue
+        # only stage the files that have to be read
+        local_files = dict(zip(catalogue.remote_files(sample), catalogue.files(sample)))
+        for path in pending:
+            booked[path] = book_file(local_files[path])
+        logger.info("booked sum of weights for %s files of sample ID: %s", len(pending), sample)
+
+    if len(booked) > 0:
+        logger.info("running the event loops of %s files", len(booked))
+        ROOT.RDF.RunGraphs([result for results in booked.values() for result in results.values()])
+
+    file_results = dict()
+    for records in sample_files.values():
+        for record in records:
+            key = cache_key(record)
+            if record["path"] in booked:
+                file_results[record["path"]] = {name: result.GetValue() for name, result in booked[record["path"]].items()}
+                if key is not None:
+                    cache[key] = file_results[record["path"]]
+            else:
+                file_results[record["path"]] = cache[key]
+    save_cache(cache_path, cache)
+
+    metadata = dict()
+    for sample, records in sample_files.items():
+        metadata[sample] = {"sumW": sum(file_results[record["path"]]["sumW"] for record in records)}
+        num_events = sum(file_results[record["path"]]["entries"] for record in records)
+
+        # retrieve cross-section metadata from
+        # run/xsec_info_<sample>.txt (or its parts)
+        xsec_metadata = read_xsec_info(sample, num_events)
+        if xsec_metadata is not None:
+            metadata[sample].update(xsec_metadata)
+
+    return metadata
+
+def write_metadata(metadata:dict):
+    """
+    Merge the metadata of each sample into its metadata file (see data/samples.py).
+    """
+    metadata_files = dict()
+    for sample, sample_metadata in metadata.items():
+        metadata_files.setdefault(samples[sample]["metadata"], dict())[sample] = sample_metadata
+    for metadata_path, entries in metadata_files.items():
+        update_metadata_file(metadata_path, entries)
+
 def main():
     parser = argparse.ArgumentParser(description="Get sum of weights metadata from Delphes output files.")
     parser.add_argument(
@@ -46,6 +264,32 @@ def main():
         required=True,
         help="List of sample IDs to retrieve metadata for."
     )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=8,
+        help="Number of threads used to validate the sample files."
+    )
+    parser.add_argument(
+        "-j",
+        "--threads",
+        type=int,
+        default=1,
+        help="Number of threads used by ROOT to run the event loops."
+    )
+    parser.add_argument(
+        "--cache",
+        type=pathlib.Path,
+        default=DEFAULT_CACHE_PATH,
+        help="Path of the per-file sum of weights cache."
+    )
+    parser.add_argument(
+        "--print-only",
+        action="store_true",
+        default=False,
+        help="Only print the metadata instead of merging it into the metadata files."
+    )
 
     args = parser.parse_args()
 
@@ -53,62 +297,20 @@ def main():
     if "all" in samples_to_check:
         samples_to_check = list(samples.keys())
 
-    df = None
-    file_path = str()
-    metadata = dict()
-    xsec_info = str()
-    xsec = float()
-    xsec_uncert = float()
-    tmp_md = list()
-    for sample in samples_to_check:
-        if sample not in samples:
-            logger.error("sample ID %s not found in samples dictionary in samples.py", sample)
-            continue
-        logger.info("processing sample ID: %s", sample)
-        
-        # load the sample rdf
-        file_path = samples[sample]['ntuple']
-        df = ROOT.RDataFrame("Delphes", file_path)
-        metadata[sample] = {"sumW": df.Sum("Event.Weight").GetValue()}
-        num_events = df.Count().GetValue()
-
-        # retrieve cross-section metadata from 
-        # run/xsec_info_<sample>.txt
-        if pathlib.Path(f"run/xsec_info_{sample.lower()}.txt").is_file():
-            with open(f"run/xsec_info_{sample.lower()}.txt", "r") as f:
-                xsec_info = f.read().strip()
-
-            if not samples[sample].get("uses_pythia8", False):
-                matches = re.findall(r"(?:&nbsp;){6}<b>s= (\d+\.\d+.*) &#177 (\d+\.\d+.*) \Wpb\W.{12}", xsec_info)
-                xsec = float(matches[0][0])
-                xsec_uncert = float(matches[0][1])
-                # TODO get the filter efficiency here!
-                filter_eff = float(num_events) / extract_unwgt(xsec_info)
-            else:
-                # different handling for excited quark samples
-                # which are generated with pythia8
-                tmp_md = [float(val) for val in xsec_info.split("\n")[1].split(" ")]
-                xsec = float(tmp_md[0]) * 1e9  # convert from mb to pb
-                xsec_uncert = tmp_md[1] * 1e9  # convert from mb to pb
-                filter_eff = tmp_md[4] / tmp_md[2]
-                # override sumW with the one from pythia8
-                metadata[sample]["sumW"] = tmp_md[-1]
-
-            metadata[sample].update({
-                "xsec": xsec,
-                "xsec_uncert": xsec_uncert,
-                "filter_eff": filter_eff
-            })
-        else:
-            logger.warning("cross-section info file run/xsec_info_%s.txt not found, skipping xsec metadata for this sample", sample)
+    if args.threads > 1:
+        ROOT.ROOT.EnableImplicitMT(args.threads)
+
+    metadata = compute_metadata(samples_to_check, workers=args.workers, cache_path=args.cache)
 
-    # print out the metadata so this can be copied into a 
-    # separate json file
     logger.info("sum of weights metadata:")
     print(json.dumps(metadata, indent=4))
-    logger.info("don't forget to copy this information into the appropriate metadata json file into the data directory!")
+    if args.print_only:
+        return 0
+
+    # merge the new entries into the metadata file of each sample
+    write_metadata(metadata)
 
-    return
+    return 0
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())
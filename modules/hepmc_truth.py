@@ -0,0 +1,448 @@
+"""
+
+Truth-level dijet acceptances from HepMC2 files, without running Delphes.
+
+The HepMC2 (IO_GenEvent) files written by Pythia are parsed incrementally,
+line by line and optionally gzip-compressed, so only one batch of events is
+held in memory at a time. For each batch the truth jets are clustered from
+the visible final-state particles with the anti-kt algorithm (a small Numba
+implementation of the nearest-neighbour clustering, enough for the few
+hundred particles of a signal event), or the two hardest outgoing partons of
+the hard process are used instead with --partons. The leading-dijet columns
+are filled in the same format as the array backend and the cut logic of the
+analysis specs is applied with ArrayAnalysis, so the acceptances can be
+compared directly to the detector-level ones.
+
+The outputs are written with the "truth" file prefix by default, to the
+results store and to JSON files like modules/array_backend.py. The
+cross-section is taken from the sample metadata if the sample is known,
+otherwise from the cross-section lines of the HepMC file.
+
+Example:
+python modules/hepmc_truth.py -i tag_1_pythia8_events.hepmc.gz -s excited_quark_mmed2000 -a run2_atlas_tla_dijet -o outputs
+
+"""
+import sys
+import argparse
+import gzip
+import importlib
+import json
+import pathlib
+import numpy as np
+import numba
+from data.samples import samples
+from modules.logger_setup import logger
+from modules.results_store import ResultsStore, DEFAULT_STORE_NAME, acceptance_file_name, cutflow_file_name
+from modules.analysis_spec import ArrayAnalysis, cutflow_acceptances
+from modules.metadata import metadata_store
+
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_JET_RADIUS = 0.4
+# the same as the minimum jet pT of the Delphes ATLAS card
+DEFAULT_JET_PT_MIN = 20.0
+# the calorimeter acceptance of the Delphes ATLAS card
+MAX_PARTICLE_ETA = 4.9
+
+# neutrinos are not visible in the calorimeters
+INVISIBLE_PDG_IDS = [12, 14, 16]
+# HepMC status of the stable final-state particles and, in the Pythia
+# convention, of the outgoing particles of the hardest process
+FINAL_STATE_STATUS = 1
+HARD_OUTGOING_STATUS = 23
+PARTON_PDG_IDS = [1, 2, 3, 4, 5, 21]
+
+def _open(path):
+    path = str(path)
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt")
+    return open(path, "r")
+
+def _new_batch()->dict:
+    return {"weights": [], "offsets": [0], "pdg": [], "status": [], "px": [], "py": [], "pz": [], "e": []}
+
+def _finish_batch(batch:dict)->dict:
+    arrays = {
+        "weights": np.asarray(batch["weights"], dtype=np.float64),
+        "offsets": np.asarray(batch["offsets"], dtype=np.int64),
+        "pdg": np.asarray(batch["pdg"], dtype=np.int64),
+        "status": np.asarray(batch["status"], dtype=np.int64),
+    }
+    for component in ["px", "py", "pz", "e"]:
+        arrays[component] = np.asarray(batch[component], dtype=np.float64)
+    return arrays
+
+def iterate_hepmc2(path, batch_size:int=DEFAULT_BATCH_SIZE, statuses:tuple=(FINAL_STATE_STATUS,), cross_section:dict=None):
+    """
+    Parse a HepMC2 (IO_GenEvent) file incrementally and yield batches of
+    events as flat arrays.
+
+    Only the particles with one of the given statuses are kept. Each batch
+    is a dictionary with the first weight of each event ("weights"), the
+    offsets of the particles of each event in the flat particle arrays
+    ("offsets", of length number of events + 1) and the particle arrays
+    "pdg", "status", "px", "py", "pz" and "e", with the momenta in GeV.
+
+    If a dictionary is given as cross_section, the last cross-section (in pb)
+    and its uncertainty read from the file are stored in it.
+    """
+    batch = _new_batch()
+    n_events = 0
+    # HepMC2 momenta are in GeV unless stated otherwise on a units line
+    momentum_scale = 1.0
+    in_event = False
+    with _open(path) as f:
+        for line in f:
+            tag = line[:1]
+            if tag == "P":
+                # P barcode pdg px py pz e m status ...
+                fields = line.split(None, 9)
+                if int(fields[8]) not in statuses:
+                    continue
+                batch["pdg"].append(int(fields[2]))
+                batch["status"].append(int(fields[8]))
+                batch["px"].append(float(fields[3]) * momentum_scale)
+                batch["py"].append(float(fields[4]) * momentum_scale)
+                batch["pz"].append(float(fields[5]) * momentum_scale)
+                batch["e"].append(float(fields[6]) * momentum_scale)
+            elif tag == "E":
+                if in_event:
+                    batch["offsets"].append(len(batch["pdg"]))
+                    n_events += 1
+                    if n_events == batch_size:
+                        yield _finish_batch(batch)
+                        batch = _new_batch()
+                        n_events = 0
+                # E number mpi scale alpha_qcd alpha_qed process_id process_vertex
+                #   n_vertices beam1 beam2 n_random [random...] n_weights [weights...]
+                fields = line.split()
+                n_random = int(fields[11])
+                n_weights = int(fields[12 + n_random])
+                batch["weights"].append(float(fields[13 + n_random]) if n_weights > 0 else 1.0)
+                in_event = True
+            elif tag == "U":
+                momentum_scale = 1e-3 if line.split()[1] == "MEV" else 1.0
+            elif tag == "C" and cross_section is not None:
+                fields = line.split()
+                cross_section["xsec"] = float(fields[1])
+                cross_section["xsec_err"] = float(fields[2])
+            elif line.startswith("HepMC::IO_GenEvent-END_EVENT_LISTING"):
+                break
+    if in_event:
+        batch["offsets"].append(len(batch["pdg"]))
+        n_events += 1
+    if n_events > 0:
+        yield _finish_batch(batch)
+
+@numba.njit(cache=True)
+def _delta_r2(rapidity, phi, i, j):
+    dphi = abs(phi[i] - phi[j])
+    if dphi > np.pi:
+        dphi = 2 * np.pi - dphi
+    drap = rapidity[i] - rapidity[j]
+    return drap * drap + dphi * dphi
+
+@numba.njit(cache=True)
+def _update_kinematics(px, py, pz, e, rapidity, phi, inv_pt2, i):
+    pt2 = px[i] * px[i] + py[i] * py[i]
+    inv_pt2[i] = 1.0 / pt2 if pt2 > 0 else 1e300
+    phi[i] = np.arctan2(py[i], px[i])
+    if e[i] > abs(pz[i]):
+        rapidity[i] = 0.5 * np.log((e[i] + pz[i]) / (e[i] - pz[i]))
+    else:
+        rapidity[i] = 1e5 if pz[i] >= 0 else -1e5
+
+@numba.njit(cache=True)
+def _nearest_neighbour(rapidity, phi, inv_pt2, active, i, R2):
+    # the geometric nearest neighbour of i and the anti-kt distance to it
+    nn = -1
+    best = R2
+    for j in range(len(active)):
+        if j == i or not active[j]:
+            continue
+        dr2 = _delta_r2(rapidity, phi, i, j)
+        if dr2 < best:
+            best = dr2
+            nn = j
+    if nn < 0:
+        return -1, 1e300
+    return nn, min(inv_pt2[i], inv_pt2[nn]) * best / R2
+
+@numba.njit(cache=True)
+def _cluster_event(px, py, pz, e, R, pt_min, leading):
+    """
+    Cluster one event with the anti-kt algorithm (E-scheme recombination)
+    and fill the pt, eta, phi and mass of the two leading jets above pt_min
+    into leading, returning the number of jets above pt_min.
+    """
+    n = len(px)
+    R2 = R * R
+    px = px.copy()
+    py = py.copy()
+    pz = pz.copy()
+    e = e.copy()
+    rapidity = np.empty(n)
+    phi = np.empty(n)
+    inv_pt2 = np.empty(n)
+    active = np.ones(n, dtype=np.bool_)
+    for i in range(n):
+        _update_kinematics(px, py, pz, e, rapidity, phi, inv_pt2, i)
+    nn = np.empty(n, dtype=np.int64)
+    nn_dist = np.empty(n)
+    for i in range(n):
+        nn[i], nn_dist[i] = _nearest_neighbour(rapidity, phi, inv_pt2, active, i, R2)
+
+    jet_pt = np.empty(n)
+    jet_index = np.empty(n, dtype=np.int64)
+    jet_p4 = np.empty((n, 4))
+    n_jets = 0
+    n_active = n
+    while n_active > 0:
+        # the smallest of the pairwise and beam distances, the pairwise
+        # minimum is always between a particle and its geometric neighbour
+        i_min = -1
+        d_min = 1e301
+        merge = False
+        for i in range(n):
+            if not active[i]:
+                continue
+            if nn_dist[i] < d_min:
+                d_min = nn_dist[i]
+                i_min = i
+                merge = True
+            if inv_pt2[i] < d_min:
+                d_min = inv_pt2[i]
+                i_min = i
+                merge = False
+
+        if merge:
+            j_min = nn[i_min]
+            px[i_min] += px[j_min]
+            py[i_min] += py[j_min]
+            pz[i_min] += pz[j_min]
+            e[i_min] += e[j_min]
+            active[j_min] = False
+            _update_kinematics(px, py, pz, e, rapidity, phi, inv_pt2, i_min)
+        else:
+            j_min = -1
+            active[i_min] = False
+            pt = np.sqrt(px[i_min] * px[i_min] + py[i_min] * py[i_min])
+            if pt > pt_min:
+                jet_pt[n_jets] = pt
+                jet_p4[n_jets, 0] = px[i_min]
+                jet_p4[n_jets, 1] = py[i_min]
+                jet_p4[n_jets, 2] = pz[i_min]
+                jet_p4[n_jets, 3] = e[i_min]
+                n_jets += 1
+        n_active -= 1
+
+        # update the neighbours of the merged particle and of the particles
+        # whose neighbour was removed or changed
+        for k in range(n):
+            if not active[k]:
+                continue
+            if k == i_min or nn[k] == i_min or nn[k] == j_min:
+                nn[k], nn_dist[k] = _nearest_neighbour(rapidity, phi, inv_pt2, active, k, R2)
+            elif merge:
+                dr2 = _delta_r2(rapidity, phi, k, i_min)
+                if dr2 < R2:
+                    dist = min(inv_pt2[k], inv_pt2[i_min]) * dr2 / R2
+                    if nn[k] < 0 or dr2 < _delta_r2(rapidity, phi, k, nn[k]):
+                        nn[k] = i_min
+                        nn_dist[k] = dist
+
+    jet_index[:n_jets] = np.argsort(-jet_pt[:n_jets])
+    for rank in range(min(n_jets, 2)):
+        _fill_jet(jet_p4[jet_index[rank]], leading[rank])
+    return n_jets
+
+@numba.njit(cache=True)
+def _fill_jet(p4, out):
+    px, py, pz, e = p4[0], p4[1], p4[2], p4[3]
+    pt = np.sqrt(px * px + py * py)
+    p = np.sqrt(pt * pt + pz * pz)
+    out[0] = pt
+    out[1] = np.arcsinh(pz / pt) if pt > 0 else (1e5 if pz >= 0 else -1e5)
+    out[2] = np.arctan2(py, px)
+    m2 = e * e - p * p
+    out[3] = np.sqrt(m2) if m2 > 0 else 0.0
+
+@numba.njit(cache=True)
+def _cluster_events(px, py, pz, e, offsets, R, pt_min, leading, n_jets):
+    for event in range(len(offsets) - 1):
+        start, stop = offsets[event], offsets[event + 1]
+        n_jets[event] = _cluster_event(px[start:stop], py[start:stop], pz[start:stop], e[start:stop], R, pt_min, leading[event])
+
+@numba.njit(cache=True)
+def _leading_partons(px, py, pz, e, offsets, leading, n_jets):
+    for event in range(len(offsets) - 1):
+        start, stop = offsets[event], offsets[event + 1]
+        pt = np.sqrt(px[start:stop] ** 2 + py[start:stop] ** 2)
+        order = np.argsort(-pt)
+        n_jets[event] = stop - start
+        for rank in range(min(stop - start, 2)):
+            index = start + order[rank]
+            _fill_jet(np.array([px[index], py[index], pz[index], e[index]]), leading[event, rank])
+
+def truth_dijet_arrays(batch:dict, partons:bool=False, jet_radius:float=DEFAULT_JET_RADIUS, jet_pt_min:float=DEFAULT_JET_PT_MIN)->dict:
+    """
+    Return the jet multiplicity and the kinematics of the two leading truth
+    jets of a batch of events in the format of leading_dijet_arrays in
+    modules/array_backend.py, with NaN for missing jets.
+
+    The truth jets are clustered from the visible final-state particles,
+    or are the outgoing partons of the hard process if partons is True.
+    """
+    n_events = len(batch["weights"])
+    pdg = np.abs(batch["pdg"])
+    if partons:
+        keep = (batch["status"] == HARD_OUTGOING_STATUS) & np.isin(pdg, PARTON_PDG_IDS)
+    else:
+        pt = np.hypot(batch["px"], batch["py"])
+        with np.errstate(divide="ignore", invalid="ignore"):
+            eta = np.arcsinh(batch["pz"] / pt)
+        keep = (batch["status"] == FINAL_STATE_STATUS) & ~np.isin(pdg, INVISIBLE_PDG_IDS) & (pt > 0) & (np.abs(eta) < MAX_PARTICLE_ETA)
+
+    # offsets of the kept particles of each event
+    kept = np.concatenate([[0], np.cumsum(keep)])
+    offsets = kept[batch["offsets"]]
+    px, py, pz, e = (np.ascontiguousarray(batch[component][keep]) for component in ["px", "py", "pz", "e"])
+
+    leading = np.full((n_events, 2, 4), np.nan)
+    n_jets = np.zeros(n_events, dtype=np.int64)
+    if partons:
+        _leading_partons(px, py, pz, e, offsets, leading, n_jets)
+    else:
+        _cluster_events(px, py, pz, e, offsets, jet_radius, jet_pt_min, leading, n_jets)
+
+    arrays = {"Jet_size": n_jets}
+    for i in range(2):
+        for k, variable in enumerate(["pt", "eta", "phi", "mass"]):
+            arrays[f"Jet{i}_{variable}"] = leading[:, i, k]
+    return arrays
+
+def run_files(paths:list, specs:dict, batch_size:int=DEFAULT_BATCH_SIZE, partons:bool=False, jet_radius:float=DEFAULT_JET_RADIUS, jet_pt_min:float=DEFAULT_JET_PT_MIN, max_events:int=None):
+    """
+    Run the given analysis specs over the events of HepMC2 files and
+    return the ArrayAnalysis of each analysis, the number of events read
+    and the cross-section read from the files (None if not given).
+    """
+    results = {name: ArrayAnalysis(spec) for name, spec in specs.items()}
+    statuses = (HARD_OUTGOING_STATUS,) if partons else (FINAL_STATE_STATUS,)
+    cross_section = dict()
+    n_events = 0
+    for path in paths:
+        logger.info("reading events from %s", path)
+        for batch in iterate_hepmc2(path, batch_size, statuses, cross_section):
+            if max_events is not None and n_events + len(batch["weights"]) > max_events:
+                keep = max_events - n_events
+                batch["weights"] = batch["weights"][:keep]
+                batch["offsets"] = batch["offsets"][:keep + 1]
+            arrays = truth_dijet_arrays(batch, partons, jet_radius, jet_pt_min)
+            for result in results.values():
+                # each analysis adds its own derived columns
+                result.process(dict(arrays), batch["weights"])
+            n_events += len(batch["weights"])
+            if max_events is not None and n_events >= max_events:
+                break
+        if max_events is not None and n_events >= max_events:
+            break
+    logger.info("processed %s truth-level events", n_events)
+    return results, n_events, cross_section.get("xsec")
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="Compute truth-level dijet acceptances from HepMC2 files, without Delphes",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("-i", "--input", type=str, nargs="+", required=True, help="HepMC2 files of one sample (optionally gzip-compressed)")
+    parser.add_argument("-s", "--sample", type=str, required=True, help="Name of the sample, used for the outputs and, if given in data/samples.py, for the cross-section")
+    parser.add_argument("-o", "--output-dir", type=pathlib.Path, required=True, help="Directory to save output files")
+    parser.add_argument(
+        "-a",
+        "--analyses",
+        type=str,
+        nargs="+",
+        help="List of analyses to run (corresponding to module names in analyses/)",
+        default=["run2_atlas_tla_dijet"]
+    )
+    parser.add_argument("--partons", action="store_true", default=False, help="Use the two hardest outgoing partons of the hard process instead of truth jets")
+    parser.add_argument("--jet-radius", type=float, default=DEFAULT_JET_RADIUS, help="Radius parameter of the anti-kt truth jets")
+    parser.add_argument("--jet-pt-min", type=float, default=DEFAULT_JET_PT_MIN, help="Minimum pT of the truth jets in GeV")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="Number of events parsed and analysed at once")
+    parser.add_argument("--max-events", type=int, default=None, help="Maximum number of events to process")
+    parser.add_argument(
+        "--results-store",
+        type=pathlib.Path,
+        default=None,
+        help="SQLite results store to add the acceptances and cutflows to (by default results.sqlite in the output directory)"
+    )
+    parser.add_argument(
+        "--legacy-json",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Whether to also write the acceptances and cutflows to one JSON file per analysis"
+    )
+    parser.add_argument(
+        "--file-prefix",
+        type=str,
+        default="truth",
+        help="Prefix to add to the output files to distinguish them from the detector-level results (if empty string, no prefix is added)"
+    )
+
+    return parser.parse_args()
+
+def main():
+    args = get_args()
+
+    if not args.output_dir.exists():
+        logger.error("output directory %s does not exist", args.output_dir)
+        return 1
+
+    specs = dict()
+    for analysis_name in args.analyses:
+        analysis_module = importlib.import_module(f"analyses.{analysis_name}")
+        if not hasattr(analysis_module, "SPEC"):
+            logger.error("analysis module %s does not define a SPEC, cannot run it at truth level", analysis_name)
+            return 1
+        specs[analysis_name] = analysis_module.SPEC
+
+    results, n_events, file_xsec = run_files(
+        args.input, specs, args.batch_size, args.partons, args.jet_radius, args.jet_pt_min, args.max_events
+    )
+    if n_events == 0:
+        logger.error("no events found in %s", ", ".join(args.input))
+        return 1
+
+    # the metadata cross-section includes the BR and filter efficiency, the
+    # one from the HepMC file is the generator cross-section
+    if args.sample in samples and metadata_store.is_valid(args.sample, samples[args.sample]["metadata"]):
+        xsec_factor = metadata_store.xsec_factor(args.sample)
+    elif file_xsec is not None:
+        logger.warning("no valid metadata for sample %s, using the cross-section of %s pb from the HepMC file", args.sample, file_xsec)
+        xsec_factor = file_xsec
+    else:
+        logger.warning("no cross-section for sample %s, the expected cross-sections are the acceptances", args.sample)
+        xsec_factor = 1.0
+
+    results_store = ResultsStore(args.results_store or args.output_dir / DEFAULT_STORE_NAME)
+    for analysis_name, result in results.items():
+        sr_cutflows = result.cutflows()
+        sr_acceptances = cutflow_acceptances(sr_cutflows, xsec_factor, result.statistics())
+        results_store.add_cutflows(args.sample, analysis_name, sr_cutflows, prefix=args.file_prefix)
+        results_store.add_acceptances(args.sample, analysis_name, sr_acceptances, prefix=args.file_prefix)
+        for sr, acceptance in sr_acceptances.items():
+            logger.info("%s %s: truth-level acceptance %.4g", analysis_name, sr, acceptance["acceptance"])
+        if not args.legacy_json:
+            continue
+        for file_name, content in [
+            (cutflow_file_name(args.sample, analysis_name, args.file_prefix), sr_cutflows),
+            (acceptance_file_name(args.sample, analysis_name, prefix=args.file_prefix), sr_acceptances),
+        ]:
+            logger.info("saving %s in output directory", file_name)
+            with open(args.output_dir / file_name, "w") as f:
+                json.dump(content, f, indent=4)
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
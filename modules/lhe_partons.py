@@ -0,0 +1,277 @@
+"""
+
+Parton-level dijet acceptances from MadGraph LHE files.
+
+The (optionally gzip-compressed) unweighted_events.lhe.gz files written by
+MadGraph before the shower are streamed line by line. The particle lines of
+a fixed number of events are decoded at once into NumPy arrays, the two
+leading outgoing quarks or gluons of each event are taken as the leading
+dijet and the cut logic of the analysis specs is applied with ArrayAnalysis
+in the same format as the array backend.
+
+The resulting parton-level acceptances of all the given files are written to
+a table (CSV) sorted by mass, and to the results store with the "parton"
+file prefix. They are a quick estimate to decide which mass points of a
+scan are worth the full Pythia and Delphes generation, and are not a
+substitute for the detector-level acceptances.
+
+Example:
+python modules/lhe_partons.py -i run_mmed*/Events/run_01/unweighted_events.lhe.gz -n DMsimp_mmed350 DMsimp_mmed400 -a run2_atlas_tla_dijet -o outputs
+
+"""
+import sys
+import argparse
+import gzip
+import importlib
+import pathlib
+import numpy as np
+import pandas as pd
+from data.samples import samples
+from modules.logger_setup import logger
+from modules.results_store import ResultsStore, DEFAULT_STORE_NAME
+from modules.analysis_spec import ArrayAnalysis, cutflow_acceptances
+
+DEFAULT_BATCH_SIZE = 10000
+DEFAULT_TABLE_NAME = "parton_acceptances.csv"
+
+# columns of an LHE particle line
+# IDUP ISTUP MOTHUP1 MOTHUP2 ICOLUP1 ICOLUP2 PX PY PZ E M VTIMUP SPINUP
+N_PARTICLE_COLUMNS = 13
+PDG_COLUMN, STATUS_COLUMN = 0, 1
+PX_COLUMN, PY_COLUMN, PZ_COLUMN, E_COLUMN, MASS_COLUMN = 6, 7, 8, 9, 10
+
+# LHE status of the outgoing particles
+OUTGOING_STATUS = 1
+PARTON_PDG_IDS = [1, 2, 3, 4, 5, 21]
+
+def _open(path):
+    path = str(path)
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt")
+    return open(path, "r")
+
+def _decode_batch(particle_lines:list, counts:list, weights:list)->dict:
+    """
+    Decode the particle lines of a batch of events into a 2D array with
+    one row per particle.
+    """
+    values = np.array(" ".join(particle_lines).split(), dtype=np.float64)
+    if len(values) != len(particle_lines) * N_PARTICLE_COLUMNS:
+        # some lines have extra (or missing optional) columns
+        values = np.array([line.split()[:N_PARTICLE_COLUMNS] for line in particle_lines], dtype=np.float64)
+    return {
+        "weights": np.asarray(weights, dtype=np.float64),
+        "counts": np.asarray(counts, dtype=np.int64),
+        "particles": values.reshape(-1, N_PARTICLE_COLUMNS),
+    }
+
+def iterate_lhe(path, batch_size:int=DEFAULT_BATCH_SIZE, init:dict=None):
+    """
+    Stream the events of an LHE file and yield them in batches.
+
+    Each batch is a dictionary with the event weights ("weights"), the
+    number of particles of each event ("counts") and the particle lines of
+    all the events as a 2D array ("particles", see the *_COLUMN indices).
+
+    If a dictionary is given as init, the total cross-section (in pb) and
+    its uncertainty summed over the processes of the init block are stored
+    in it.
+    """
+    particle_lines, counts, weights = list(), list(), list()
+    in_init = False
+    in_event = False
+    remaining = 0
+    with _open(path) as f:
+        for line in f:
+            stripped = line.lstrip()
+            if in_event:
+                if remaining < 0:
+                    # NUP IDPRUP XWGTUP SCALUP AQEDUP AQCDUP
+                    fields = line.split()
+                    remaining = int(fields[0])
+                    counts.append(remaining)
+                    weights.append(float(fields[2]))
+                elif remaining > 0:
+                    particle_lines.append(line)
+                    remaining -= 1
+                elif stripped.startswith("</event"):
+                    in_event = False
+                    if len(counts) == batch_size:
+                        yield _decode_batch(particle_lines, counts, weights)
+                        particle_lines, counts, weights = list(), list(), list()
+                # any other lines of the event (e.g. reweighting info) are skipped
+            elif stripped.startswith("<event"):
+                in_event = True
+                remaining = -1
+            elif stripped.startswith("<init"):
+                in_init = True
+                n_init_lines = 0
+            elif in_init:
+                if stripped.startswith("</init") or stripped.startswith("<"):
+                    in_init = False
+                    continue
+                n_init_lines += 1
+                # the first line describes the beams, then one line per process
+                # with XSECUP XERRUP XMAXUP LPRUP
+                if n_init_lines > 1 and init is not None:
+                    fields = line.split()
+                    init["xsec"] = init.get("xsec", 0.0) + float(fields[0])
+                    init["xsec_err"] = np.hypot(init.get("xsec_err", 0.0), float(fields[1]))
+    if len(counts) > 0:
+        yield _decode_batch(particle_lines, counts, weights)
+
+def parton_dijet_arrays(batch:dict)->dict:
+    """
+    Return the number of outgoing partons and the kinematics of the two
+    leading ones of a batch of events in the format of leading_dijet_arrays
+    in modules/array_backend.py, with NaN for missing partons.
+    """
+    particles = batch["particles"]
+    n_events = len(batch["counts"])
+    event = np.repeat(np.arange(n_events), batch["counts"])
+
+    selected = (particles[:, STATUS_COLUMN] == OUTGOING_STATUS) & np.isin(np.abs(particles[:, PDG_COLUMN]), PARTON_PDG_IDS)
+    event = event[selected]
+    px, py, pz = particles[selected, PX_COLUMN], particles[selected, PY_COLUMN], particles[selected, PZ_COLUMN]
+    kinematics = {
+        "pt": np.hypot(px, py),
+        "phi": np.arctan2(py, px),
+        "mass": particles[selected, MASS_COLUMN],
+    }
+    with np.errstate(divide="ignore", invalid="ignore"):
+        kinematics["eta"] = np.arcsinh(pz / kinematics["pt"])
+
+    # order the partons by decreasing pT within each event and rank them
+    n_partons = np.bincount(event, minlength=n_events)
+    order = np.lexsort((-kinematics["pt"], event))
+    first = np.cumsum(n_partons) - n_partons
+    rank = np.arange(len(order)) - first[event[order]]
+
+    arrays = {"Jet_size": n_partons}
+    for i in range(2):
+        index = order[rank == i]
+        for variable in ["pt", "eta", "phi", "mass"]:
+            column = np.full(n_events, np.nan)
+            column[event[index]] = kinematics[variable][index]
+            arrays[f"Jet{i}_{variable}"] = column
+    return arrays
+
+def run_file(path, specs:dict, batch_size:int=DEFAULT_BATCH_SIZE):
+    """
+    Run the given analysis specs over the events of an LHE file and return
+    the ArrayAnalysis of each analysis, the number of events read and the
+    cross-section of the init block (None if not given).
+    """
+    results = {name: ArrayAnalysis(spec) for name, spec in specs.items()}
+    init = dict()
+    n_events = 0
+    for batch in iterate_lhe(path, batch_size, init):
+        arrays = parton_dijet_arrays(batch)
+        for result in results.values():
+            # each analysis adds its own derived columns
+            result.process(dict(arrays), batch["weights"])
+        n_events += len(batch["weights"])
+    logger.info("processed %s parton-level events from %s", n_events, path)
+    return results, n_events, init.get("xsec")
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="Compute parton-level dijet acceptances from MadGraph LHE files",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("-i", "--input", type=str, nargs="+", required=True, help="LHE files (optionally gzip-compressed), one per sample")
+    parser.add_argument(
+        "-n",
+        "--names",
+        type=str,
+        nargs="+",
+        default=None,
+        help="Sample names of the input files, in the same order (by default the file names), the mass of samples in data/samples.py is added to the table"
+    )
+    parser.add_argument("-o", "--output-dir", type=pathlib.Path, required=True, help="Directory to save output files")
+    parser.add_argument(
+        "-a",
+        "--analyses",
+        type=str,
+        nargs="+",
+        help="List of analyses to run (corresponding to module names in analyses/)",
+        default=["run2_atlas_tla_dijet"]
+    )
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="Number of events decoded and analysed at once")
+    parser.add_argument("--table", type=str, default=DEFAULT_TABLE_NAME, help="Name of the acceptance table written to the output directory")
+    parser.add_argument(
+        "--results-store",
+        type=pathlib.Path,
+        default=None,
+        help="SQLite results store to add the acceptances and cutflows to (by default results.sqlite in the output directory)"
+    )
+    parser.add_argument(
+        "--file-prefix",
+        type=str,
+        default="parton",
+        help="Prefix of the results in the results store, to distinguish them from the detector-level results"
+    )
+
+    return parser.parse_args()
+
+def main():
+    args = get_args()
+
+    if not args.output_dir.exists():
+        logger.error("output directory %s does not exist", args.output_dir)
+        return 1
+    if args.names is not None and len(args.names) != len(args.input):
+        logger.error("got %s sample names for %s input files", len(args.names), len(args.input))
+        return 1
+    names = args.names or [pathlib.Path(path).name.split(".lhe")[0] for path in args.input]
+
+    specs = dict()
+    for analysis_name in args.analyses:
+        analysis_module = importlib.import_module(f"analyses.{analysis_name}")
+        if not hasattr(analysis_module, "SPEC"):
+            logger.error("analysis module %s does not define a SPEC, cannot run it at parton level", analysis_name)
+            return 1
+        specs[analysis_name] = analysis_module.SPEC
+
+    results_store = ResultsStore(args.results_store or args.output_dir / DEFAULT_STORE_NAME)
+    rows = list()
+    for sample_name, path in zip(names, args.input):
+        results, n_events, xsec = run_file(path, specs, args.batch_size)
+        if n_events == 0:
+            logger.error("no events found in %s, skipping", path)
+            continue
+        if xsec is None:
+            logger.warning("no cross-section in the init block of %s, the expected cross-sections are the acceptances", path)
+
+        for analysis_name, result in results.items():
+            sr_cutflows = result.cutflows()
+            sr_acceptances = cutflow_acceptances(sr_cutflows, xsec if xsec is not None else 1.0, result.statistics())
+            results_store.add_cutflows(sample_name, analysis_name, sr_cutflows, prefix=args.file_prefix)
+            results_store.add_acceptances(sample_name, analysis_name, sr_acceptances, prefix=args.file_prefix)
+            for sr, acceptance in sr_acceptances.items():
+                rows.append({
+                    "sample": sample_name,
+                    "mass": samples.get(sample_name, dict()).get("mass"),
+                    "analysis": analysis_name,
+                    "signal_region": sr,
+                    "events": n_events,
+                    "xsec_pb": xsec,
+                    "acceptance": acceptance["acceptance"],
+                    "acceptance_stat_uncertainty": acceptance["acceptance_stat_uncertainty"],
+                    "expected_xsec_pb": acceptance["expected_xsec_pb"],
+                })
+
+    if len(rows) == 0:
+        logger.error("no acceptances computed")
+        return 1
+
+    table = pd.DataFrame(rows).sort_values(["analysis", "signal_region", "mass", "sample"], ignore_index=True)
+    logger.info("parton-level acceptances:\n%s", table.to_string(index=False))
+    table_path = args.output_dir / args.table
+    table.to_csv(table_path, index=False)
+    logger.info("saved parton-level acceptance table to %s", table_path)
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,152 @@
+"""
+
+Merge the parts of mass points generated in several jobs.
+
+With --events-per-job (utils/submit_jobs.py and utils/submit_pythia.py) or
+in the gridpack generate stage, the events of a mass point are split over
+several jobs whose seeds are recorded in the seed ledger (see
+modules/seed_ledger.py). For every mass point of a job ID in the ledger,
+this script checks that:
+
+- the output files of all the parts exist in the output directory
+- the cross-section info files of all the parts (and, for gridpack jobs,
+  the number of LHE events) were returned to run/ (the script is run from
+  the top directory, like get_metadata.py)
+- the ntuple of the sample in data/samples.py covers the files of all the
+  parts (a glob pattern such as generated_events_<job id>_mmed<mass>_part*)
+
+The sum of weights and cross-section metadata of the complete samples are
+then computed over all the parts (see modules/get_metadata.py) and merged
+into their metadata files. Incomplete mass points are reported with the
+parts and seeds to resubmit, and samples.py entries covering all the parts
+are printed for the samples that need them.
+
+Example:
+python modules/merge_job_parts.py -j dmsimp -l run/seed_ledger.json
+
+"""
+import sys
+import argparse
+import glob
+import json
+import os
+import pathlib
+import pprint
+from data.samples import samples
+from modules.logger_setup import logger
+from modules.sample_catalogue import catalogue
+from modules.seed_ledger import SeedLedger, DEFAULT_LEDGER_NAME
+from modules.get_metadata import compute_metadata, write_metadata, DEFAULT_CACHE_PATH
+
+# directory the cross-section info files are returned to (see read_xsec_info)
+RUN_DIR = pathlib.Path("run")
+
+def find_sample(job_id:str, mass)->str:
+    """
+    Return the ID of the sample in data/samples.py of a mass point of a job
+    ID (named <job id>_mmed<mass> up to the case), or None if not listed.
+    """
+    name = f"{job_id}_mmed{mass}".lower()
+    return next((sample for sample in samples if sample.lower() == name), None)
+
+def part_files(entry:dict)->list:
+    """
+    Return the output files of a part found in its output directory.
+    """
+    return sorted(glob.glob(os.path.join(glob.escape(entry["output_dir"]), entry["output"])))
+
+def check_mass_point(job_id:str, mass, parts:list)->tuple:
+    """
+    Check the parts of a mass point and return the sample ID (None if it
+    is not in data/samples.py), the output files of all the parts and the
+    list of problems (empty if the mass point is complete).
+    """
+    problems = list()
+    files = list()
+    for entry in parts:
+        found = part_files(entry)
+        if len(found) == 0:
+            problems.append(f"part {entry['part']} (seed {entry['seed']}): no output file {entry['output']} in {entry['output_dir']}")
+        if not (RUN_DIR / entry["xsec_info"]).is_file():
+            problems.append(f"part {entry['part']} (seed {entry['seed']}): no cross-section info file {RUN_DIR / entry['xsec_info']}")
+        if "lhe_info" in entry and not (RUN_DIR / entry["lhe_info"]).is_file():
+            # needed for the filter efficiency of gridpack samples
+            problems.append(f"part {entry['part']} (seed {entry['seed']}): no LHE event count file {RUN_DIR / entry['lhe_info']}")
+        files += found
+
+    sample = find_sample(job_id, mass)
+    if sample is None:
+        problems.append(f"no sample {job_id}_mmed{mass} in data/samples.py")
+        return sample, files, problems
+
+    # the metadata is computed for the files of the sample in samples.py
+    sample_files = set(catalogue.remote_files(sample))
+    not_covered = [path for path in files if path not in sample_files]
+    if len(not_covered) > 0:
+        problems.append(f"the ntuple of sample {sample} does not include {len(not_covered)} of the {len(files)} part files")
+    return sample, files, problems
+
+def samples_entry(job_id:str, mass, parts:list, sample:str=None)->dict:
+    """
+    Return a data/samples.py entry whose ntuple pattern covers all the parts
+    of a mass point.
+    """
+    sample = sample or f"{job_id}_mmed{mass}"
+    pattern = os.path.join(parts[0]["output_dir"], f"generated_events_{job_id}_mmed{mass}_part*.root")
+    entry = dict(samples.get(sample, dict()))
+    entry["ntuple"] = pattern
+    entry.setdefault("mass", mass)
+    return {sample: entry}
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="Check the parts of split event generation jobs and merge their metadata",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("-j", "--job-id", type=str, required=True, help="Job ID of the submission")
+    parser.add_argument("-m", "--mass-points", type=int, nargs="+", default=None, help="Mass points to merge (by default all the ones in the ledger)")
+    parser.add_argument("-l", "--ledger", type=pathlib.Path, default=pathlib.Path("run") / DEFAULT_LEDGER_NAME, help="Path of the seed ledger")
+    parser.add_argument("-w", "--workers", type=int, default=8, help="Number of threads used to validate the sample files")
+    parser.add_argument("--cache", type=pathlib.Path, default=DEFAULT_CACHE_PATH, help="Path of the per-file sum of weights cache")
+    parser.add_argument("--print-only", action="store_true", default=False, help="Only print the merged metadata instead of merging it into the metadata files")
+
+    return parser.parse_args()
+
+def main():
+    args = get_args()
+
+    ledger = SeedLedger(args.ledger)
+    mass_points = dict()
+    for entry in ledger.parts(args.job_id):
+        if args.mass_points is None or entry["mass"] in args.mass_points:
+            mass_points.setdefault(entry["mass"], list()).append(entry)
+    if len(mass_points) == 0:
+        logger.error("no parts of job ID %s found in %s", args.job_id, args.ledger)
+        return 1
+
+    complete = list()
+    entries = dict()
+    for mass, parts in mass_points.items():
+        sample, files, problems = check_mass_point(args.job_id, mass, parts)
+        if len(problems) > 0:
+            logger.error("mass point %s of job ID %s is not complete:\n%s", mass, args.job_id, "\n".join(problems))
+            if sample is None or any("ntuple" in problem for problem in problems):
+                entries.update(samples_entry(args.job_id, mass, parts, sample))
+            continue
+        logger.info("mass point %s of job ID %s: %s parts with %s files, %s events", mass, args.job_id, len(parts), len(files), sum(entry["nevents"] for entry in parts))
+        complete.append(sample)
+
+    if len(entries) > 0:
+        logger.info("data/samples.py entries covering all the parts:\n%s", pprint.pformat(entries, sort_dicts=False))
+
+    if len(complete) > 0:
+        metadata = compute_metadata(complete, workers=args.workers, cache_path=args.cache)
+        logger.info("merged metadata:")
+        print(json.dumps(metadata, indent=4))
+        if not args.print_only:
+            write_metadata(metadata)
+
+    return 0 if len(complete) == len(mass_points) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,199 @@
+"""
+
+Helpers for reading the sample metadata JSON files stored in data/.
+
+These do not depend on ROOT so they can be shared between the
+RDataFrame and array (uproot) backends.
+
+Each metadata file is parsed once per process by the shared MetadataStore
+(many samples point at the same file) and its entries are validated when
+it is loaded. The file is only parsed again if it changes on disk.
+
+"""
+import json
+import os
+import tempfile
+import threading
+from data.samples import samples
+from modules.logger_setup import logger
+from modules.staging_cache import file_lock
+
+REQUIRED_KEYS = ["xsec", "sumW"]
+OPTIONAL_KEYS = ["br", "filter_eff"]
+
+def validate_sample_metadata(sample_id:str, metadata)->list:
+    """
+    Return the list of problems with the metadata of a sample (empty if valid).
+    """
+    if not isinstance(metadata, dict):
+        return [f"metadata for sample {sample_id} is not a dictionary"]
+    problems = list()
+    for key in REQUIRED_KEYS + OPTIONAL_KEYS:
+        if key not in metadata:
+            if key in REQUIRED_KEYS:
+                problems.append(f"missing required key {key}")
+            continue
+        if not isinstance(metadata[key], (int, float)) or isinstance(metadata[key], bool):
+            problems.append(f"key {key} should be a number, got {metadata[key]!r}")
+    if isinstance(metadata.get("sumW"), (int, float)) and metadata["sumW"] == 0:
+        problems.append("sumW is zero")
+    return problems
+
+class MetadataStore:
+    """
+    Memoised access to the metadata files, keyed by the absolute file path.
+    """
+
+    def __init__(self):
+        self._files = dict()
+        self._problems = dict()
+        self._factors = dict()
+        self._lock = threading.Lock()
+
+    def _load(self, metadata_path:str)->dict:
+        path = os.path.abspath(metadata_path)
+        mtime = os.stat(path).st_mtime
+        with self._lock:
+            if path in self._files and self._files[path][0] == mtime:
+                return self._files[path][1]
+
+            with open(path, "r") as f:
+                contents = json.load(f)
+            logger.debug("loaded metadata file %s", path)
+
+            # validate all the sample entries of the file up front and
+            # precompute the normalisation factors of the valid ones
+            problems, factors = dict(), dict()
+            for sample_id, metadata in contents.items():
+                if sample_id == "description":
+                    continue
+                sample_problems = validate_sample_metadata(sample_id, metadata)
+                if len(sample_problems) > 0:
+                    problems[sample_id] = sample_problems
+                    logger.warning("invalid metadata for sample %s in %s: %s", sample_id, path, "; ".join(sample_problems))
+                elif sample_id in samples:
+                    factors[sample_id] = (get_xsec_factor(sample_id, metadata), get_weight_factor(sample_id, metadata))
+
+            self._files[path] = (mtime, contents)
+            self._problems[path] = problems
+            self._factors[path] = factors
+            return contents
+
+    def invalidate(self, metadata_path:str=None):
+        """
+        Forget a loaded metadata file (or all of them), e.g. after writing to it.
+        """
+        with self._lock:
+            paths = list(self._files) if metadata_path is None else [os.path.abspath(metadata_path)]
+            for path in paths:
+                self._files.pop(path, None)
+                self._problems.pop(path, None)
+                self._factors.pop(path, None)
+
+    def get(self, sample_id:str, metadata_path:str)->dict:
+        """
+        Return the validated metadata of a sample.
+        """
+        contents = self._load(metadata_path)
+        if sample_id not in contents:
+            raise KeyError(f"sample {sample_id} not found in metadata file {metadata_path}")
+        problems = self._problems[os.path.abspath(metadata_path)].get(sample_id)
+        if problems:
+            raise ValueError(f"invalid metadata for sample {sample_id} in {metadata_path}: {'; '.join(problems)}")
+        return contents[sample_id]
+
+    def raw(self, sample_id:str, metadata_path:str)->dict:
+        """
+        Return the metadata of a sample as stored in the file without validating it,
+        or an empty dictionary if the file or the sample entry does not exist yet.
+        """
+        if not os.path.isfile(metadata_path):
+            return dict()
+        return dict(self._load(metadata_path).get(sample_id, dict()))
+
+    def is_valid(self, sample_id:str, metadata_path:str)->bool:
+        try:
+            self.get(sample_id, metadata_path)
+        except (KeyError, ValueError, OSError) as error:
+            logger.error("%s", error)
+            return False
+        return True
+
+    def _sample_factors(self, sample_id:str, metadata_path:str=None)->tuple:
+        metadata_path = metadata_path or samples[sample_id]["metadata"]
+        self.get(sample_id, metadata_path)
+        return self._factors[os.path.abspath(metadata_path)][sample_id]
+
+    def xsec_factor(self, sample_id:str, metadata_path:str=None)->float:
+        """
+        Return the precomputed cross-section factor of a sample (see get_xsec_factor).
+        """
+        return self._sample_factors(sample_id, metadata_path)[0]
+
+    def weight_factor(self, sample_id:str, metadata_path:str=None)->float:
+        """
+        Return the precomputed event weight normalisation of a sample (see get_weight_factor).
+        """
+        return self._sample_factors(sample_id, metadata_path)[1]
+
+# store shared by all the loaders and processing loops in a process
+metadata_store = MetadataStore()
+
+def load_sample_metadata(sample_id:str, metadata_path:str)->dict:
+    """
+    Return the metadata dictionary for a single sample.
+    """
+    return metadata_store.get(sample_id, metadata_path)
+
+def update_metadata_file(metadata_path:str, entries:dict):
+    """
+    Merge the given sample entries into a metadata file.
+
+    The file is updated under a lock and written atomically, so concurrent
+    jobs updating the same file never lose entries or read a partial file.
+    Existing fields of a sample that are not in the new entry (e.g. br) are kept.
+    """
+    path = os.path.abspath(metadata_path)
+    with file_lock(f"{path}.lock"):
+        contents = dict()
+        if os.path.isfile(path):
+            with open(path, "r") as f:
+                contents = json.load(f)
+        for sample_id, entry in entries.items():
+            contents.setdefault(sample_id, dict()).update(entry)
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=f".{os.path.basename(path)}.")
+        with os.fdopen(fd, "w") as f:
+            json.dump(contents, f, indent=4)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    logger.info("updated %s samples in metadata file %s", len(entries), path)
+    metadata_store.invalidate(path)
+
+def get_xsec_factor(sample_id:str, metadata:dict)->float:
+    """
+    Return the cross-section (in pb) including the branching ratio and,
+    where needed, the filter efficiency, i.e. the factor multiplying the
+    acceptance to obtain the expected signal cross-section.
+    """
+    # include the BR where this is defined in the metadata file, otherwise assume it is 1
+    # (i.e. the cross-section already includes the BR)
+    xsec_factor = metadata['xsec'] * metadata.get('br', 1.0)
+    # Pythia8 accounts for the "filter efficiency" but not the branching ratio internally
+    # in the cross-section calculations
+    # i.e.
+    # double Info::sigmaGen(int i = 0)
+    # double Info::sigmaErr(int i = 0)
+    # the estimated cross section and its estimated error, summed over all allowed
+    # processes (i = 0) or for the given process, in units of mb. The numbers refer
+    # to the accepted event sample above, i.e. after any user veto.
+    if not samples[sample_id].get("uses_pythia8", False):
+        xsec_factor *= metadata.get('filter_eff', 1.0)
+    return xsec_factor
+
+def get_weight_factor(sample_id:str, metadata:dict)->float:
+    """
+    Return the factor used to normalise the Delphes Event.Weight
+    to the sample cross-section.
+    """
+    return get_xsec_factor(sample_id, metadata) / metadata['sumW']
@@ -4,13 +4,26 @@ This module runs analyses for a given set of samples.
 
 The outputs consist of:
 - Histograms saved in ROOT files
-- JSON dictionaries with cutflow information specific to each analysis
+- JSON dictionaries with cutflow information specific to each analysis,
+  and with the sum of weights, sum of squared weights, raw event counts
+  and N-1 yields for each cutflow step
 - JSON dictionaries storing the acceptance of the selection for each sample
 - JSON dictionaries storing the expected signal cross-section accounting
   for the acceptance
+- the acceptances and cutflows added to a SQLite results store shared by
+  all samples (see modules/results_store.py)
+
+With --systematics, the jet energy scale and resolution variations are
+registered with RDF Vary in the dijet preselection and evaluated in the
+same event loop as the nominal selection. The acceptances for each
+variation are stored in a "systematics" block of the acceptance JSON.
+
+With --weight-vector-branch, all the weights stored per event (e.g. the
+MadGraph scale and PDF weights) are accumulated at once as RVec columns,
+and the acceptances and expected cross-sections for each weight and their
+envelopes are stored in a "weight_variations" block of the acceptance JSON.
 
 """
-from math import floor, ceil
 import numpy as np
 import sys
 import argparse
@@ -19,283 +32,39 @@ import json
 import ROOT
 import pathlib
 from data.samples import samples
+from modules.sample_catalogue import catalogue
+from modules.staging_cache import StagingCache, DEFAULT_CACHE_SIZE_GB
 from modules.logger_setup import logger
+from modules.results_store import ResultsStore, DEFAULT_STORE_NAME
 import modules.common_tools as ct
-import re
-import array
-import datetime
-
-# NOTE add more methods here as they are implemented
-TRUNCATION_METHODS = [
-    "default",
-    "generic_30",
-    "generic_15",
-    "generic_10",
-    "generic_5",
-    "quantile",
-    "mode",
-    "mode_15",
-]
-
-class TruncationWindow:
-    """
-    Class to define the mass window to use for truncating the signal sample when running the reinterpretation.
-     - the default method uses a window of [0.8 * M, 1.2 * M] where M is the signal mass, as suggested in 
-       Appendix A.1 of arXiv:1407.1376
-     - the generic method uses a window of [(1 - factor) * M, (1 + factor) * M] where factor is a user-defined 
-       parameter, which could be set to 0.2 to match the default method, but could also be varied to study the 
-       impact of the mass window choice on the limits
-     - the quantile method uses the +/- 2 sigma quantiles to define the window, half of the +/- 1 sigma quantiles 
-       window to define sigma, and the median in the truncated window to estimate the mean mass
-     - the mode method defines the window around the peak of the mjj spectrum. The width of the window on each 
-       side of the peak is twice the distance between the peak and the point that encloses 34.13% of the distribution 
-       (measured wrt the peak) calculated on the side of the distribution with the largest tail. The mean mass is 
-       estimated as the mode of the truncated distribution.
-     - the mode_XY method defines the window as in the generic_XY method but uses the mode instead of the mean in 
-       the window to estimate the average mass of the truncated signal
+from modules.metadata import metadata_store, validate_sample_metadata, get_xsec_factor, update_metadata_file
+from modules.analysis_spec import cutflow_acceptances, booked_results, evaluate_results, scale_statistics, WEIGHT_VECTOR_COLUMN, WEIGHT_INDEX_COLUMN
+from modules.get_metadata import read_xsec_info
+from modules.reinterpretation import TRUNCATION_METHODS, TRUNCATION_BINS, TRUNCATION_MAX_MASS, reinterpret_histogram
 
+def book_truncation_histogram(rdf, name:str="h_mjj_total", weight_column:str="mcEventWeight"):
     """
+    Book the 1 GeV mjj histogram the truncation windows are computed from
+    (see HistogramTruncationWindow in modules/reinterpretation.py).
+    """
+    return ct.bookHistWeighted(
+        rdf,
+        name,
+        "Dijet mass;M_{jj} [GeV];Events",
+        TRUNCATION_BINS, 0.0, TRUNCATION_MAX_MASS,
+        "mjj",
+        weight_column
+    )
 
-    def __init__(self, method_name:str, signal_mass:float, rdf):
-        self.method_name = method_name
-        self.signal_mass = signal_mass
-        self.rdf = rdf
-
-        # initialise attributes that are returned
-        # by get_* functions 
-        self.mean = None
-        self.sigma = None
-        self.window = None
-        self.hist = None
-
-        # fill the mjj histogram for the whole sample (no truncation)
-        # in case it is needed for calculating anything
-        self.total_mjj = None
-        if "quantile" in method_name or "mode" in method_name:
-            self.total_mjj = self.__get_total_hist()
-
-        # compute the parameters for each method at initialisation
-        # so this is only done once and not every time the get_* 
-        # functions are called
-        if self.method_name == "default":
-            logger.info(f"using default truncation method for signal mass {self.signal_mass}")
-            self.window = self.__get_generic_window(factor=0.2)
-            self.sigma = self.__get_generic_sigma(window=self.window)
-            self.mean, self.hist = self.__get_generic_mean(window=self.window)
-        elif "generic" in self.method_name:
-            factor = float(re.findall(r"generic_(\d+)", self.method_name)[0]) / 100.0
-            logger.info(f"using generic ({factor*100}%) truncation method for signal mass {self.signal_mass}")
-            self.window = self.__get_generic_window(factor=factor)
-            self.sigma = self.__get_generic_sigma(window=self.window)
-            self.mean, self.hist = self.__get_generic_mean(window=self.window)
-        elif "quantile" in self.method_name:
-            logger.info(f"using quantile truncation method for signal mass {self.signal_mass}")
-            self.window = self.__get_quantile_window()
-            self.sigma = self.__get_quantile_sigma()
-            self.mean, self.hist = self.__get_quantile_mean()
-        elif self.method_name == "mode":
-            logger.info(f"using mode truncation method for signal mass {self.signal_mass}")
-            self.mean, self.hist, self.sigma, self.window = self.__get_mode_parameters()
-        elif "mode" in self.method_name:
-            factor = float(re.findall(r"mode_(\d+)", self.method_name)[0]) / 100.0
-            logger.info(f"using mode ({factor*100}%) truncation method for signal mass {self.signal_mass}")
-            self.window = self.__get_generic_window(factor=factor)
-            self.sigma = self.__get_generic_sigma(window=self.window)
-            self.mean, self.hist = self.__get_generic_mean(window=self.window, use_mode=True)
-        else:
-            raise ValueError(f"truncation method {self.method_name} not recognised, should be one of {TRUNCATION_METHODS}")
-        
-        logger.info(
-            f"window = {self.window}"
-            f", mean = {self.mean}"
-            f", sigma = {self.sigma}"
-        )
-
-    def get_window(self):
-        return self.window
-
-    def get_sigma(self):
-        return self.sigma
-
-    def get_mean(self):
-        return self.mean
-    
-    def get_hist(self):
-        return self.hist
-       
-    ################################################################################
-    ##### Generic window methods (i.e. a window around the signal pole mass value)
-    def __get_generic_window(self, factor:float=0.2):
-        return [ceil(self.signal_mass*(1-factor)), floor(self.signal_mass*(1+factor))]
-
-    def __get_generic_sigma(self, window:list):
-        # divide by 5 to get an approximate sigma value, since the window 
-        # is roughly +/- 2 sigma around the mean
-        return (window[1] - window[0]) / 5.0
-
-    def __get_generic_mean(self, window:list, use_mode:bool=False, rebin_factor:int=10):
-        # get histogram in window
-        hist = self.__get_truncated_hist(window)
-        # calculate mean
-        mean = hist.GetMean() if hist.GetEntries() > 0 else 0.0
-        if use_mode:
-            # calculate mode instead of mean
-            mode_hist = hist.Clone(f"mode_hist_{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}")
-            if rebin_factor > 1:
-                mode_hist.Rebin(rebin_factor)
-            mode_bin = mode_hist.GetMaximumBin()
-            mean = mode_hist.GetBinCenter(mode_bin)
-        # return mean and histogram
-        return mean, hist
-
-    ################################################################################
-    ##### Quantile window methods
-    def __get_quantile_window(self, quantile:float=0.9545):
-        quantile_left = (1 - quantile) / 2
-        # assumes symmetric distribution
-        quantile_right = 1 - quantile_left
-
-        # get the quantiles of the distribution
-        quantiles = array.array('d', [quantile_left, quantile_right])
-        quantiles_values = array.array('d', [0.0, 0.0])
-        self.total_mjj.GetQuantiles(2, quantiles_values, quantiles)
-
-        # return the quantiles as the window
-        return [ceil(quantiles_values[0]), floor(quantiles_values[1])]
-
-    def __get_quantile_sigma(self, quantile:float=0.6826):
-        # calculate the approximated Gaussian width in GeV for the quantile window
-        window = self.__get_quantile_window(quantile=quantile)
-        # divide by 2 to get an approximate sigma value, since the window 
-        # is roughly +/- 1 sigma around the mean for a 68% quantile
-        return (window[1] - window[0]) / 2.0
-
-    def __get_quantile_mean(self):
-        # get window 
-        window = self.__get_quantile_window()
-        # get histogram in window
-        hist = self.__get_truncated_hist(window)
-        # calculate the median as an approximation for the mean
-        quantiles = array.array('d', [0.5])
-        quantiles_values = array.array('d', [0.0])
-        hist.GetQuantiles(1, quantiles_values, quantiles)
-        mean = float(quantiles_values[0]) if hist.GetEntries() > 0 else 0.0
-        # return mean and histogram
-        return round(mean), hist
-
-    ################################################################################
-    ##### Mode window methods
-    def __get_mode_parameters(self, rebin_factor:int=10):
-        # rebin the total mjj histogram to get a smoother distribution
-        # for the mode finding
-        # come up with a unique name to avoid conflicts when running this 
-        # multiple times in the same job
-        temp_hist = self.total_mjj.Clone(f"rebinned_mjj_{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}")
-        temp_hist.Rebin(rebin_factor)
-
-        # find the mode of the distribution
-        mode_bin = temp_hist.GetMaximumBin()
-        # integrate from the mode bin to the left and right and determine
-        # which side has the larger tail
-        integral_left = temp_hist.Integral(1, mode_bin-1)
-        integral_right = temp_hist.Integral(mode_bin+1, temp_hist.GetNbinsX())
-        integral_total = temp_hist.Integral()
-        if integral_total > 0:
-            integral_left_fraction = integral_left / integral_total
-            integral_right_fraction = integral_right / integral_total
-
-        direction = "left" if integral_left > integral_right else "right"
-        one_sigma_bin, integral = self.__get_integral_fraction(
-            temp_hist, mode_bin, 0.3413, direction=direction
-        )
-        logger.debug(
-            "mode found at bin %s with integral to the left %s and to the right %s, using direction %s to find the one sigma point at bin %s with integral %s",
-            mode_bin, integral_left, integral_right, direction, one_sigma_bin, integral
-        )
-        # define the window size as twice the distance between the mode and the one sigma point on the side with the larger tail
-        sigma = abs(temp_hist.GetBinCenter(mode_bin) - temp_hist.GetBinCenter(one_sigma_bin))
-        window = [
-            ceil(temp_hist.GetBinCenter(mode_bin) - 2*sigma), 
-            floor(temp_hist.GetBinCenter(mode_bin) + 2*sigma)
-        ]
-        mode = temp_hist.GetBinCenter(mode_bin)
-        # get histogram in window
-        hist = self.__get_truncated_hist(window)        
-        return (mode, hist, sigma, window)
- 
-    ################################################################################
-    ##### Other helper functions
-    def __get_truncated_hist(
-        self, 
-        window:list, 
-        mjj_column:str="mjj", 
-        weight_column:str="mcEventWeight", 
-        nbins:int=6000, 
-        min_mass:float=0.0, 
-        max_mass:float=6000.0
-    ):
-        # fill a histogram with the events in the mass window and return it
-        h_mjj = ct.bookHistWeighted(
-            self.rdf.Filter(f"{mjj_column} > {window[0]} && {mjj_column} < {window[1]}"),
-            "h_mjj_window",
-            "Dijet mass in window;M_{jj} [GeV];Events",
-            nbins, min_mass, max_mass,
-            mjj_column,
-            weight_column
-        ).GetValue()
-        return h_mjj
-    
-    def __get_total_hist(
-        self,
-        mjj_column:str="mjj",
-        weight_column:str="mcEventWeight",
-        nbins:int=6000,
-        min_mass:float=0.0,
-        max_mass:float=6000.0
-    ):
-        # fill a histogram with all the events and return it
-        h_mjj = ct.bookHistWeighted(
-            self.rdf,
-            "h_mjj_total",
-            "Dijet mass;M_{jj} [GeV];Events",
-            nbins, min_mass, max_mass,
-            mjj_column,
-            weight_column
-        ).GetValue()
-        return h_mjj
-
-    def __get_integral_fraction(self, hist, start_bin:int, threshold:float, direction:str="left"):
-        # find the bin that encloses the given threshold fraction of the distribution 
-        # starting from start_bin and moving in the given direction (left or right)
-        if hist.GetEntries() == 0:
-            return -1
-        elif hist.Integral() != 1.0:
-            logger.debug(
-                "histogram integral is not unity, normalising to unit area for calculating quantiles and integrals"
-            )
-            # normalise to unit area for calculating quantiles and integrals
-            hist.Scale(1.0 / hist.Integral())
-
-        if direction not in ["left", "right"]:
-            raise ValueError(f"direction {direction} not recognised, should be 'left' or 'right'")
-
-        bin_index = start_bin
-        integral = float()
-        while bin_index > 0 and bin_index <= hist.GetNbinsX():
-            if bin_index > start_bin:
-                integral = hist.Integral(start_bin, bin_index)
-            else:
-                integral = hist.Integral(bin_index, start_bin)
-            
-            if integral >= threshold:
-                break
-            
-            if direction == "left":
-                bin_index -= 1
-            elif direction == "right":
-                bin_index += 1        
-
-        return bin_index, integral
+def histogram_contents(hist)->np.ndarray:
+    """
+    Return the bin contents of a TH1 or TH2 including the under- and overflow
+    bins, indexed [x bin] or [x bin, y bin] like the uproot values(flow=True).
+    """
+    contents = np.array([hist.GetBinContent(i_cell) for i_cell in range(hist.GetNcells())])
+    if hist.GetDimension() == 2:
+        contents = contents.reshape(hist.GetNbinsY() + 2, hist.GetNbinsX() + 2).T
+    return contents
 
 def run_reinterpretation(
     rdf,
@@ -307,17 +76,66 @@ def run_reinterpretation(
     truncation_method="default",
     weight_column:str="mcEventWeight",
     save_histograms:bool=True,
+    systematics:bool=False,
+    n_weights:int=0,
+    weight_factor:float=None,
 ):
-    # retrieve the mass window for this interpretation method
-    truncation = TruncationWindow(truncation_method, signal_mass, rdf)
-    # calculate parameters needed for this truncation method
-    mass_window = truncation.get_window()
-    sigma = truncation.get_sigma()
-    mean_mass = truncation.get_mean()
+    # the window, the fraction of events in it and the limit are computed from the
+    # 1 GeV mjj distribution by reinterpret_histogram, the same code as the offline
+    # reinterpretation of the saved histograms in modules/reinterpretation.py
+    total_hist = book_truncation_histogram(rdf, weight_column=weight_column)
+    if systematics:
+        # book the variations before running the event loop so that the
+        # varied mjj distributions are filled in the same pass
+        total_hist_variations = ct.variations_for(total_hist)
+    weight_hist = None
+    if n_weights > 0:
+        # same columns as the weight vector histograms of book_histograms
+        weight_df = ct.define_columns(rdf, {
+            "mjj_weights": f"return ROOT::RVec<double>({WEIGHT_VECTOR_COLUMN}.size(), mjj);"
+        })
+        weight_hist = weight_df.Histo2D(
+            ("h_mjj_total_weights", "Dijet mass;M_{jj} [GeV]; weight index", TRUNCATION_BINS, 0.0, TRUNCATION_MAX_MASS, n_weights, -0.5, n_weights - 0.5),
+            "mjj_weights",
+            WEIGHT_INDEX_COLUMN,
+            WEIGHT_VECTOR_COLUMN
+        )
+    total_hist = total_hist.GetValue()
+
+    variation_contents = None
+    if systematics:
+        variation_contents = {
+            variation: histogram_contents(hist)
+            for variation, hist in ct.variation_values(total_hist_variations).items()
+            if variation != "nominal"
+        }
+    reinterpret_histogram(
+        gauss_limit,
+        signal_mass,
+        data_dict,
+        histogram_contents(total_hist),
+        np.linspace(0.0, TRUNCATION_MAX_MASS, TRUNCATION_BINS + 1),
+        truncation_method=truncation_method,
+        # [bin, weight] without the flow bins of the weight axis
+        weight_contents=histogram_contents(weight_hist.GetValue())[:, 1:-1] if weight_hist is not None else None,
+        variation_contents=variation_contents,
+    )
 
     # write truncated histogram to the (existing) histogram file
     if save_histograms:
-        truncated_hist = truncation.get_hist()
+        mass_window = data_dict["mjj_window"]
+        truncated_hist = total_hist.Clone("h_mjj_window")
+        # keep the bins inside the window, as counted by reinterpret_histogram
+        for i_bin in range(truncated_hist.GetNcells()):
+            low_edge = truncated_hist.GetBinLowEdge(i_bin)
+            in_window = 0 < i_bin <= TRUNCATION_BINS and low_edge >= mass_window[0] and low_edge + truncated_hist.GetBinWidth(i_bin) <= mass_window[1]
+            if not in_window:
+                truncated_hist.SetBinContent(i_bin, 0.0)
+                truncated_hist.SetBinError(i_bin, 0.0)
+        truncated_hist.ResetStats()
+        if weight_factor is not None:
+            # normalise like the other histograms of the file (see --sumw-in-loop)
+            truncated_hist.Scale(weight_factor)
         with ROOT.TFile.Open(
             histogram_file,
             "UPDATE"
@@ -325,110 +143,66 @@ def run_reinterpretation(
             outfile.cd(signal_region)
             truncated_hist.Write()
 
-    # compute the fraction of events in the mass window
-    tmp_df = rdf.Filter(
-        f"mjj > {mass_window[0]} && mjj < {mass_window[1]}"
-    )
-    sumW_mass_window = tmp_df.Sum(weight_column).GetValue()
-    sumW_total = rdf.Sum(weight_column).GetValue()
-    fraction_in_window = sumW_mass_window / sumW_total if sumW_total > 0 else 0.0
-
-    logger.info(
-        "fraction of events in mass window between %s GeV and %s GeV is %s",
-        mass_window[0], mass_window[1], fraction_in_window
-    )
-
-    # store the modified acceptance and other information
-    data_dict["mjj_window_acceptance"] = fraction_in_window
-    data_dict["mjj_window"] = mass_window
-    if "expected_xsec_pb" in data_dict:
-        modified_acceptance_xsec = data_dict["expected_xsec_pb"] * fraction_in_window
-    else:
-        modified_acceptance_xsec = None
-        logger.warning("expected_xsec_pb not found in data_dict, cannot calculate modified expected cross-section!")
-    data_dict["truncation_method"] = truncation_method
-    data_dict["mean_window_mass"] = mean_mass
-    data_dict["modified_expected_xsec_pb"] = modified_acceptance_xsec
-    
-    # get the widths available for this signal region
-    limit_widths = gauss_limit["width"].unique()
-    limit_widths = np.sort(limit_widths)
-
-    # calculate the width/mass ratio to match to the gaussian limits
-    width = (sigma / mean_mass) * 100.0 if mean_mass > 0 else 0.0 # in percent
-
-    # round up to the nearest value in widths
-    if width not in limit_widths:
-        if width > np.max(limit_widths):
-            logger.warning(
-                "calculated width/mass ratio of %s pc. is larger than the maximum width available in the limits, using maximum width %s pc. for limit calculation",
-                width, np.max(limit_widths)
-            )
-            width = np.max(limit_widths)
-        elif width < np.min(limit_widths):
-            logger.warning(
-                "calculated width/mass ratio of %s pc. is smaller than the minimum width available in the limits, using minimum width %s pc. for limit calculation",
-                width, np.min(limit_widths)
-            )
-            width = np.min(limit_widths)
-        else:
-            diff = width - limit_widths
-            mask = diff < 0
-            width = limit_widths[mask][np.argmin(diff[mask] * -1)]
-    # ensure width is a float for later saving in json
-    width = float(width) 
-    data_dict["width_pc"] = width
-
-    # retrieve the limits for this width
-    gauss_limit = gauss_limit.loc[gauss_limit["width"] == int(width)]
-    if gauss_limit.empty:
-        logger.warning(
-            "no Gaussian limits found for width %s pc., skipping limit calculation",
-            width
-        )
-        data_dict["excluded_xsec_pb"] = np.nan
-        return
-
-    excluded_xsec = float()
-    if np.any(gauss_limit["mass"] == mean_mass):
-        logger.info(
-            "exact mass point %s GeV found with width %s pc., using corresponding observed limit",
-            mean_mass, width
-        )
-        excluded_xsec = gauss_limit.loc[gauss_limit["mass"] == mean_mass, "observed_limit"].values[0]
-    else:
-        # find the closest mass points above and below the mean mass
-        mass_below = gauss_limit["mass"][gauss_limit["mass"] < mean_mass]
-        mass_above = gauss_limit["mass"][gauss_limit["mass"] > mean_mass]
-        if mass_below.empty and mass_above.empty:
-            logger.warning(
-                "no suitable mass points found for width %s pc. with mean mass %s GeV, skipping limit calculation",
-                width, mean_mass
-            )
-            excluded_xsec = np.nan
-        elif mass_below.empty or mass_above.empty:
-            logger.warning("the mean mass %s GeV is outside the mass range for width %s pc. limits, skipping limit calculation", mean_mass, width)
-            excluded_xsec = np.nan
-        else:
-            # find the largest mass point in mass_below and smallest in mass_above
-            # and retrieve the observed limit for those points
-            closest_below = mass_below.max()
-            closest_above = mass_above.min()
-            limit_below = gauss_limit.loc[gauss_limit["mass"] == closest_below, "observed_limit"]
-            limit_above = gauss_limit.loc[gauss_limit["mass"] == closest_above, "observed_limit"]
-
-            # take the larger of the two limits to be conservative
-            excluded_xsec = np.max([limit_below.values[0], limit_above.values[0]])
-
-            logger.info(
-                "interpolated mass point for width %s pc. with mean mass %s GeV between %s GeV and %s GeV, using more conservative observed limit %s pb.",
-                width, mean_mass, closest_below, closest_above, excluded_xsec
-            )
+    return
 
-    # store the reinterpretation results in the data dictionary
-    data_dict["excluded_xsec_pb"] = excluded_xsec
+def loop_sample_metadata(sample_name:str, sumW:float, num_events:int)->tuple:
+    """
+    Return the metadata of a sample using the sum of weights computed in the
+    event loop, and the entry to write back to the metadata file.
 
-    return
+    The cross-section information is taken from the metadata file if present,
+    otherwise from run/xsec_info_<sample>.txt (see modules/get_metadata.py).
+    """
+    metadata = metadata_store.raw(sample_name, samples[sample_name]["metadata"])
+    entry = {"sumW": sumW}
+    if "xsec" not in metadata:
+        xsec_metadata = read_xsec_info(sample_name, num_events)
+        if xsec_metadata is not None:
+            entry.update(xsec_metadata)
+    elif samples[sample_name].get("uses_pythia8", False) and "sumW" in metadata:
+        # the sum of weights of Pythia8 samples is taken from the generator info
+        entry["sumW"] = metadata["sumW"]
+    metadata.update(entry)
+    return metadata, entry
+
+def evaluate_cutflow_variations(cutflow_variations:dict, sr_cutflows:dict)->dict:
+    """
+    Return the cutflows of each signal region for each systematic variation.
+
+    Parameters
+    ----------
+    cutflow_variations : dict
+        RDF result maps booked with variations_for for each signal region and cut.
+    sr_cutflows : dict
+        Evaluated nominal cutflows, used for the steps that do not depend
+        on the varied columns (e.g. the initial yield).
+
+    Returns
+    -------
+    dict
+        Cutflows keyed by variation name and signal region.
+    """
+    sr_values = {
+        sr: {cut: ct.variation_values(result_map) for cut, result_map in cutflow.items()}
+        for sr, cutflow in cutflow_variations.items()
+    }
+    variations = sorted({
+        variation
+        for cutflow in sr_values.values()
+        for values in cutflow.values()
+        for variation in values
+        if variation != "nominal"
+    })
+    return {
+        variation: {
+            sr: {
+                cut: sr_values[sr].get(cut, dict()).get(variation, sr_cutflows[sr][cut])
+                for cut in sr_cutflows[sr]
+            }
+            for sr in sr_cutflows
+        }
+        for variation in variations
+    }
 
 def get_args():
     parser = argparse.ArgumentParser(
@@ -492,6 +266,92 @@ def get_args():
         help="Whether to skip storing the cutflows in JSON files in the output directory",
         default=False
     )
+    parser.add_argument(
+        "--systematics",
+        action="store_true",
+        help="Whether to evaluate the jet energy scale and resolution variations in the same event loop",
+        default=False
+    )
+    parser.add_argument(
+        "--jes-uncertainty",
+        type=float,
+        default=0.02,
+        help="Relative jet energy scale uncertainty used for the JES up/down variations"
+    )
+    parser.add_argument(
+        "--jer-resolution",
+        type=float,
+        default=0.05,
+        help="Relative width of the additional jet smearing used for the JER variation"
+    )
+    parser.add_argument(
+        "--weight-vector-branch",
+        type=str,
+        default=None,
+        help="Branch with multiple weights per event (e.g. Weight.Weight) to evaluate all weights in the same event loop"
+    )
+    parser.add_argument(
+        "--validation-workers",
+        type=int,
+        default=8,
+        help="Number of threads used to check the sample files before processing"
+    )
+    parser.add_argument(
+        "--tree-cache-mb",
+        type=float,
+        default=None,
+        help="TTreeCache size in MB used when reading the samples (0 disables it, RDF default if not given)"
+    )
+    parser.add_argument(
+        "--prefetch",
+        action=argparse.BooleanOptionalAction,
+        default=None,
+        help="Whether to enable asynchronous prefetching when reading the samples (ROOT default if not given)"
+    )
+    parser.add_argument(
+        "--cache-branches",
+        type=str,
+        nargs="+",
+        default=None,
+        help="Branches to restrict the TTreeCache to, e.g. Jet.PT Jet.Eta Jet.Phi Jet.Mass Jet_size Event.Weight "
+        "(with a 30 MB cache if --tree-cache-mb is not given)"
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=pathlib.Path,
+        default=None,
+        help="Local directory to stage the sample files to before reading them (e.g. on a local SSD)"
+    )
+    parser.add_argument(
+        "--cache-size-gb",
+        type=float,
+        default=DEFAULT_CACHE_SIZE_GB,
+        help="Maximum size of the staging cache, least recently used files are evicted above it"
+    )
+    parser.add_argument(
+        "--sumw-in-loop",
+        action="store_true",
+        default=False,
+        help="Whether to compute the sum of weights in the analysis event loop and normalise the results afterwards, instead of reading it from the metadata file"
+    )
+    parser.add_argument(
+        "--write-metadata",
+        action="store_true",
+        default=False,
+        help="Whether to write the sum of weights computed with --sumw-in-loop (and any cross-section information read) back to the metadata file"
+    )
+    parser.add_argument(
+        "--results-store",
+        type=pathlib.Path,
+        default=None,
+        help="SQLite results store to add the acceptances and cutflows to (by default results.sqlite in the output directory)"
+    )
+    parser.add_argument(
+        "--legacy-json",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Whether to also write the acceptances and cutflows to one JSON file per sample and analysis"
+    )
     parser.add_argument(
         "--file-prefix",
         type=str,
@@ -508,9 +368,22 @@ def main():
         logger.error("output directory %s does not exist", args.output_dir)
         return 1
 
+    results_store = ResultsStore(args.results_store or args.output_dir / DEFAULT_STORE_NAME)
+
+    if args.cache_dir is not None:
+        catalogue.staging = StagingCache(args.cache_dir, args.cache_size_gb)
+
+    if args.write_metadata and not args.sumw_in_loop:
+        logger.error("--write-metadata requires --sumw-in-loop")
+        return 1
+
     if args.skip_histograms and not args.do_reinterpretation:
         logger.error("cannot skip histogram creation if not running reinterpretation!")
         return 1
+
+    if args.cache_branches is not None and args.tree_cache_mb == 0:
+        logger.error("--cache-branches needs the TTreeCache, it cannot be used with --tree-cache-mb 0")
+        return 1
     
     analysis_modules = dict()
     analysis_limits = dict()
@@ -530,6 +403,12 @@ def main():
                 break
         if not bad_module:
             analysis_modules[analysis_name] = analysis_module
+            if not hasattr(analysis_module, "SPEC"):
+                logger.warning(
+                    "analysis module %s does not define an AnalysisSpec (SPEC), its functions are only given "
+                    "the dataframe: no shared preselection, jet variations, cutflow statistics or weight vector",
+                    analysis_name
+                )
 
         # now also load the limits module if it exists
         analysis_limit = None
@@ -564,49 +443,136 @@ def main():
         logger.info("setting up ROOT RDataFrame with %d workers", args.workers)
         ROOT.ROOT.EnableImplicitMT(args.workers)
     
+    # check that the files of all samples exist before starting any event loop
+    validation = catalogue.validate(
+        [sample_name for sample_name in args.samples if sample_name in catalogue],
+        workers=args.validation_workers
+    )
+
     sr_dfs = dict()
     sr_histograms = dict()
     sr_cutflows = dict()
     sr_acceptances = dict()
     sample_metadata = dict()
+    analysis_dfs = dict()
+    analysis_histograms = dict()
+    analysis_cutflows = dict()
     for sample_name in args.samples:
+        # the event loops of the previous sample are done, its staged files can be evicted
+        catalogue.release()
         if sample_name not in samples:
             logger.error("sample %s not found in data/samples.py, skipping", sample_name)
             continue
+        if not validation[sample_name]["valid"]:
+            logger.error("sample %s has missing or unreadable files, skipping", sample_name)
+            continue
+        if not args.sumw_in_loop and not metadata_store.is_valid(sample_name, samples[sample_name]["metadata"]):
+            logger.error("sample %s has missing or invalid metadata, skipping", sample_name)
+            continue
+
+        # number of weights in the weight vector, if any
+        n_weights = 0
+        if args.weight_vector_branch is not None:
+            n_weights = ct.get_weight_vector_size(catalogue.files(sample_name), args.weight_vector_branch)
+            logger.info("found %s weights in branch %s for sample %s", n_weights, args.weight_vector_branch, sample_name)
 
         # load the RDF for this sample
         sample_rdf = ct.load_delhes_rdf(
             sample_name, 
-            samples[sample_name]["ntuple"], 
-            samples[sample_name]["metadata"]
+            catalogue.files(sample_name), 
+            samples[sample_name]["metadata"],
+            weight_vector_branch=args.weight_vector_branch,
+            cache_size_mb=args.tree_cache_mb,
+            prefetch=args.prefetch,
+            branches=args.cache_branches,
+            weight_factor=1.0 if args.sumw_in_loop else None
         )
 
-        # load the same metadata to get cross-section information
-        with open(samples[sample_name]["metadata"], 'r') as f:
-            sample_metadata = json.load(f)[sample_name]
-
-        sr_dfs = dict() # clear for each iteration
-        sr_histograms = dict()
-        sr_cutflows = dict()
-        sr_acceptances = dict()
-        tmp_df = None
+        # apply the dijet preselection once for this sample so that all
+        # analyses branch from the same node and share the leading-dijet defines
+        jet_variations = None
+        if args.systematics:
+            jet_variations = ct.jet_variations(args.jes_uncertainty, args.jer_resolution)
+        preselection_rdf = ct.dijet_preselection(sample_rdf, variations=jet_variations)
+
+        analysis_dfs = dict() # clear for each iteration
+        analysis_histograms = dict()
+        analysis_cutflows = dict()
+        analysis_cutflow_variations = dict()
+        analysis_statistics = dict()
         for analysis_name in analysis_modules:
-            logger.info("processing sample %s for analysis %s", sample_name, analysis_name)
+            logger.info("booking sample %s for analysis %s", sample_name, analysis_name)
 
             # run the analysis / selection on the RDF
-            sr_dfs, sr_cutflows = analysis_modules[analysis_name].analysis(sample_rdf)
-            
-            # make the histograms
-            histogram_file = args.output_dir / f"{args.file_prefix + '_' if args.file_prefix != '' else ''}histograms_{sample_name}_{analysis_name}.root"
+            # modules defined with an AnalysisSpec take the shared preselection, the
+            # statistics to fill and the number of weights, older ones only the dataframe
+            analysis_statistics[analysis_name] = dict()
+            analysis_kwargs, histogram_kwargs = dict(), dict()
+            if hasattr(analysis_modules[analysis_name], "SPEC"):
+                analysis_kwargs = {"preselection": preselection_rdf, "statistics": analysis_statistics[analysis_name], "n_weights": n_weights}
+                histogram_kwargs = {"n_weights": n_weights}
+            analysis_dfs[analysis_name], analysis_cutflows[analysis_name] = analysis_modules[analysis_name].analysis(
+                sample_rdf, **analysis_kwargs
+            )
+
+            # book the systematic variations of the cutflow yields
+            if args.systematics:
+                analysis_cutflow_variations[analysis_name] = {
+                    sr: {
+                        cut: ct.variations_for(result)
+                        for cut, result in cutflow.items()
+                        if not isinstance(result, (float, int))
+                    }
+                    for sr, cutflow in analysis_cutflows[analysis_name].items()
+                }
+
+            # book the histograms
+            analysis_histograms[analysis_name] = dict()
             if not args.skip_histograms:
-                for sr in sr_dfs:
-                    sr_histograms[sr] = analysis_modules[analysis_name].histograms(sr_dfs[sr])
+                for sr in analysis_dfs[analysis_name]:
+                    analysis_histograms[analysis_name][sr] = analysis_modules[analysis_name].histograms(
+                        analysis_dfs[analysis_name][sr], **histogram_kwargs
+                    )
 
-                # run the analysis histogram event loops via RunGraphs
-                print(ROOT.RDF.RunGraphs([h for hist_list in sr_histograms.values() for h in hist_list]), file=sys.stderr)
+        # run the histogram and cutflow event loops for all analyses together via
+        # RunGraphs so that the preselection is only evaluated once per event
+        # the cutflow statistics and N-1 yields share the filters of the cutflows
+        loop_results = booked_results(analysis_histograms)
+        loop_results += booked_results(analysis_cutflows)
+        loop_results += booked_results(analysis_statistics)
+        if args.sumw_in_loop:
+            # the raw sum of weights of the sample, read in the same event loop
+            loop_sumW = sample_rdf.Sum("Event.Weight")
+            loop_events = sample_rdf.Count()
+            loop_results += [loop_sumW, loop_events]
+        print(ROOT.RDF.RunGraphs(loop_results), file=sys.stderr)
+
+        # normalise the results of the raw weights now that the sum of weights is known,
+        # the cutflows and their variations are normalised together below
+        weight_factor = None
+        if args.sumw_in_loop:
+            sample_metadata, metadata_entry = loop_sample_metadata(sample_name, loop_sumW.GetValue(), loop_events.GetValue())
+            problems = validate_sample_metadata(sample_name, sample_metadata)
+            if len(problems) > 0:
+                logger.error("cannot normalise sample %s: %s, skipping", sample_name, "; ".join(problems))
+                continue
+            weight_factor = get_xsec_factor(sample_name, sample_metadata) / sample_metadata["sumW"]
+            logger.info("calculated weight factor for sample %s of %s after the event loop", sample_name, weight_factor)
+            for hist in booked_results(analysis_histograms):
+                hist.GetValue().Scale(weight_factor)
+            if args.write_metadata:
+                update_metadata_file(samples[sample_name]["metadata"], {sample_name: metadata_entry})
 
-                # save the histograms to a ROOT file with directories for 
-                # each signal region
+        for analysis_name in analysis_modules:
+            logger.info("processing sample %s for analysis %s", sample_name, analysis_name)
+            sr_dfs = analysis_dfs[analysis_name]
+            sr_histograms = analysis_histograms[analysis_name]
+            sr_cutflows = analysis_cutflows[analysis_name]
+
+            # save the histograms to a ROOT file with directories for
+            # each signal region
+            histogram_file = args.output_dir / f"{args.file_prefix + '_' if args.file_prefix != '' else ''}histograms_{sample_name}_{analysis_name}.root"
+            if not args.skip_histograms:
                 logger.info("saving histograms to %s in output directory", histogram_file)
                 with ROOT.TFile.Open(str(histogram_file), "RECREATE") as outfile:
                     for sr in sr_histograms:
@@ -621,42 +587,44 @@ def main():
                 for cut in sr_cutflows[sr]:
                     if not isinstance(sr_cutflows[sr][cut], (float, int)):
                         sr_cutflows[sr][cut] = sr_cutflows[sr][cut].GetValue()
-
-                # calculate acceptance from the cutflow
-                initial_events = sr_cutflows[sr]["initial"]
-                final_events = sr_cutflows[sr][(list(sr_cutflows[sr].keys()))[-1]] # last cut
-                # in the acceptance calculation all factors of the cross-section, BR, etc
-                # should cancel out, so they need to be applied to the signal cross-section 
-                # again later on
-                acceptance = final_events / initial_events if initial_events > 0 else 0.0
-
-                # initialise extra factors to apply to the cross-section
-                # so that the expected MC yield is normalised correctly
-                extra_factors = sample_metadata.get("br", 1.0)
-                # Pythia8 accounts for the "filter efficiency" but not the branching ratio internally 
-                # in the cross-section calculations
-                # i.e.
-                # double Info::sigmaGen(int i = 0)  
-                # double Info::sigmaErr(int i = 0)
-                # the estimated cross section and its estimated error, summed over all allowed 
-                # processes (i = 0) or for the given process, in units of mb. The numbers refer 
-                # to the accepted event sample above, i.e. after any user veto.
-                if not samples[sample_name].get("uses_pythia8", False):
-                    extra_factors *= sample_metadata.get("filter_eff", 1.0)
-                
-                sr_acceptances[sr] = {
-                    "acceptance": acceptance,
-                    # include factors for the branching ratio and filter efficiency multiplying the cross-section 
-                    # to correctly determine the expected cross-section of the signal sample
-                    "expected_xsec_pb": acceptance * sample_metadata["xsec"] * extra_factors,
-                }
-
-            # save the cutflows to a JSON file
+            # the variations take the steps without a varied column from the
+            # nominal cutflows, so they are evaluated before normalising either
+            variation_cutflows = dict()
+            if args.systematics:
+                variation_cutflows = evaluate_cutflow_variations(analysis_cutflow_variations[analysis_name], sr_cutflows)
+            if weight_factor is not None:
+                for cutflows in [sr_cutflows] + list(variation_cutflows.values()):
+                    for sr in cutflows:
+                        for cut in cutflows[sr]:
+                            cutflows[sr][cut] *= weight_factor
+
+            # calculate acceptance from the cutflow, including factors for the branching
+            # ratio and filter efficiency multiplying the cross-section to correctly
+            # determine the expected cross-section of the signal sample
+            sr_statistics = evaluate_results(analysis_statistics[analysis_name])
+            if weight_factor is None:
+                xsec_factor = metadata_store.xsec_factor(sample_name)
+            else:
+                xsec_factor = get_xsec_factor(sample_name, sample_metadata)
+                sr_statistics = scale_statistics(sr_statistics, weight_factor)
+            sr_acceptances = cutflow_acceptances(sr_cutflows, xsec_factor, sr_statistics)
+            for variation, cutflows in variation_cutflows.items():
+                for sr, variation_acceptance in cutflow_acceptances(cutflows, xsec_factor).items():
+                    sr_acceptances[sr].setdefault("systematics", dict())[variation] = variation_acceptance
+
+            # save the cutflows to the results store and JSON files
             if not args.skip_store_cutflows:
-                cutflow_file = args.output_dir / f"{args.file_prefix + '_' if args.file_prefix != '' else ''}cutflows_{sample_name}_{analysis_name}.json"
-                logger.info("saving cutflows to %s in output directory", cutflow_file)
-                with open(cutflow_file, "w") as cutflow_file:
-                    json.dump(sr_cutflows, cutflow_file, indent=4)
+                results_store.add_cutflows(sample_name, analysis_name, sr_cutflows, prefix=args.file_prefix)
+                if args.legacy_json:
+                    cutflow_file = args.output_dir / f"{args.file_prefix + '_' if args.file_prefix != '' else ''}cutflows_{sample_name}_{analysis_name}.json"
+                    logger.info("saving cutflows to %s in output directory", cutflow_file)
+                    with open(cutflow_file, "w") as cutflow_file:
+                        json.dump(sr_cutflows, cutflow_file, indent=4)
+
+                statistics_file = args.output_dir / f"{args.file_prefix + '_' if args.file_prefix != '' else ''}cutflow_statistics_{sample_name}_{analysis_name}.json"
+                logger.info("saving cutflow statistics to %s in output directory", statistics_file)
+                with open(statistics_file, "w") as statistics_file:
+                    json.dump(sr_statistics, statistics_file, indent=4)
 
             # run the re-interpretation of the sample using Gaussian limits
             # do this for each signal region and then pick out the 
@@ -672,12 +640,22 @@ def main():
                         sr_acceptances[sr],
                         str(histogram_file),
                         truncation_method=args.truncation_method,
-                        save_histograms=not args.skip_histograms
+                        save_histograms=not args.skip_histograms,
+                        systematics=args.systematics,
+                        n_weights=n_weights,
+                        weight_factor=weight_factor
                     )
 
-            # save the acceptances to a JSON file
+            # save the acceptances to the results store and a JSON file
             # always do this so that the acceptance information is available 
             # for diagnostic purposes even if the reinterpretation is not run
+            results_store.add_acceptances(
+                sample_name, analysis_name, sr_acceptances,
+                truncation_method=args.truncation_method if args.do_reinterpretation else "",
+                prefix=args.file_prefix
+            )
+            if not args.legacy_json:
+                continue
             acceptance_file = str(args.output_dir / f"{args.file_prefix + '_' if args.file_prefix != '' else ''}acceptances_{sample_name}_{analysis_name}")
             if args.do_reinterpretation:
                 acceptance_file += f"_{args.truncation_method}"
@@ -0,0 +1,529 @@
+"""
+
+Reinterpretation of the signal samples with the Gaussian limits, directly
+from the stored outputs of modules/process_sample.py (or the array backend).
+
+The truncation of the signal is computed from the per-signal-region h_mjj
+histograms in histograms_{sample}_{analysis}.root instead of the events, and
+the acceptances are read from the results store (or the acceptance JSON
+files written without --do-reinterpretation). No ntuple is read and ROOT is
+not needed, so all the truncation methods can be run over a whole mass scan
+in seconds:
+
+python modules/reinterpretation.py -s <sample IDs> -a run2_atlas_tla_dijet -i outputs
+
+The outputs are the same as with process_sample.py --do-reinterpretation
+for each truncation method: the acceptances are added to the results store
+with the truncation method and written to acceptances_{sample}_{analysis}_{method}.json.
+
+The windows have integer edges, so with the 1 GeV binning of the h_mjj
+histograms the fraction of events in the window is the same as from the
+events. The mean mass in the window is computed from the bin centres rather
+than the exact mjj values, and the systematic variations of the window
+fraction (--systematics) are not available since they need the event loop.
+
+"""
+import sys
+import argparse
+import copy
+import importlib
+import json
+import pathlib
+import re
+from math import floor, ceil
+import numpy as np
+import uproot
+from data.samples import samples
+from modules.logger_setup import logger
+from modules.results_store import ResultsStore, DEFAULT_STORE_NAME, acceptance_file_name
+from modules.analysis_spec import envelope
+
+# NOTE add more methods here as they are implemented
+TRUNCATION_METHODS = [
+    "default",
+    "generic_30",
+    "generic_15",
+    "generic_10",
+    "generic_5",
+    "quantile",
+    "mode",
+    "mode_15",
+]
+# 1 GeV mjj histograms the windows are computed from in the event loop
+# (run_reinterpretation in modules/process_sample.py)
+TRUNCATION_BINS = 6000
+TRUNCATION_MAX_MASS = 6000.0
+
+def lookup_gaussian_limit(gauss_limit, sigma:float, mean_mass:float)->tuple:
+    """
+    Return the width/mass ratio (in percent) of a truncated signal rounded up
+    to the widths of the Gaussian limits, and the excluded cross-section for
+    that width at the mean mass (NaN if it cannot be determined).
+
+    Parameters
+    ----------
+    gauss_limit : pd.DataFrame
+        Gaussian limits of a signal region as returned by get_limits of the
+        analysis limits module.
+    sigma : float
+        Width of the truncated signal in GeV.
+    mean_mass : float
+        Mean mass of the truncated signal in GeV.
+    """
+    # get the widths available for this signal region
+    limit_widths = gauss_limit["width"].unique()
+    limit_widths = np.sort(limit_widths)
+
+    # calculate the width/mass ratio to match to the gaussian limits
+    width = (sigma / mean_mass) * 100.0 if mean_mass > 0 else 0.0 # in percent
+
+    # round up to the nearest value in widths
+    if width not in limit_widths:
+        if width > np.max(limit_widths):
+            logger.warning(
+                "calculated width/mass ratio of %s pc. is larger than the maximum width available in the limits, using maximum width %s pc. for limit calculation",
+                width, np.max(limit_widths)
+            )
+            width = np.max(limit_widths)
+        elif width < np.min(limit_widths):
+            logger.warning(
+                "calculated width/mass ratio of %s pc. is smaller than the minimum width available in the limits, using minimum width %s pc. for limit calculation",
+                width, np.min(limit_widths)
+            )
+            width = np.min(limit_widths)
+        else:
+            diff = width - limit_widths
+            mask = diff < 0
+            width = limit_widths[mask][np.argmin(diff[mask] * -1)]
+    # ensure width is a float for later saving in json
+    width = float(width)
+
+    # retrieve the limits for this width
+    gauss_limit = gauss_limit.loc[gauss_limit["width"] == int(width)]
+    if gauss_limit.empty:
+        logger.warning(
+            "no Gaussian limits found for width %s pc., skipping limit calculation",
+            width
+        )
+        return width, np.nan
+
+    excluded_xsec = float()
+    if np.any(gauss_limit["mass"] == mean_mass):
+        logger.info(
+            "exact mass point %s GeV found with width %s pc., using corresponding observed limit",
+            mean_mass, width
+        )
+        excluded_xsec = gauss_limit.loc[gauss_limit["mass"] == mean_mass, "observed_limit"].values[0]
+    else:
+        # find the closest mass points above and below the mean mass
+        mass_below = gauss_limit["mass"][gauss_limit["mass"] < mean_mass]
+        mass_above = gauss_limit["mass"][gauss_limit["mass"] > mean_mass]
+        if mass_below.empty and mass_above.empty:
+            logger.warning(
+                "no suitable mass points found for width %s pc. with mean mass %s GeV, skipping limit calculation",
+                width, mean_mass
+            )
+            excluded_xsec = np.nan
+        elif mass_below.empty or mass_above.empty:
+            logger.warning("the mean mass %s GeV is outside the mass range for width %s pc. limits, skipping limit calculation", mean_mass, width)
+            excluded_xsec = np.nan
+        else:
+            # find the largest mass point in mass_below and smallest in mass_above
+            # and retrieve the observed limit for those points
+            closest_below = mass_below.max()
+            closest_above = mass_above.min()
+            limit_below = gauss_limit.loc[gauss_limit["mass"] == closest_below, "observed_limit"]
+            limit_above = gauss_limit.loc[gauss_limit["mass"] == closest_above, "observed_limit"]
+
+            # take the larger of the two limits to be conservative
+            excluded_xsec = np.max([limit_below.values[0], limit_above.values[0]])
+
+            logger.info(
+                "interpolated mass point for width %s pc. with mean mass %s GeV between %s GeV and %s GeV, using more conservative observed limit %s pb.",
+                width, mean_mass, closest_below, closest_above, excluded_xsec
+            )
+
+    return width, excluded_xsec
+
+################################################################################
+##### Histogram helpers following the TH1 conventions (GetQuantiles, Rebin)
+def _quantiles(contents, edges, probabilities:list)->list:
+    # as TH1::GetQuantiles, with linear interpolation inside the bins
+    n_bins = len(contents)
+    integral = np.concatenate([[0.0], np.cumsum(contents)])
+    if integral[-1] <= 0:
+        return [0.0] * len(probabilities)
+    integral = integral / integral[-1]
+    quantiles = list()
+    for probability in probabilities:
+        i_bin = int(np.searchsorted(integral[:n_bins], probability, side="right")) - 1
+        i_bin = max(i_bin, 0)
+        while i_bin < n_bins - 1 and integral[i_bin + 1] == probability:
+            if integral[i_bin + 2] == probability:
+                i_bin += 1
+            else:
+                break
+        quantile = edges[i_bin]
+        step = integral[i_bin + 1] - integral[i_bin]
+        if probability - integral[i_bin] > 0 and step > 0:
+            quantile += (edges[i_bin + 1] - edges[i_bin]) * (probability - integral[i_bin]) / step
+        quantiles.append(float(quantile))
+    return quantiles
+
+def _rebin(contents, edges, rebin_factor:int):
+    n_bins = (len(contents) // rebin_factor) * rebin_factor
+    return contents[:n_bins].reshape(-1, rebin_factor).sum(axis=1), edges[:n_bins + 1:rebin_factor]
+
+class HistogramTruncationWindow:
+    """
+    Mass window, width and mean mass of a truncated signal for a truncation
+    method, computed from a binned mjj distribution. It is used both in the
+    event loop (run_reinterpretation in modules/process_sample.py) and for
+    the saved histograms, so the two always give the same windows.
+     - the default method uses a window of [0.8 * M, 1.2 * M] where M is the signal mass, as suggested in 
+       Appendix A.1 of arXiv:1407.1376
+     - the generic method uses a window of [(1 - factor) * M, (1 + factor) * M] where factor is a user-defined 
+       parameter, which could be set to 0.2 to match the default method, but could also be varied to study the 
+       impact of the mass window choice on the limits
+     - the quantile method uses the +/- 2 sigma quantiles to define the window, half of the +/- 1 sigma quantiles 
+       window to define sigma, and the median in the truncated window to estimate the mean mass
+     - the mode method defines the window around the peak of the mjj spectrum. The width of the window on each 
+       side of the peak is twice the distance between the peak and the point that encloses 34.13% of the distribution 
+       (measured wrt the peak) calculated on the side of the distribution with the largest tail. The mean mass is 
+       estimated as the mode of the truncated distribution.
+     - the mode_XY method defines the window as in the generic_XY method but uses the mode instead of the mean in 
+       the window to estimate the average mass of the truncated signal
+
+    Parameters
+    ----------
+    method_name : str
+        Truncation method, one of TRUNCATION_METHODS.
+    signal_mass : float
+        Pole mass of the signal in GeV.
+    contents : np.ndarray
+        Bin contents of the mjj histogram, without under- and overflow.
+    edges : np.ndarray
+        Bin edges of the mjj histogram.
+    """
+
+    def __init__(self, method_name:str, signal_mass:float, contents, edges):
+        self.method_name = method_name
+        self.signal_mass = signal_mass
+        self.contents = np.asarray(contents, dtype=np.float64)
+        self.edges = np.asarray(edges, dtype=np.float64)
+        self.centers = 0.5 * (self.edges[1:] + self.edges[:-1])
+
+        if self.method_name == "default":
+            self.window = self._generic_window(factor=0.2)
+            self.sigma = self._generic_sigma(self.window)
+            self.mean = self._window_mean(self.window)
+        elif "generic" in self.method_name:
+            factor = float(re.findall(r"generic_(\d+)", self.method_name)[0]) / 100.0
+            self.window = self._generic_window(factor=factor)
+            self.sigma = self._generic_sigma(self.window)
+            self.mean = self._window_mean(self.window)
+        elif "quantile" in self.method_name:
+            self.window = self._quantile_window()
+            # half of the +/- 1 sigma quantile window
+            window = self._quantile_window(quantile=0.6826)
+            self.sigma = (window[1] - window[0]) / 2.0
+            truncated = np.where(self.window_mask(self.window), self.contents, 0.0)
+            self.mean = round(_quantiles(truncated, self.edges, [0.5])[0]) if truncated.sum() > 0 else 0
+        elif self.method_name == "mode":
+            self.mean, self.sigma, self.window = self._mode_parameters()
+        elif "mode" in self.method_name:
+            factor = float(re.findall(r"mode_(\d+)", self.method_name)[0]) / 100.0
+            self.window = self._generic_window(factor=factor)
+            self.sigma = self._generic_sigma(self.window)
+            self.mean = self._window_mean(self.window, use_mode=True)
+        else:
+            raise ValueError(f"truncation method {self.method_name} not recognised, should be one of {TRUNCATION_METHODS}")
+
+        logger.debug(
+            "%s truncation for signal mass %s: window = %s, mean = %s, sigma = %s",
+            self.method_name, self.signal_mass, self.window, self.mean, self.sigma
+        )
+
+    def get_window(self):
+        return self.window
+
+    def get_sigma(self):
+        return self.sigma
+
+    def get_mean(self):
+        return self.mean
+
+    def window_mask(self, window:list):
+        # the bins inside mjj > window[0] && mjj < window[1]
+        return (self.edges[:-1] >= window[0]) & (self.edges[1:] <= window[1])
+
+    def _generic_window(self, factor:float=0.2):
+        return [ceil(self.signal_mass*(1-factor)), floor(self.signal_mass*(1+factor))]
+
+    def _generic_sigma(self, window:list):
+        # the window is roughly +/- 2 sigma around the mean
+        return (window[1] - window[0]) / 5.0
+
+    def _window_mean(self, window:list, use_mode:bool=False, rebin_factor:int=10):
+        truncated = np.where(self.window_mask(window), self.contents, 0.0)
+        if truncated.sum() <= 0:
+            return 0.0
+        if use_mode:
+            rebinned, edges = _rebin(truncated, self.edges, rebin_factor)
+            mode_bin = int(np.argmax(rebinned))
+            return float(0.5 * (edges[mode_bin] + edges[mode_bin + 1]))
+        return float(np.sum(truncated * self.centers) / np.sum(truncated))
+
+    def _quantile_window(self, quantile:float=0.9545):
+        quantile_left = (1 - quantile) / 2
+        quantile_right = 1 - quantile_left
+        values = _quantiles(self.contents, self.edges, [quantile_left, quantile_right])
+        return [ceil(values[0]), floor(values[1])]
+
+    def _mode_parameters(self, rebin_factor:int=10):
+        rebinned, edges = _rebin(self.contents, self.edges, rebin_factor)
+        centers = 0.5 * (edges[1:] + edges[:-1])
+        total = rebinned.sum()
+        if total <= 0:
+            return 0.0, 0.0, [0, 0]
+        rebinned = rebinned / total
+
+        mode_bin = int(np.argmax(rebinned))
+        # move from the mode towards the side with the larger tail until
+        # 34.13% of the distribution is enclosed
+        direction = -1 if rebinned[:mode_bin].sum() > rebinned[mode_bin + 1:].sum() else 1
+        one_sigma_bin = mode_bin
+        while 0 <= one_sigma_bin < len(rebinned):
+            low, high = sorted([mode_bin, one_sigma_bin])
+            if rebinned[low:high + 1].sum() >= 0.3413:
+                break
+            one_sigma_bin += direction
+        one_sigma_bin = min(max(one_sigma_bin, 0), len(rebinned) - 1)
+
+        sigma = abs(centers[mode_bin] - centers[one_sigma_bin])
+        window = [ceil(centers[mode_bin] - 2*sigma), floor(centers[mode_bin] + 2*sigma)]
+        return float(centers[mode_bin]), float(sigma), window
+
+def reinterpret_histogram(
+    gauss_limit,
+    signal_mass:float,
+    data_dict:dict,
+    contents,
+    edges,
+    truncation_method:str="default",
+    weight_contents=None,
+    variation_contents:dict=None,
+):
+    """
+    Add the reinterpretation results of a signal region to its acceptance
+    dictionary from its binned mjj distribution, for the event loop
+    (run_reinterpretation in modules/process_sample.py) and the saved
+    histograms.
+
+    Parameters
+    ----------
+    contents : np.ndarray
+        Bin contents of the mjj histogram including the under- and overflow
+        bins, so that the total sum of weights is that of all selected events.
+    edges : np.ndarray
+        Bin edges of the mjj histogram.
+    weight_contents : np.ndarray, optional
+        Bin contents with the under- and overflow bins of the mjj histogram
+        of each weight of the weight vector, with shape [bin, weight].
+    variation_contents : dict, optional
+        Bin contents with the under- and overflow bins of the mjj histogram
+        of each systematic variation, keyed like the systematics block of
+        data_dict.
+    """
+    # the quantile and mode windows are computed from the histogram without its
+    # overflow, so they only match the event loop if the histogram covers the same range
+    if contents[-1] > 0 and edges[-1] < TRUNCATION_MAX_MASS and ("quantile" in truncation_method or truncation_method == "mode"):
+        logger.warning(
+            "mjj histogram ends at %s GeV with %s of the sum of weights above it, the %s window "
+            "will differ from the event loop, which uses the distribution up to %s GeV",
+            edges[-1], contents[-1] / np.sum(contents), truncation_method, TRUNCATION_MAX_MASS
+        )
+    truncation = HistogramTruncationWindow(truncation_method, signal_mass, contents[1:-1], edges)
+    mass_window = truncation.get_window()
+    sigma = truncation.get_sigma()
+    mean_mass = truncation.get_mean()
+
+    in_window = np.concatenate([[False], truncation.window_mask(mass_window), [False]])
+    sumW_total = float(np.sum(contents))
+    fraction_in_window = float(np.sum(contents[in_window])) / sumW_total if sumW_total > 0 else 0.0
+    logger.info(
+        "fraction of events in mass window between %s GeV and %s GeV is %s",
+        mass_window[0], mass_window[1], fraction_in_window
+    )
+
+    data_dict["mjj_window_acceptance"] = fraction_in_window
+    data_dict["mjj_window"] = mass_window
+    if "expected_xsec_pb" in data_dict:
+        modified_acceptance_xsec = data_dict["expected_xsec_pb"] * fraction_in_window
+    else:
+        modified_acceptance_xsec = None
+        logger.warning("expected_xsec_pb not found in data_dict, cannot calculate modified expected cross-section!")
+    data_dict["truncation_method"] = truncation_method
+    data_dict["mean_window_mass"] = mean_mass
+    data_dict["modified_expected_xsec_pb"] = modified_acceptance_xsec
+
+    # the window, width and mean mass are kept at their nominal values so only
+    # the fraction of events in the window changes for each variation
+    if variation_contents is not None:
+        for variation, variation_dict in data_dict.get("systematics", dict()).items():
+            varied_contents = variation_contents.get(variation, contents)
+            variation_total = float(np.sum(varied_contents))
+            variation_fraction = float(np.sum(varied_contents[in_window])) / variation_total if variation_total > 0 else 0.0
+            variation_dict["mjj_window_acceptance"] = variation_fraction
+            variation_dict["modified_expected_xsec_pb"] = variation_dict["expected_xsec_pb"] * variation_fraction
+
+    if weight_contents is not None and "weight_variations" in data_dict:
+        window_sums = weight_contents[in_window].sum(axis=0)
+        total_sums = weight_contents.sum(axis=0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            window_fractions = np.where(total_sums > 0, window_sums / total_sums, 0.0)
+        modified_xsecs = np.array(data_dict["weight_variations"]["expected_xsec_pb"]) * window_fractions
+        data_dict["weight_variations"]["mjj_window_acceptance"] = window_fractions.tolist()
+        data_dict["weight_variations"]["modified_expected_xsec_pb"] = modified_xsecs.tolist()
+        data_dict["weight_variations"]["modified_expected_xsec_pb_envelope"] = envelope(modified_xsecs)
+
+    width, excluded_xsec = lookup_gaussian_limit(gauss_limit, sigma, mean_mass)
+    data_dict["width_pc"] = width
+    # the limit is the nominal one, it is not stored for the variations
+    # since only their acceptances change
+    data_dict["excluded_xsec_pb"] = excluded_xsec
+
+def load_acceptances(results_store:ResultsStore, input_dir:pathlib.Path, sample:str, analysis:str, prefix:str="")->dict:
+    """
+    Return the acceptances of a sample without reinterpretation from the
+    results store, or from the legacy JSON file if not in the store.
+    """
+    try:
+        return results_store.legacy_acceptances(sample, analysis, prefix=prefix)
+    except KeyError:
+        acceptance_file = input_dir / acceptance_file_name(sample, analysis, prefix=prefix)
+        if not acceptance_file.exists():
+            raise
+        with open(acceptance_file, "r") as f:
+            return json.load(f)
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="Run the reinterpretation with all truncation methods from the stored histograms and acceptances",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("-s", "--samples", type=str, nargs="+", required=True, help="Names of the samples, as given in data/samples.py")
+    parser.add_argument(
+        "-a",
+        "--analyses",
+        type=str,
+        nargs="+",
+        help="List of analyses (corresponding to module names in analyses/ with a limits module)",
+        default=["run2_atlas_tla_dijet"]
+    )
+    parser.add_argument("-i", "--input-dir", type=pathlib.Path, default=pathlib.Path("outputs"), help="Directory with the histogram and acceptance files")
+    parser.add_argument("-o", "--output-dir", type=pathlib.Path, default=None, help="Directory to save the acceptance files with reinterpretation (by default the input directory)")
+    parser.add_argument(
+        "-t",
+        "--truncation-methods",
+        type=str,
+        nargs="+",
+        choices=TRUNCATION_METHODS,
+        default=TRUNCATION_METHODS,
+        help="Truncation methods to run"
+    )
+    parser.add_argument("--histogram", type=str, default="h_mjj", help="Name of the mjj histogram in each signal region directory")
+    parser.add_argument(
+        "--results-store",
+        type=pathlib.Path,
+        default=None,
+        help="SQLite results store to read the acceptances from and add the reinterpreted ones to (by default results.sqlite in the input directory)"
+    )
+    parser.add_argument(
+        "--legacy-json",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Whether to also write the acceptances to one JSON file per sample, analysis and truncation method"
+    )
+    parser.add_argument(
+        "--file-prefix",
+        type=str,
+        default="",
+        help="Prefix of the input and output files (if empty string, no prefix is added)"
+    )
+
+    return parser.parse_args()
+
+def main():
+    args = get_args()
+    output_dir = args.output_dir or args.input_dir
+    if not args.input_dir.exists() or not output_dir.exists():
+        logger.error("input directory %s or output directory %s does not exist", args.input_dir, output_dir)
+        return 1
+
+    analysis_limits = dict()
+    for analysis_name in args.analyses:
+        try:
+            analysis_limits[analysis_name] = importlib.import_module(f"analyses.{analysis_name}_limits")
+        except ModuleNotFoundError:
+            logger.error("no limits module found for analysis %s!", analysis_name)
+            return 1
+
+    results_store = ResultsStore(args.results_store or args.input_dir / DEFAULT_STORE_NAME)
+    prefix = args.file_prefix + "_" if args.file_prefix != "" else ""
+    limits = dict()
+    n_failed = 0
+    for analysis_name in args.analyses:
+        for sample_name in args.samples:
+            if sample_name not in samples:
+                logger.error("sample %s not found in data/samples.py, skipping", sample_name)
+                n_failed += 1
+                continue
+            histogram_file = args.input_dir / f"{prefix}histograms_{sample_name}_{analysis_name}.root"
+            try:
+                sr_acceptances = load_acceptances(results_store, args.input_dir, sample_name, analysis_name, args.file_prefix)
+                with uproot.open(histogram_file) as infile:
+                    sr_histograms = dict()
+                    for sr in sr_acceptances:
+                        hist = infile[f"{sr}/{args.histogram}"]
+                        weight_key = f"{sr}/{args.histogram}_weights"
+                        sr_histograms[sr] = (
+                            hist.values(flow=True),
+                            hist.axis().edges(),
+                            # [bin, weight] without the flow bins of the weight axis
+                            infile[weight_key].values(flow=True)[:, 1:-1] if weight_key in infile else None,
+                        )
+            except (KeyError, FileNotFoundError) as error:
+                logger.error("cannot reinterpret sample %s for analysis %s: %s", sample_name, analysis_name, error)
+                n_failed += 1
+                continue
+
+            for truncation_method in args.truncation_methods:
+                method_acceptances = copy.deepcopy(sr_acceptances)
+                for sr, (contents, edges, weight_contents) in sr_histograms.items():
+                    if (analysis_name, sr) not in limits:
+                        limits[(analysis_name, sr)] = analysis_limits[analysis_name].get_limits(sr)
+                    reinterpret_histogram(
+                        limits[(analysis_name, sr)],
+                        samples[sample_name]["mass"],
+                        method_acceptances[sr],
+                        contents,
+                        edges,
+                        truncation_method=truncation_method,
+                        weight_contents=weight_contents,
+                    )
+
+                results_store.add_acceptances(
+                    sample_name, analysis_name, method_acceptances,
+                    truncation_method=truncation_method, prefix=args.file_prefix
+                )
+                if args.legacy_json:
+                    acceptance_file = output_dir / acceptance_file_name(sample_name, analysis_name, truncation_method, args.file_prefix)
+                    with open(acceptance_file, "w") as f:
+                        json.dump(method_acceptances, f, indent=4)
+            logger.info("reinterpreted sample %s for analysis %s with %s truncation methods", sample_name, analysis_name, len(args.truncation_methods))
+
+    return 0 if n_failed == 0 else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
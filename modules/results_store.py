@@ -0,0 +1,386 @@
+"""
+
+Single SQLite store of the acceptance and cutflow results of all samples.
+
+modules/process_sample.py adds one row per sample, analysis, signal region
+and truncation method to the acceptances table, and one row per cutflow
+step to the cutflows table, instead of the plotting scripts having to open
+one JSON file per combination. Rows are keyed by file prefix, sample,
+analysis, signal region and truncation method (empty if the reinterpretation
+was not run), so re-running a sample replaces its previous results.
+
+Every row keeps the full acceptance dictionary (including the systematics
+and weight variations blocks), so the legacy JSON files can be exported
+again, together with provenance information (time, git commit, host and
+command line).
+
+Concurrent jobs can write to the same store, each write being a single
+transaction. SQLite locking is not reliable on network file systems
+(e.g. EOS-FUSE), so the store should be kept on a local or shared POSIX disk.
+
+Example:
+python modules/results_store.py import outputs/*acceptances_*.json outputs/*cutflows_*.json
+python modules/results_store.py query --analysis run2_atlas_tla_dijet --truncation-method default
+python modules/results_store.py export outputs/legacy --analysis run2_atlas_tla_dijet
+
+store = ResultsStore("outputs/results.sqlite", read_only=True)
+store.acceptances(analysis="run2_atlas_tla_dijet", truncation_method=["default", "mode_15"])
+
+"""
+import sys
+import argparse
+import datetime
+import json
+import pathlib
+import re
+import socket
+import sqlite3
+import subprocess
+import pandas as pd
+from data.samples import samples
+from modules.logger_setup import logger
+
+DEFAULT_STORE_NAME = "results.sqlite"
+
+# columns of the acceptance dictionaries stored as typed columns for queries
+ACCEPTANCE_COLUMNS = [
+    "acceptance",
+    "acceptance_stat_uncertainty",
+    "expected_xsec_pb",
+    "expected_xsec_pb_stat_uncertainty",
+    "raw_events",
+    "effective_events",
+    "mjj_window_acceptance",
+    "mean_window_mass",
+    "width_pc",
+    "modified_expected_xsec_pb",
+    "excluded_xsec_pb",
+]
+KEY_COLUMNS = ["prefix", "sample", "analysis", "signal_region", "truncation_method"]
+PROVENANCE_COLUMNS = ["created", "git_commit", "host", "command"]
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS acceptances (
+    prefix TEXT NOT NULL,
+    sample TEXT NOT NULL,
+    analysis TEXT NOT NULL,
+    signal_region TEXT NOT NULL,
+    truncation_method TEXT NOT NULL,
+    mass REAL,
+    {", ".join(f"{column} REAL" for column in ACCEPTANCE_COLUMNS)},
+    mjj_window_low REAL,
+    mjj_window_high REAL,
+    record TEXT NOT NULL,
+    {", ".join(f"{column} TEXT" for column in PROVENANCE_COLUMNS)},
+    PRIMARY KEY ({", ".join(KEY_COLUMNS)})
+);
+CREATE INDEX IF NOT EXISTS acceptances_analysis ON acceptances (analysis, truncation_method, signal_region);
+CREATE TABLE IF NOT EXISTS cutflows (
+    prefix TEXT NOT NULL,
+    sample TEXT NOT NULL,
+    analysis TEXT NOT NULL,
+    signal_region TEXT NOT NULL,
+    step_index INTEGER NOT NULL,
+    step TEXT NOT NULL,
+    sumW REAL,
+    {", ".join(f"{column} TEXT" for column in PROVENANCE_COLUMNS)},
+    PRIMARY KEY (prefix, sample, analysis, signal_region, step)
+);
+CREATE INDEX IF NOT EXISTS cutflows_analysis ON cutflows (analysis, signal_region);
+"""
+
+def provenance()->dict:
+    """
+    Return the time, git commit, host and command line of the current process.
+    """
+    try:
+        git_commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=pathlib.Path(__file__).resolve().parent
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        git_commit = None
+    return {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "git_commit": git_commit,
+        "host": socket.gethostname(),
+        "command": " ".join(sys.argv),
+    }
+
+def acceptance_file_name(sample:str, analysis:str, truncation_method:str="", prefix:str="")->str:
+    """
+    Return the name of the legacy acceptance JSON file written by modules/process_sample.py.
+    """
+    name = f"{prefix + '_' if prefix != '' else ''}acceptances_{sample}_{analysis}"
+    if truncation_method != "":
+        name += f"_{truncation_method}"
+    return name + ".json"
+
+def cutflow_file_name(sample:str, analysis:str, prefix:str="")->str:
+    return f"{prefix + '_' if prefix != '' else ''}cutflows_{sample}_{analysis}.json"
+
+def parse_file_name(file_name:str, analyses:list)->dict:
+    """
+    Return the prefix, kind (acceptances or cutflows), sample, analysis and truncation
+    method of a legacy JSON file name, or None if it does not match any known sample.
+    """
+    pattern = re.compile(
+        r"^(?:(?P<prefix>.+)_)?(?P<kind>acceptances|cutflows)_(?P<sample>{samples})_(?P<analysis>{analyses})(?:_(?P<method>.+))?\.json$".format(
+            samples="|".join(sorted(map(re.escape, samples), key=len, reverse=True)),
+            analyses="|".join(sorted(map(re.escape, analyses), key=len, reverse=True)),
+        )
+    )
+    match = pattern.match(file_name)
+    if match is None:
+        return None
+    return {
+        "prefix": match["prefix"] or "",
+        "kind": match["kind"],
+        "sample": match["sample"],
+        "analysis": match["analysis"],
+        "truncation_method": match["method"] or "",
+    }
+
+class ResultsStore:
+    """
+    Acceptance and cutflow results of all samples in a SQLite file.
+    """
+
+    def __init__(self, path, timeout:float=60.0, read_only:bool=False):
+        """
+        Open the store, creating it if needed. A read-only store (for the
+        query and plotting scripts) raises a FileNotFoundError if the file
+        does not exist instead of creating an empty store.
+        """
+        self.path = pathlib.Path(path)
+        if read_only:
+            if not self.path.is_file():
+                raise FileNotFoundError(
+                    f"results store {self.path} not found, import the existing acceptance and cutflow JSON files with "
+                    f"'python modules/results_store.py --store {self.path} import {self.path.parent}/*acceptances_*.json {self.path.parent}/*cutflows_*.json'"
+                )
+            self.connection = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, timeout=timeout)
+        else:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            # wait for concurrent writers instead of failing
+            self.connection = sqlite3.connect(self.path, timeout=timeout)
+            self.connection.executescript(SCHEMA)
+        self._provenance = None
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def provenance(self)->dict:
+        if self._provenance is None:
+            self._provenance = provenance()
+        return self._provenance
+
+    def add_acceptances(self, sample:str, analysis:str, sr_acceptances:dict, truncation_method:str="", prefix:str=""):
+        """
+        Add (or replace) the acceptances of a sample for each signal region,
+        as computed by cutflow_acceptances and run_reinterpretation.
+        """
+        rows = list()
+        for sr, data in sr_acceptances.items():
+            window = data.get("mjj_window") or [None, None]
+            rows.append({
+                "prefix": prefix,
+                "sample": sample,
+                "analysis": analysis,
+                "signal_region": sr,
+                "truncation_method": truncation_method or "",
+                "mass": samples.get(sample, dict()).get("mass"),
+                **{column: data.get(column) for column in ACCEPTANCE_COLUMNS},
+                "mjj_window_low": window[0],
+                "mjj_window_high": window[1],
+                "record": json.dumps(data),
+                **self.provenance,
+            })
+        self._insert("acceptances", rows)
+
+    def add_cutflows(self, sample:str, analysis:str, sr_cutflows:dict, prefix:str=""):
+        """
+        Add (or replace) the evaluated cutflows of a sample for each signal region.
+        """
+        rows = [
+            {
+                "prefix": prefix,
+                "sample": sample,
+                "analysis": analysis,
+                "signal_region": sr,
+                "step_index": i_step,
+                "step": step,
+                "sumW": sumW,
+                **self.provenance,
+            }
+            for sr, cutflow in sr_cutflows.items()
+            for i_step, (step, sumW) in enumerate(cutflow.items())
+        ]
+        # remove the steps of a previous cutflow in the same transaction
+        self._insert("cutflows", rows, delete=("prefix = ? AND sample = ? AND analysis = ?", (prefix, sample, analysis)))
+
+    def _insert(self, table:str, rows:list, delete:tuple=None):
+        with self.connection:
+            if delete is not None:
+                self.connection.execute(f"DELETE FROM {table} WHERE {delete[0]}", delete[1])
+            if len(rows) == 0:
+                return
+            columns = list(rows[0].keys())
+            self.connection.executemany(
+                f"INSERT OR REPLACE INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})",
+                [tuple(row[column] for column in columns) for row in rows]
+            )
+
+    def query(self, table:str, columns:list=None, **filters)->pd.DataFrame:
+        """
+        Return the rows of a table matching the filters as a DataFrame.
+
+        Each filter is a column name with a single value or a list of values, e.g.
+        query("acceptances", analysis="run2_atlas_tla_dijet", signal_region=["J50", "J100"]).
+        """
+        conditions, parameters = list(), list()
+        for column, value in filters.items():
+            values = list(value) if isinstance(value, (list, tuple, set)) else [value]
+            conditions.append(f"{column} IN ({', '.join('?' for _ in values)})")
+            parameters += values
+        statement = f"SELECT {', '.join(columns) if columns else '*'} FROM {table}"
+        if len(conditions) > 0:
+            statement += " WHERE " + " AND ".join(conditions)
+        return pd.read_sql_query(statement, self.connection, params=parameters)
+
+    def acceptances(self, **filters)->pd.DataFrame:
+        """
+        Return the acceptances matching the filters sorted by sample mass.
+        """
+        frame = self.query("acceptances", **filters)
+        # columns that are missing for all rows (e.g. without reinterpretation) are read as None
+        numeric = ["mass", "mjj_window_low", "mjj_window_high"] + ACCEPTANCE_COLUMNS
+        frame[numeric] = frame[numeric].apply(pd.to_numeric, errors="coerce")
+        return frame.sort_values(["analysis", "signal_region", "truncation_method", "mass"], ignore_index=True)
+
+    def cutflows(self, **filters)->pd.DataFrame:
+        frame = self.query("cutflows", **filters)
+        return frame.sort_values(["sample", "analysis", "signal_region", "step_index"], ignore_index=True)
+
+    def legacy_acceptances(self, sample:str, analysis:str, truncation_method:str="", prefix:str="")->dict:
+        """
+        Return the acceptances of a sample in the format of the legacy JSON files.
+        """
+        frame = self.query(
+            "acceptances", ["signal_region", "record"],
+            sample=sample, analysis=analysis, truncation_method=truncation_method, prefix=prefix
+        )
+        if frame.empty:
+            raise KeyError(f"no acceptances for sample {sample}, analysis {analysis} and truncation method {truncation_method!r} in {self.path}")
+        return {row.signal_region: json.loads(row.record) for row in frame.itertuples()}
+
+    def legacy_cutflows(self, sample:str, analysis:str, prefix:str="")->dict:
+        frame = self.cutflows(sample=sample, analysis=analysis, prefix=prefix)
+        sr_cutflows = dict()
+        for row in frame.itertuples():
+            sr_cutflows.setdefault(row.signal_region, dict())[row.step] = row.sumW
+        return sr_cutflows
+
+    def export_json(self, output_dir, **filters)->list:
+        """
+        Write the legacy acceptance and cutflow JSON files of the results
+        matching the filters and return the paths written.
+        """
+        output_dir = pathlib.Path(output_dir)
+        written = list()
+        keys = self.query("acceptances", ["prefix", "sample", "analysis", "truncation_method"], **filters).drop_duplicates()
+        for key in keys.itertuples():
+            path = output_dir / acceptance_file_name(key.sample, key.analysis, key.truncation_method, key.prefix)
+            with open(path, "w") as f:
+                json.dump(self.legacy_acceptances(key.sample, key.analysis, key.truncation_method, key.prefix), f, indent=4)
+            written.append(path)
+
+        cutflow_filters = {column: value for column, value in filters.items() if column != "truncation_method"}
+        keys = self.query("cutflows", ["prefix", "sample", "analysis"], **cutflow_filters).drop_duplicates()
+        for key in keys.itertuples():
+            path = output_dir / cutflow_file_name(key.sample, key.analysis, key.prefix)
+            with open(path, "w") as f:
+                json.dump(self.legacy_cutflows(key.sample, key.analysis, key.prefix), f, indent=4)
+            written.append(path)
+        return written
+
+    def import_json(self, paths:list, analyses:list)->int:
+        """
+        Add the results of legacy acceptance and cutflow JSON files to the store
+        and return the number of files imported.
+        """
+        n_imported = 0
+        for path in map(pathlib.Path, paths):
+            key = parse_file_name(path.name, analyses)
+            if key is None:
+                logger.warning("could not identify the sample and analysis of %s, skipping", path)
+                continue
+            with open(path, "r") as f:
+                data = json.load(f)
+            if key["kind"] == "acceptances":
+                self.add_acceptances(key["sample"], key["analysis"], data, key["truncation_method"], key["prefix"])
+            else:
+                self.add_cutflows(key["sample"], key["analysis"], data, key["prefix"])
+            n_imported += 1
+        return n_imported
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Import, query and export the results store",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("--store", type=pathlib.Path, default=pathlib.Path("outputs") / DEFAULT_STORE_NAME, help="Path of the results store")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    import_parser = subparsers.add_parser("import", help="Add legacy acceptance and cutflow JSON files to the store")
+    import_parser.add_argument("files", type=pathlib.Path, nargs="+", help="JSON files to import")
+
+    for name, help_text in [("query", "Print the acceptances matching the filters"), ("export", "Write the legacy JSON files matching the filters")]:
+        subparser = subparsers.add_parser(name, help=help_text)
+        if name == "export":
+            subparser.add_argument("output_dir", type=pathlib.Path, help="Directory to write the JSON files to")
+        subparser.add_argument("--sample", type=str, nargs="+", default=None, help="Samples to select")
+        subparser.add_argument("--analysis", type=str, nargs="+", default=None, help="Analyses to select")
+        subparser.add_argument("--signal-region", type=str, nargs="+", default=None, help="Signal regions to select")
+        subparser.add_argument("--truncation-method", type=str, nargs="+", default=None, help="Truncation methods to select")
+        subparser.add_argument("--prefix", type=str, nargs="+", default=None, help="File prefixes to select")
+    args = parser.parse_args()
+
+    try:
+        store = ResultsStore(args.store, read_only=args.command != "import")
+    except FileNotFoundError as error:
+        logger.error(error)
+        return 1
+
+    with store:
+        if args.command == "import":
+            analyses = [path.stem for path in pathlib.Path("analyses").glob("*.py") if not path.stem.endswith("_limits") and path.stem != "__init__"]
+            n_imported = store.import_json(args.files, analyses)
+            logger.info("imported %s of %s files into %s", n_imported, len(args.files), args.store)
+            return 0
+
+        filters = {
+            column: getattr(args, column)
+            for column in ["sample", "analysis", "signal_region", "truncation_method", "prefix"]
+            if getattr(args, column) is not None
+        }
+        if args.command == "query":
+            columns = KEY_COLUMNS + ["mass"] + ACCEPTANCE_COLUMNS
+            print(store.acceptances(**filters)[columns].to_string(index=False))
+        else:
+            if not args.output_dir.exists():
+                logger.error("output directory %s does not exist", args.output_dir)
+                return 1
+            written = store.export_json(args.output_dir, **filters)
+            logger.info("wrote %s JSON files to %s", len(written), args.output_dir)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,268 @@
+"""
+
+Catalogue of the generated samples.
+
+Wraps the sample definitions in data/samples.py, where the ntuple of a
+sample can be given as a single path, a glob pattern or a list of paths
+and patterns. All the files of a sample are opened together as a chain,
+and the patterns are only resolved when the files of a sample are first
+requested.
+
+The size, modification time, number of entries and (optionally) adler32
+checksum of each file are cached in an index file, so unchanged files do
+not need to be opened again. The files are validated concurrently with a
+thread pool since each stat or open on EOS-FUSE can be slow.
+
+If a staging cache is configured (see modules/staging_cache.py), the files
+returned for each sample are local copies of the remote files. They are
+kept in the cache until they are released (see release).
+
+Example:
+python modules/sample_catalogue.py -s all -w 16 --checksum
+
+"""
+import sys
+import argparse
+import glob
+import json
+import os
+import pathlib
+import re
+import tempfile
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import uproot
+from data.samples import samples
+from modules.logger_setup import logger
+from modules.staging_cache import StagingCache
+
+DEFAULT_INDEX_PATH = pathlib.Path(__file__).resolve().parent.parent / "data" / "sample_index.json"
+CHECKSUM_BLOCK_SIZE = 16 * 1024 * 1024
+
+def adler32_checksum(path:str)->str:
+    """
+    Return the adler32 checksum of a file as used by EOS and xrootd.
+    """
+    checksum = 1
+    with open(path, "rb") as f:
+        while block := f.read(CHECKSUM_BLOCK_SIZE):
+            checksum = zlib.adler32(block, checksum)
+    return f"{checksum:08x}"
+
+class SampleCatalogue:
+    """
+    Lazily resolved view of the samples in data/samples.py keyed by
+    sample ID, or by model and mass.
+    """
+
+    def __init__(self, definitions:dict=samples, index_path=DEFAULT_INDEX_PATH, tree_name:str="Delphes", staging:StagingCache=None):
+        self.definitions = definitions
+        self.index_path = pathlib.Path(index_path)
+        self.tree_name = tree_name
+        self.staging = staging
+        self._files = dict()
+        self._index = None
+        self._lock = threading.Lock()
+
+    def __contains__(self, sample_id:str):
+        return sample_id in self.definitions
+
+    def __getitem__(self, sample_id:str)->dict:
+        return self.definitions[sample_id]
+
+    def sample_ids(self)->list:
+        return list(self.definitions.keys())
+
+    def model(self, sample_id:str)->str:
+        """
+        Return the model of a sample, given by the model field if defined
+        or otherwise by the sample ID without the mass suffix.
+        """
+        return self.definitions[sample_id].get("model", re.sub(r"_m(med|zp)\d+$", "", sample_id))
+
+    def find(self, model:str, mass:float)->str:
+        """
+        Return the ID of the sample for a given model and mass.
+        """
+        for sample_id, definition in self.definitions.items():
+            if self.model(sample_id) == model and definition.get("mass") == mass:
+                return sample_id
+        raise KeyError(f"no sample found for model {model} with mass {mass}")
+
+    def files(self, sample_id:str)->list:
+        """
+        Return the list of ntuple files to read for a sample, staging them
+        to the local cache first if one is configured.
+        """
+        files = self.remote_files(sample_id)
+        if self.staging is None:
+            return files
+        return [
+            self.staging.stage(
+                path,
+                expected_size=self.index.get(path, dict()).get("size"),
+                expected_checksum=self.index.get(path, dict()).get("checksum"),
+            )
+            for path in files
+        ]
+
+    def release(self, sample_id:str=None):
+        """
+        Release the staged files of a sample (of all the samples by default)
+        once they are no longer read, so that the staging cache can evict them.
+        """
+        if self.staging is None:
+            return
+        if sample_id is None:
+            self.staging.release()
+        else:
+            self.staging.release([self.staging.local_path(path) for path in self.remote_files(sample_id)])
+
+    def remote_files(self, sample_id:str)->list:
+        """
+        Return the list of ntuple files of a sample, expanding any glob patterns.
+        """
+        if sample_id not in self._files:
+            ntuples = self.definitions[sample_id]["ntuple"]
+            patterns = [ntuples] if isinstance(ntuples, str) else list(ntuples)
+            files = list()
+            for pattern in patterns:
+                if glob.has_magic(pattern) and "://" not in pattern:
+                    matches = sorted(glob.glob(pattern))
+                    if len(matches) == 0:
+                        logger.warning("pattern %s of sample %s does not match any file", pattern, sample_id)
+                    files += matches
+                else:
+                    files.append(pattern)
+            self._files[sample_id] = files
+        return self._files[sample_id]
+
+    ################################################################################
+    ##### File index
+    @property
+    def index(self)->dict:
+        if self._index is None:
+            self._index = dict()
+            if self.index_path.is_file():
+                with open(self.index_path, "r") as f:
+                    self._index = json.load(f)
+        return self._index
+
+    def save_index(self):
+        """
+        Write the index atomically so that concurrent jobs never read a partial file.
+        """
+        self.index_path.parent.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            fd, tmp_path = tempfile.mkstemp(dir=self.index_path.parent, prefix=f".{self.index_path.name}.")
+            with os.fdopen(fd, "w") as f:
+                json.dump(self.index, f, indent=4, sort_keys=True)
+            os.replace(tmp_path, self.index_path)
+
+    def inspect_file(self, path:str, checksum:bool=False)->dict:
+        """
+        Return the index record of a file, only opening it if it changed since it was last indexed.
+        """
+        with self._lock:
+            cached = dict(self.index.get(path, dict()))
+
+        record = {"path": path, "exists": True}
+        if "://" not in path:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return {"path": path, "exists": False}
+            record.update({"size": stat.st_size, "mtime": stat.st_mtime})
+            unchanged = cached.get("size") == record["size"] and cached.get("mtime") == record["mtime"]
+            if unchanged:
+                record["entries"] = cached.get("entries")
+                record["checksum"] = cached.get("checksum")
+
+        try:
+            if record.get("entries") is None:
+                with uproot.open(path) as infile:
+                    record["entries"] = int(infile[self.tree_name].num_entries)
+            if checksum and record.get("checksum") is None and "://" not in path:
+                record["checksum"] = adler32_checksum(path)
+        except Exception as error:
+            logger.error("could not read %s: %s", path, error)
+            record["exists"] = False
+            return record
+
+        with self._lock:
+            self.index[path] = {key: value for key, value in record.items() if key not in ["path", "exists"]}
+        return record
+
+    def validate(self, sample_ids:list, workers:int=8, checksum:bool=False)->dict:
+        """
+        Check that all the files of the given samples exist and can be read,
+        inspecting the files concurrently and updating the index.
+
+        Returns
+        -------
+        dict
+            For each sample, the file records, the total number of entries
+            and whether all the files are valid.
+        """
+        sample_files = {sample_id: self.remote_files(sample_id) for sample_id in sample_ids}
+        all_files = sorted({path for files in sample_files.values() for path in files})
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            records = dict(zip(all_files, executor.map(lambda path: self.inspect_file(path, checksum), all_files)))
+        self.save_index()
+
+        report = dict()
+        for sample_id, files in sample_files.items():
+            sample_records = [records[path] for path in files]
+            report[sample_id] = {
+                "files": sample_records,
+                "entries": sum(record.get("entries") or 0 for record in sample_records),
+                "valid": len(files) > 0 and all(record["exists"] for record in sample_records),
+            }
+            if not report[sample_id]["valid"]:
+                missing = [record["path"] for record in sample_records if not record["exists"]]
+                logger.error("sample %s has missing or unreadable files: %s", sample_id, missing if missing else "no files found")
+        return report
+
+    def entries(self, sample_id:str)->int:
+        """
+        Return the total number of entries of a sample from the index, validating it if needed.
+        """
+        files = self.remote_files(sample_id)
+        if not all(self.index.get(path, dict()).get("entries") is not None for path in files):
+            self.validate([sample_id])
+        return sum(self.index.get(path, dict()).get("entries") or 0 for path in files)
+
+# shared catalogue of the samples in data/samples.py, staged to the
+# cache configured in the environment if any
+catalogue = SampleCatalogue(staging=StagingCache.from_environment())
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Validate the samples in data/samples.py and update the sample index",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("-s", "--samples", type=str, nargs="+", default=["all"], help="Sample IDs to validate, or all")
+    parser.add_argument("-w", "--workers", type=int, default=8, help="Number of threads used to inspect the files")
+    parser.add_argument("--checksum", action="store_true", default=False, help="Whether to also compute the adler32 checksum of each file")
+    parser.add_argument("--index", type=pathlib.Path, default=DEFAULT_INDEX_PATH, help="Path of the index file")
+    args = parser.parse_args()
+
+    sample_catalogue = SampleCatalogue(index_path=args.index)
+    sample_ids = sample_catalogue.sample_ids() if "all" in args.samples else args.samples
+    unknown = [sample_id for sample_id in sample_ids if sample_id not in sample_catalogue]
+    if len(unknown) > 0:
+        logger.error("samples %s not found in data/samples.py", unknown)
+        return 1
+
+    report = sample_catalogue.validate(sample_ids, workers=args.workers, checksum=args.checksum)
+    for sample_id, sample_report in report.items():
+        logger.info(
+            "%s: %s files, %s entries, %s",
+            sample_id, len(sample_report["files"]), sample_report["entries"],
+            "valid" if sample_report["valid"] else "INVALID"
+        )
+    return 0 if all(sample_report["valid"] for sample_report in report.values()) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,130 @@
+"""
+
+Ledger of the random seeds of split event generation jobs.
+
+When the events of a mass point are split over several jobs (see
+--events-per-job in utils/submit_jobs.py and utils/submit_pythia.py), each
+job (part) gets its own seed, used as the MadGraph iseed or the Pythia8
+Random:seed. The seeds are allocated in turn from a single JSON ledger, so
+they never overlap between mass points, generators or submissions. The
+seed of a part already in the ledger is returned again, so a failed part
+can be resubmitted and reproduces the same events.
+
+The ledger also records the number of events, output directory, output
+file pattern and cross-section info file of each part, which are used by
+modules/merge_job_parts.py to check that all the parts are complete.
+
+Example:
+python modules/seed_ledger.py -l run/seed_ledger.json -j dmsimp
+
+"""
+import sys
+import argparse
+import json
+import os
+import pathlib
+import tempfile
+from modules.logger_setup import logger
+from modules.staging_cache import file_lock
+
+DEFAULT_LEDGER_NAME = "seed_ledger.json"
+# Pythia8 accepts seeds up to 900000000 and MadGraph up to 30081*30081
+MAX_SEED = 900000000
+
+def part_key(job_id:str, mass, part:int)->str:
+    return f"{job_id}:{mass}:{part}"
+
+def split_events(nevents:int, events_per_job:int)->list:
+    """
+    Return the number of events of each part when splitting nevents into
+    jobs of events_per_job events (the last part gets the remainder).
+    """
+    n_full, remainder = divmod(nevents, events_per_job)
+    return [events_per_job] * n_full + ([remainder] if remainder > 0 else [])
+
+class SeedLedger:
+    """
+    Seeds of the parts of split generation jobs, keyed by job ID, mass and
+    part index (starting from 1).
+    """
+
+    def __init__(self, path=DEFAULT_LEDGER_NAME):
+        self.path = pathlib.Path(path)
+
+    def load(self)->dict:
+        if not self.path.is_file():
+            return dict()
+        with open(self.path, "r") as f:
+            return json.load(f)
+
+    def _save(self, entries:dict):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.path.parent, prefix=f".{self.path.name}.")
+        with os.fdopen(fd, "w") as f:
+            json.dump(entries, f, indent=4, sort_keys=True)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, self.path)
+
+    def allocate(self, parts:list)->list:
+        """
+        Allocate the seeds of the given parts and return them in the same order.
+
+        Each part is a dictionary with at least the job_id, mass, part,
+        generator and nevents, and is stored in the ledger with its seed.
+        A part already in the ledger keeps its seed, but raises a ValueError
+        if it was recorded with another generator or number of events since
+        the seeds of the other parts could then overlap with its events.
+        """
+        seeds = list()
+        with file_lock(f"{self.path}.lock"):
+            entries = self.load()
+            next_seed = max([entry["seed"] for entry in entries.values()], default=0) + 1
+            for part in parts:
+                key = part_key(part["job_id"], part["mass"], part["part"])
+                if key in entries:
+                    recorded = entries[key]
+                    if recorded["generator"] != part["generator"] or recorded["nevents"] != part["nevents"]:
+                        raise ValueError(
+                            f"part {key} is already in {self.path} with {recorded['nevents']} {recorded['generator']} events, "
+                            f"cannot resubmit it with {part['nevents']} {part['generator']} events"
+                        )
+                    logger.info("reusing seed %s of part %s", recorded["seed"], key)
+                    seeds.append(recorded["seed"])
+                    continue
+                if next_seed > MAX_SEED:
+                    raise ValueError(f"no seeds left in {self.path}")
+                entries[key] = dict(part, seed=next_seed)
+                seeds.append(next_seed)
+                next_seed += 1
+            self._save(entries)
+        return seeds
+
+    def parts(self, job_id:str, mass=None)->list:
+        """
+        Return the parts of a job ID (and mass) sorted by mass and part index.
+        """
+        entries = [
+            entry for entry in self.load().values()
+            if entry["job_id"] == job_id and (mass is None or entry["mass"] == mass)
+        ]
+        return sorted(entries, key=lambda entry: (entry["mass"], entry["part"]))
+
+def main():
+    parser = argparse.ArgumentParser(description="Print the seeds allocated to split event generation jobs")
+    parser.add_argument("-l", "--ledger", type=pathlib.Path, default=pathlib.Path("run") / DEFAULT_LEDGER_NAME, help="Path of the seed ledger")
+    parser.add_argument("-j", "--job-id", type=str, required=True, help="Job ID of the submission")
+    args = parser.parse_args()
+
+    parts = SeedLedger(args.ledger).parts(args.job_id)
+    if len(parts) == 0:
+        logger.error("no parts of job ID %s in %s", args.job_id, args.ledger)
+        return 1
+    for entry in parts:
+        logger.info(
+            "mmed = %s part %s: seed %s, %s %s events, output %s",
+            entry["mass"], entry["part"], entry["seed"], entry["nevents"], entry["generator"], entry["output"]
+        )
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,265 @@
+"""
+
+Local staging cache for remote ntuples.
+
+Files on EOS (read over FUSE or xrootd) are copied to a local cache
+directory, normally on a local SSD, the first time they are used. Later
+uses read the local copy. Each copy is checked against the size and, when
+known from the sample index, the adler32 checksum of the remote file. The
+size, modification time and checksum of the remote file are recorded next
+to the copy, so a copy is only reused while they still match.
+
+The cache is shared between concurrent processes:
+- each file is copied under an exclusive lock on its own lock file, so
+  only one process copies it while the others wait and reuse the copy
+- the copy is written to a temporary file and renamed into place, so a
+  partial copy is never visible
+- a staged file is pinned with a shared lock on its lock file until it
+  is released (see release), or the process exits, so files in use by
+  any process (e.g. the earlier files of the chain being staged) are
+  never evicted
+- eviction runs under a lock on the whole cache and removes the least
+  recently used files that are not pinned until the total size is below
+  the configured cap
+
+The cache is enabled for all the samples of the catalogue through the
+--cache-dir option of the processing scripts, or by setting the
+SAMPLE_CACHE_DIR (and optionally SAMPLE_CACHE_SIZE_GB) environment variables.
+
+"""
+import fcntl
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from modules.logger_setup import logger
+
+DEFAULT_CACHE_SIZE_GB = 100.0
+LOCK_SUFFIX = ".lock"
+SOURCE_SUFFIX = ".source"
+
+@contextmanager
+def file_lock(path):
+    """
+    Hold an exclusive advisory lock on path for the duration of the context.
+    """
+    with open(path, "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+class StagingCache:
+    """
+    Local copies of remote files in cache_dir, limited to max_size_gb.
+    """
+
+    def __init__(self, cache_dir, max_size_gb:float=DEFAULT_CACHE_SIZE_GB):
+        self.cache_dir = pathlib.Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_size = int(max_size_gb * 1024**3)
+        self.cache_lock = self.cache_dir / f"cache{LOCK_SUFFIX}"
+        # open lock files holding a shared lock on the staged files in use
+        self._pins = dict()
+        self._pins_lock = threading.Lock()
+
+    @classmethod
+    def from_environment(cls):
+        """
+        Return the cache configured by the SAMPLE_CACHE_DIR and SAMPLE_CACHE_SIZE_GB
+        environment variables, or None if no cache directory is set.
+        """
+        cache_dir = os.environ.get("SAMPLE_CACHE_DIR")
+        if not cache_dir:
+            return None
+        return cls(cache_dir, float(os.environ.get("SAMPLE_CACHE_SIZE_GB", DEFAULT_CACHE_SIZE_GB)))
+
+    def local_path(self, remote_path:str)->pathlib.Path:
+        # prefix the file name with a hash of the full path since many samples
+        # share the same file names in different directories
+        digest = hashlib.sha1(remote_path.encode()).hexdigest()[:16]
+        return self.cache_dir / f"{digest}_{pathlib.PurePosixPath(remote_path).name}"
+
+    def source_path(self, local_path:pathlib.Path)->pathlib.Path:
+        """
+        Return the path of the record of the remote file a copy was made from.
+        """
+        return self.cache_dir / f".{local_path.name}{SOURCE_SUFFIX}"
+
+    def _read_source(self, local_path:pathlib.Path)->dict:
+        try:
+            with open(self.source_path(local_path), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return dict()
+
+    def _write_source(self, local_path:pathlib.Path, source:dict):
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix=f".{local_path.name}.")
+        with os.fdopen(fd, "w") as f:
+            json.dump(source, f)
+        os.replace(tmp_path, self.source_path(local_path))
+
+    def _is_valid_copy(self, local_path:pathlib.Path, expected_size:int, remote_mtime:float, expected_checksum:str)->bool:
+        """
+        Return whether the local copy matches the remote file: same size and,
+        when known, same modification time and adler32 checksum.
+        """
+        # avoid circular import, the catalogue uses the cache
+        from modules.sample_catalogue import adler32_checksum
+
+        if not local_path.is_file():
+            return False
+        if expected_size is not None and local_path.stat().st_size != expected_size:
+            return False
+        source = self._read_source(local_path)
+        if remote_mtime is not None and source.get("mtime") != remote_mtime:
+            return False
+        if expected_checksum is not None:
+            if source.get("checksum") is None:
+                # copied before the checksum was indexed
+                source["checksum"] = adler32_checksum(local_path)
+                self._write_source(local_path, source)
+            if source["checksum"] != expected_checksum:
+                return False
+        return True
+
+    def cached_files(self)->list:
+        return [
+            path for path in self.cache_dir.iterdir()
+            if path.is_file() and not path.name.endswith(LOCK_SUFFIX) and not path.name.startswith(".")
+        ]
+
+    def size(self)->int:
+        return sum(path.stat().st_size for path in self.cached_files())
+
+    def evict(self, required:int=0):
+        """
+        Remove the least recently used files that are not in use until the
+        cache has room for required bytes.
+        """
+        with file_lock(self.cache_lock):
+            # the modification time is updated on every use (see stage)
+            files = sorted(self.cached_files(), key=lambda path: path.stat().st_mtime)
+            total = sum(path.stat().st_size for path in files)
+            for path in files:
+                if total + required <= self.max_size:
+                    break
+                # the lock file is kept so that concurrent stagers always lock the same file
+                with open(f"{path}{LOCK_SUFFIX}", "a") as lock_file:
+                    try:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        # pinned by a process using it (or being staged)
+                        logger.debug("not evicting %s from the staging cache, it is in use", path.name)
+                        continue
+                    logger.info("evicting %s from the staging cache", path.name)
+                    size = path.stat().st_size
+                    path.unlink(missing_ok=True)
+                    self.source_path(path).unlink(missing_ok=True)
+                    total -= size
+            if total + required > self.max_size:
+                logger.warning("staging cache is over its size limit, all the other files are in use")
+
+    def release(self, local_paths:list=None):
+        """
+        Unpin staged files (all of them by default) once they are no longer
+        read, so that they can be evicted.
+        """
+        with self._pins_lock:
+            paths = list(self._pins) if local_paths is None else [str(path) for path in local_paths]
+            for path in paths:
+                lock_file = self._pins.pop(path, None)
+                if lock_file is not None:
+                    # closing the file releases the lock
+                    lock_file.close()
+
+    def stage(self, remote_path:str, expected_size:int=None, expected_checksum:str=None)->str:
+        """
+        Return the path of the local copy of a remote file, copying it first if needed.
+
+        Parameters
+        ----------
+        remote_path : str
+            Path on EOS (FUSE) or xrootd URL of the file.
+        expected_size : int, optional
+            Size of the remote file, taken from the remote file itself when not given.
+        expected_checksum : str, optional
+            adler32 checksum of the remote file, as stored in the sample index.
+
+        The local copy stays pinned (it is not evicted) until it is released
+        with release or the process exits.
+        """
+        local_path = self.local_path(remote_path)
+        remote_mtime = None
+        if "://" not in remote_path:
+            remote_stat = os.stat(remote_path)
+            remote_mtime = remote_stat.st_mtime
+            if expected_size is None:
+                expected_size = remote_stat.st_size
+
+        with self._pins_lock:
+            if str(local_path) in self._pins and local_path.is_file():
+                # already staged and pinned by this process
+                os.utime(local_path)
+                return str(local_path)
+
+        lock_file = open(f"{local_path}{LOCK_SUFFIX}", "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if self._is_valid_copy(local_path, expected_size, remote_mtime, expected_checksum):
+                logger.debug("using staged copy %s of %s", local_path, remote_path)
+                os.utime(local_path)
+            elif expected_size is not None and expected_size > self.max_size:
+                logger.warning("file %s is larger than the staging cache, reading it remotely", remote_path)
+                lock_file.close()
+                return remote_path
+            else:
+                self._copy(remote_path, local_path, expected_size, remote_mtime, expected_checksum)
+            # keep a shared lock while the file is in use so that it is not evicted,
+            # the conversion releases the exclusive lock before taking the shared one
+            # so it is done under the cache lock, which evict holds while it runs
+            with file_lock(self.cache_lock):
+                fcntl.flock(lock_file, fcntl.LOCK_SH)
+        except BaseException:
+            lock_file.close()
+            raise
+        with self._pins_lock:
+            self._pins[str(local_path)] = lock_file
+        return str(local_path)
+
+    def _copy(self, remote_path:str, local_path:pathlib.Path, expected_size:int, remote_mtime:float, expected_checksum:str):
+        """
+        Copy a remote file into the cache, called with the lock of the file held.
+        """
+        # avoid circular import, the catalogue uses the cache
+        from modules.sample_catalogue import adler32_checksum
+
+        self.evict(required=expected_size or 0)
+
+        logger.info("staging %s to %s", remote_path, local_path)
+        start = time.time()
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix=f".{local_path.name}.")
+        os.close(fd)
+        try:
+            if "://" in remote_path:
+                subprocess.run(["xrdcp", "--force", "--silent", remote_path, tmp_path], check=True)
+            else:
+                shutil.copyfile(remote_path, tmp_path)
+
+            size = os.stat(tmp_path).st_size
+            if expected_size is not None and size != expected_size:
+                raise IOError(f"staged copy of {remote_path} has size {size} instead of {expected_size}")
+            if expected_checksum is not None and adler32_checksum(tmp_path) != expected_checksum:
+                raise IOError(f"staged copy of {remote_path} does not match checksum {expected_checksum}")
+            os.replace(tmp_path, local_path)
+            self._write_source(local_path, {"remote": remote_path, "size": size, "mtime": remote_mtime, "checksum": expected_checksum})
+        finally:
+            pathlib.Path(tmp_path).unlink(missing_ok=True)
+        logger.info("staged %s MB in %.1f s", round(size / 1024**2, 1), time.time() - start)
@@ -0,0 +1,256 @@
+"""
+
+Memory-mapped bank of the signal mjj templates of a mass scan.
+
+The per-signal-region mjj histograms of all the samples of a model are
+collected from the histogram files written by modules/process_sample.py or
+modules/array_backend.py into a single directory holding NumPy arrays:
+
+- values.npy: bin contents with shape [sample, signal region, bin]
+- variances.npy: sum of squared weights with the same shape
+- weight_values.npy (optional, with --weight-variations): contents of the
+  weight vector histograms with shape [sample, signal region, weight, bin]
+- index.json: the analysis, histogram name, bin edges, signal regions and
+  the list of samples with their masses, in the order of the arrays
+
+The arrays are written in the .npy format so they can be mapped read-only
+with np.load(mmap_mode="r"), see TemplateBank. Slicing the whole mass scan
+of a signal region then does not copy or reopen any ROOT file.
+
+Example:
+python modules/template_bank.py --model DMsimp -a run2_atlas_tla_dijet -i outputs -o outputs/template_banks
+
+"""
+import sys
+import argparse
+import json
+import os
+import pathlib
+import re
+import numpy as np
+import uproot
+from data.samples import samples
+from modules.logger_setup import logger
+
+INDEX_FILE = "index.json"
+VALUES_FILE = "values.npy"
+VARIANCES_FILE = "variances.npy"
+WEIGHT_VALUES_FILE = "weight_values.npy"
+
+DEFAULT_HISTOGRAM = "h_mjj"
+
+def sample_mass(sample:str)->float:
+    """
+    Return the mass of a sample from data/samples.py or, for samples not
+    listed there, from the mmed<mass> part of its name (NaN if neither).
+    """
+    if sample in samples and "mass" in samples[sample]:
+        return float(samples[sample]["mass"])
+    match = re.search(r"mmed(\d+(?:\.\d+)?)", sample)
+    return float(match.group(1)) if match is not None else np.nan
+
+def model_samples(model:str)->list:
+    """
+    Return the samples of a model in data/samples.py (named <model>_...)
+    sorted by mass.
+    """
+    return sorted([sample for sample in samples if sample.startswith(f"{model}_")], key=sample_mass)
+
+def bank_directory(output_dir, model:str, analysis:str, histogram:str=DEFAULT_HISTOGRAM)->pathlib.Path:
+    return pathlib.Path(output_dir) / f"template_bank_{model}_{analysis}_{histogram}"
+
+def build_template_bank(
+    sample_names:list,
+    analysis:str,
+    input_dir,
+    bank_dir,
+    histogram:str=DEFAULT_HISTOGRAM,
+    file_prefix:str="",
+    weight_variations:bool=False,
+)->dict:
+    """
+    Collect the histogram of every signal region of the given samples into
+    a template bank directory and return its index.
+
+    Samples without a histogram file are skipped. All the histograms must
+    have the same binning and signal regions. The index is written last,
+    so a bank without an index is incomplete.
+    """
+    input_dir = pathlib.Path(input_dir)
+    bank_dir = pathlib.Path(bank_dir)
+    prefix = file_prefix + "_" if file_prefix != "" else ""
+
+    files = dict()
+    for sample in sample_names:
+        histogram_file = input_dir / f"{prefix}histograms_{sample}_{analysis}.root"
+        if not histogram_file.exists():
+            logger.warning("no histogram file %s for sample %s, skipping it", histogram_file, sample)
+            continue
+        files[sample] = histogram_file
+    if len(files) == 0:
+        raise FileNotFoundError(f"no histogram files found for analysis {analysis} in {input_dir}")
+
+    # the signal regions, binning and number of weights from the first sample
+    with uproot.open(next(iter(files.values()))) as infile:
+        signal_regions = sorted({key.split("/")[0] for key in infile.keys(recursive=True, cycle=False) if "/" in key})
+        signal_regions = [sr for sr in signal_regions if f"{sr}/{histogram}" in infile]
+        if len(signal_regions) == 0:
+            raise KeyError(f"histogram {histogram} not found in any signal region of {next(iter(files.values()))}")
+        edges = infile[f"{signal_regions[0]}/{histogram}"].axis().edges()
+        n_weights = 0
+        if weight_variations:
+            weight_key = f"{signal_regions[0]}/{histogram}_weights"
+            if weight_key not in infile:
+                raise KeyError(f"no weight vector histogram {weight_key} in {next(iter(files.values()))}, was the sample processed with --weight-vector?")
+            n_weights = len(infile[weight_key].axis(1).edges()) - 1
+
+    bank_dir.mkdir(parents=True, exist_ok=True)
+    # an existing index would describe the arrays being overwritten
+    if (bank_dir / INDEX_FILE).exists():
+        os.remove(bank_dir / INDEX_FILE)
+
+    shape = (len(files), len(signal_regions), len(edges) - 1)
+    values = np.lib.format.open_memmap(bank_dir / VALUES_FILE, mode="w+", dtype=np.float64, shape=shape)
+    variances = np.lib.format.open_memmap(bank_dir / VARIANCES_FILE, mode="w+", dtype=np.float64, shape=shape)
+    weight_values = None
+    if weight_variations:
+        weight_values = np.lib.format.open_memmap(
+            bank_dir / WEIGHT_VALUES_FILE, mode="w+", dtype=np.float64,
+            shape=(len(files), len(signal_regions), n_weights, len(edges) - 1)
+        )
+
+    for i_sample, (sample, histogram_file) in enumerate(files.items()):
+        with uproot.open(histogram_file) as infile:
+            for i_sr, sr in enumerate(signal_regions):
+                hist = infile[f"{sr}/{histogram}"]
+                if not np.array_equal(hist.axis().edges(), edges):
+                    raise ValueError(f"binning of {sr}/{histogram} in {histogram_file} differs from the other samples")
+                values[i_sample, i_sr] = hist.values()
+                variances[i_sample, i_sr] = hist.variances()
+                if weight_values is not None:
+                    weight_hist = infile[f"{sr}/{histogram}_weights"]
+                    if weight_hist.values().shape[1] != n_weights:
+                        raise ValueError(f"{sr}/{histogram}_weights in {histogram_file} does not have {n_weights} weights")
+                    # stored as [bin, weight]
+                    weight_values[i_sample, i_sr] = weight_hist.values().T
+        logger.info("added sample %s to the template bank", sample)
+
+    for array in [values, variances, weight_values]:
+        if array is not None:
+            array.flush()
+
+    index = {
+        "analysis": analysis,
+        "histogram": histogram,
+        "file_prefix": file_prefix,
+        "signal_regions": signal_regions,
+        "edges": edges.tolist(),
+        "n_weights": n_weights,
+        "samples": list(files.keys()),
+        "masses": [sample_mass(sample) for sample in files],
+    }
+    with open(bank_dir / INDEX_FILE, "w") as f:
+        json.dump(index, f, indent=4)
+    logger.info("wrote template bank of %s samples and %s signal regions to %s", len(files), len(signal_regions), bank_dir)
+    return index
+
+class TemplateBank:
+    """
+    Read-only view of a template bank written by build_template_bank.
+
+    The arrays are memory-mapped, so indexing them (e.g. the templates of
+    a signal region for the whole mass scan) does not copy any data.
+    """
+    def __init__(self, bank_dir):
+        self.bank_dir = pathlib.Path(bank_dir)
+        if not (self.bank_dir / INDEX_FILE).exists():
+            raise FileNotFoundError(f"no template bank index in {self.bank_dir}")
+        with open(self.bank_dir / INDEX_FILE, "r") as f:
+            self.index = json.load(f)
+        self.values = np.load(self.bank_dir / VALUES_FILE, mmap_mode="r")
+        self.variances = np.load(self.bank_dir / VARIANCES_FILE, mmap_mode="r")
+        self.weight_values = None
+        if self.index["n_weights"] > 0:
+            self.weight_values = np.load(self.bank_dir / WEIGHT_VALUES_FILE, mmap_mode="r")
+
+        self.samples = self.index["samples"]
+        self.masses = np.array(self.index["masses"], dtype=np.float64)
+        self.signal_regions = self.index["signal_regions"]
+        self.edges = np.array(self.index["edges"])
+        self.centers = 0.5 * (self.edges[1:] + self.edges[:-1])
+
+    def sample_index(self, sample:str)->int:
+        return self.samples.index(sample)
+
+    def sr_index(self, signal_region:str)->int:
+        return self.signal_regions.index(signal_region)
+
+    def templates(self, signal_region:str):
+        """
+        Return the [sample, bin] templates of a signal region for all samples.
+        """
+        return self.values[:, self.sr_index(signal_region)]
+
+    def template(self, sample:str, signal_region:str):
+        return self.values[self.sample_index(sample), self.sr_index(signal_region)]
+
+    def mass_range(self, low:float, high:float):
+        """
+        Return the indices of the samples with a mass in [low, high].
+        """
+        return np.flatnonzero((self.masses >= low) & (self.masses <= high))
+
+    def normalised(self, signal_region:str):
+        """
+        Return a copy of the templates of a signal region normalised to unit
+        area (templates without events are left at zero).
+        """
+        templates = np.array(self.templates(signal_region))
+        totals = templates.sum(axis=1, keepdims=True)
+        np.divide(templates, totals, out=templates, where=totals > 0)
+        return templates
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="Collect the signal mjj histograms of a mass scan into a memory-mapped template bank",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("-s", "--samples", type=str, nargs="+", help="Names of the samples to add to the bank")
+    group.add_argument("-m", "--model", type=str, help="Add all the samples of data/samples.py named <model>_..., e.g. DMsimp")
+    parser.add_argument("-a", "--analysis", type=str, default="run2_atlas_tla_dijet", help="Analysis of the histogram files")
+    parser.add_argument("-i", "--input-dir", type=pathlib.Path, default=pathlib.Path("outputs"), help="Directory with the histogram files")
+    parser.add_argument("-o", "--output-dir", type=pathlib.Path, default=pathlib.Path("outputs"), help="Directory to write the template bank directory to")
+    parser.add_argument("--name", type=str, default=None, help="Name of the bank (by default the model, or 'custom' with --samples)")
+    parser.add_argument("--histogram", type=str, default=DEFAULT_HISTOGRAM, help="Name of the histogram in each signal region directory")
+    parser.add_argument("--weight-variations", action="store_true", default=False, help="Also collect the weight vector histograms (<histogram>_weights)")
+    parser.add_argument("--file-prefix", type=str, default="", help="Prefix of the histogram files (if empty string, no prefix)")
+
+    return parser.parse_args()
+
+def main():
+    args = get_args()
+
+    sample_names = args.samples if args.samples is not None else model_samples(args.model)
+    if len(sample_names) == 0:
+        logger.error("no samples found for model %s in data/samples.py", args.model)
+        return 1
+    name = args.name or args.model or "custom"
+
+    try:
+        build_template_bank(
+            sample_names,
+            args.analysis,
+            args.input_dir,
+            bank_directory(args.output_dir, name, args.analysis, args.histogram),
+            histogram=args.histogram,
+            file_prefix=args.file_prefix,
+            weight_variations=args.weight_variations,
+        )
+    except (FileNotFoundError, KeyError, ValueError) as error:
+        logger.error("failed to build the template bank: %s", error)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,6 +6,7 @@ import importlib
 import sys
 from data.samples import samples
 from modules.logger_setup import logger
+from modules.results_store import ResultsStore
 from matplotlib.backends.backend_pdf import PdfPages
 import mplhep as hep
 
@@ -42,10 +43,11 @@ with open("analyses/run2_atlas_tla_dijet_xsec_limit.json", "r") as f:
 
 SKIP_PRODUCTION = True
 
-# output file template
-# use a different file name format to avoid overwriting
+# prefix of the results in the results store
+# use a different prefix to avoid overwriting
 # existing results used for other studies
-JSON_TEMPLATE = "outputs/TRUNCATION_TEST_acceptances_{sample}_run2_atlas_tla_dijet_{method}.json"
+RESULTS_STORE = "outputs/results.sqlite"
+RESULTS_PREFIX = "TRUNCATION_TEST"
 
 # define groups of methods to be compared
 # the keys can be used in filenames for plots
@@ -82,7 +84,7 @@ method_names = {
 
 
 #### helper method used for plotting
-def plot_limit_comparison(truncation_methods:list, pdf:PdfPages, coupling_limit:bool=False):
+def plot_limit_comparison(results, truncation_methods:list, pdf:PdfPages, coupling_limit:bool=False):
     """
     Plot the excluded cross-section vs. mass for the different mass windows
     """
@@ -103,35 +105,22 @@ def plot_limit_comparison(truncation_methods:list, pdf:PdfPages, coupling_limit:
 
     handles = list()
     labels = list()
-    data = dict()
     masses = list()
     limit_values = list()
-    acceptance_file = "outputs/TRUNCATION_TEST_acceptances_{sample}_run2_atlas_tla_dijet_{method}.json"
     for i, truncation_method in enumerate(truncation_methods):
         for sr in SIGNAL_REGIONS:
-            masses = list()
-            limit_values = list()
-            for sample in SAMPLES:
-                with open(acceptance_file.format(sample=sample, method=truncation_method), "r") as f:
-                    data = json.load(f)
-                
-                if np.isnan(data[sr]["modified_expected_xsec_pb"]) or np.isnan(data[sr]["excluded_xsec_pb"]):
-                    # skip this point if the limit is not available 
-                    # or if the expected cross-section is not a number 
-                    continue 
-                
-                if coupling_limit:
-                    # if coupling limit is requested, we need to compute the 
-                    # coupling for each sample and truncation method
-                    limit_values.append(
-                        0.1 * np.sqrt(data[sr]["excluded_xsec_pb"] / (data[sr]["modified_expected_xsec_pb"]))
-                    )
-                else: # cross-section limit
-                    limit_values.append(
-                        data[sr]["excluded_xsec_pb"]
-                    )
-                
-                masses.append(samples[sample]["mass"])
+            rows = results[(results["truncation_method"] == truncation_method) & (results["signal_region"] == sr)]
+            # skip the points where the limit is not available
+            # or where the expected cross-section is not a number
+            rows = rows.dropna(subset=["modified_expected_xsec_pb", "excluded_xsec_pb"])
+
+            if coupling_limit:
+                # if coupling limit is requested, we need to compute the
+                # coupling for each sample and truncation method
+                limit_values = (0.1 * np.sqrt(rows["excluded_xsec_pb"] / rows["modified_expected_xsec_pb"])).tolist()
+            else: # cross-section limit
+                limit_values = rows["excluded_xsec_pb"].tolist()
+            masses = rows["mass"].tolist()
 
             # now plot the limit for this mass window
             style = line_formats[i % len(line_formats)]
@@ -219,19 +208,21 @@ def main():
                 f"python modules/process_sample.py -s {' '.join(SAMPLES)} -o outputs/ -w 4 -r -t {method} -a run2_atlas_tla_dijet --file-prefix TRUNCATION_TEST --skip-store-cutflows --skip-histograms"
             )
 
+    # read the results of all the samples and methods at once
+    with ResultsStore(RESULTS_STORE, read_only=True) as results_store:
+        results = results_store.acceptances(
+            analysis="run2_atlas_tla_dijet",
+            sample=SAMPLES,
+            truncation_method=sorted({method for group in methods.values() for method in group}),
+            prefix=RESULTS_PREFIX,
+        )
+
     # once finished plot the results in a loop over the methods
-    # compare cross-section and coupling limits for each method
+    # compare cross-section and coupling limits for each method
     for method_group in methods:
         with PdfPages(f"outputs/TRUNCATION_TEST_acceptances_comparison_{method_group}.pdf") as pdf:
             for coupling_limit in [False, True]:
-                data = dict()
-                for method in methods[method_group]:
-                    method_data = dict()
-                    for sample in SAMPLES:
-                        with open(JSON_TEMPLATE.format(sample=sample, method=method), "r") as f:
-                            method_data[sample] = json.load(f)
-                    data[method] = method_data
-                plot_limit_comparison(data, pdf, coupling_limit=coupling_limit)
+                plot_limit_comparison(results, methods[method_group], pdf, coupling_limit=coupling_limit)
 
 
 if __name__ == "__main__":
@@ -1,16 +1,19 @@
 import os
 import importlib
 import json
+import numpy as np
 import mplhep as hep
 import uproot
 import boost_histogram as bh
 import matplotlib.pyplot as plt
 from modules.logger_setup import logger
 from data.samples import samples
+from modules.sample_catalogue import catalogue
 import modules.common_tools as ct
 from matplotlib.backends.backend_pdf import PdfPages
 import multiprocessing as mp
-from modules.process_sample import TruncationWindow
+from modules.process_sample import book_truncation_histogram, histogram_contents
+from modules.reinterpretation import HistogramTruncationWindow, TRUNCATION_BINS, TRUNCATION_MAX_MASS
 import logging
 import contextlib
 
@@ -84,7 +87,7 @@ def execute_method(
         # load the RDF for this sample
         sample_rdf = ct.load_delhes_rdf(
             sample, 
-            samples[sample]["ntuple"], 
+            catalogue.files(sample), 
             samples[sample]["metadata"],
             progess_bar=False
         )
@@ -94,11 +97,13 @@ def execute_method(
         for sr in sr_dfs.keys():
             data_dict[sr] = dict()
 
-            # define new truncation window
-            tmp_window = TruncationWindow(
+            # define new truncation window from the mjj distribution, without the flow bins
+            contents = histogram_contents(book_truncation_histogram(sr_dfs[sr]).GetValue())
+            tmp_window = HistogramTruncationWindow(
                 truncation_method,
                 samples[sample]["mass"],
-                sr_dfs[sr],
+                contents[1:-1],
+                np.linspace(0.0, TRUNCATION_MAX_MASS, TRUNCATION_BINS + 1),
             )
 
             data_dict[sr] = {
@@ -27,6 +27,7 @@ import numpy as np
 import json
 import multiprocessing as mp
 from data.samples import samples
+from modules.results_store import ResultsStore
 
 
 analysis_name = "run2_atlas_tla_dijet"
@@ -97,26 +98,26 @@ limit_curves = {
     for truncation in truncation_methods
 }
 
-acceptance_data = dict()
+# read the acceptances of all samples, signal regions and truncation methods at once
+with ResultsStore("outputs/results.sqlite", read_only=True) as results_store:
+    acceptance_data = results_store.acceptances(
+        analysis=analysis_name, sample=samples_to_check, truncation_method=truncation_methods, prefix=""
+    )
+
 theory_expected_xsec = float()
 excluded_xsec = float()
 for truncation_method in truncation_methods:
     for signal_region in signal_regions:
-        for sample in samples_to_check:
-            # reset variables
-            theory_expected_xsec = float()
-            excluded_xsec = float()
-
-            # open acceptances file
-            with open(f"outputs/acceptances_{sample}_{analysis_name}_{truncation_method}.json", "r") as f:
-                acceptance_data = json.load(f)
-            
-            try:
-                theory_expected_xsec = acceptance_data[signal_region]["modified_expected_xsec_pb"]
-                excluded_xsec = acceptance_data[signal_region]["excluded_xsec_pb"]
-            except KeyError as e:
-                logger.warning(f"missing key {e} in acceptance data for sample {sample}, signal region {signal_region}, and truncation method {truncation_method}, skipping")
-                continue
+        rows = acceptance_data[
+            (acceptance_data["truncation_method"] == truncation_method) & (acceptance_data["signal_region"] == signal_region)
+        ]
+        missing = set(samples_to_check) - set(rows["sample"])
+        if len(missing) > 0:
+            logger.warning(f"no acceptance data for samples {sorted(missing)}, signal region {signal_region}, and truncation method {truncation_method}, skipping")
+        for row in rows.itertuples():
+            sample = row.sample
+            theory_expected_xsec = row.modified_expected_xsec_pb
+            excluded_xsec = row.excluded_xsec_pb
             
             if np.isnan(excluded_xsec) or np.isnan(theory_expected_xsec):
                 logger.debug(f"nan value for excluded_xsec or theory_expected_xsec for sample {sample} and signal region {signal_region}, skipping")
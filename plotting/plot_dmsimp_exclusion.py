@@ -6,6 +6,7 @@ import matplotlib.pyplot as plt
 from data.samples import samples
 import os
 from modules.logger_setup import logger
+from modules.results_store import ResultsStore
 
 USE_TRUNCATION = True
 TRUNCATION_METHOD = "default"
@@ -54,26 +55,26 @@ limit_curve = {
     for sr in signal_regions
 }
 
-acceptance_data = dict()
+# read the acceptances of all samples at once
+with ResultsStore("outputs/results.sqlite", read_only=True) as results_store:
+    acceptance_data = results_store.acceptances(
+        analysis="run2_atlas_tla_dijet", sample=sample_list, truncation_method=TRUNCATION_METHOD, prefix=""
+    )
+
 theory_expected_xsec = float()
 excluded_xsec = float()
-for sample in sample_list:
-    for signal_region in signal_regions:
-        # reset variables
-        theory_expected_xsec = float()
-        excluded_xsec = float()
-        # open acceptances file
-        with open(f"outputs/acceptances_{sample}_run2_atlas_tla_dijet_{TRUNCATION_METHOD}.json", "r") as f:
-            acceptance_data = json.load(f)
-        try:
-            if USE_TRUNCATION:
-                theory_expected_xsec = acceptance_data[signal_region]["modified_expected_xsec_pb"]
-            else:
-                theory_expected_xsec = acceptance_data[signal_region]["expected_xsec_pb"]
-            excluded_xsec = acceptance_data[signal_region]["excluded_xsec_pb"]
-        except KeyError as e:
-            logger.warning(f"missing key {e} in acceptance data for sample {sample} and signal region {signal_region}, skipping")
-            continue
+for signal_region in signal_regions:
+    rows = acceptance_data[acceptance_data["signal_region"] == signal_region]
+    missing = set(sample_list) - set(rows["sample"])
+    if len(missing) > 0:
+        logger.warning(f"no acceptance data for samples {sorted(missing)} and signal region {signal_region}, skipping")
+    for row in rows.itertuples():
+        sample = row.sample
+        if USE_TRUNCATION:
+            theory_expected_xsec = row.modified_expected_xsec_pb
+        else:
+            theory_expected_xsec = row.expected_xsec_pb
+        excluded_xsec = row.excluded_xsec_pb
         
         if np.isnan(excluded_xsec) or np.isnan(theory_expected_xsec):
             logger.debug(f"nan value for excluded_xsec or theory_expected_xsec for sample {sample} and signal region {signal_region}, skipping")
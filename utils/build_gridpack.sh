@@ -0,0 +1,70 @@
+#!/bin/bash
+
+####################################################
+### Script run to build a MadGraph5_aMC@NLO gridpack
+### for a mass point via CERN HTCondor
+
+echo "Starting MadGraph5_aMC@NLO gridpack build script..."
+
+MG_VERSION=3_6_7
+
+# Check if we have access to cvfms 
+# use the ATLAS setup to get an LCG release and xrootd
+if [[ -r /cvmfs/atlas.cern.ch/repo/ATLASLocalRootBase ]] ; then
+    echo "Setting up ATLAS environment..."
+    export ATLAS_LOCAL_ROOT_BASE=/cvmfs/atlas.cern.ch/repo/ATLASLocalRootBase
+    source ${ATLAS_LOCAL_ROOT_BASE}/user/atlasLocalSetup.sh -3
+    lsetup "views LCG_106 x86_64-el9-gcc13-opt"
+    lsetup xrootd
+else
+  echo "ERROR: cvmfs not accessible. You need to run on lxplus"
+  exit 1
+fi
+
+echo "Setting up voms proxy for xrootd access..."
+export X509_USER_PROXY=$1
+voms-proxy-info -all
+voms-proxy-info -all -file ${X509_USER_PROXY}
+
+GRIDPACK_DIR="$3"
+GRIDPACK_FILE="$4"
+
+echo "Current working directory: $(pwd)"
+# perform an xrootd copy of the tarball from EOS
+# NOTE you should change this path to wherever you have tarball stored
+TARBALL_PATH=/eos/user/m/mamerl/PhD/TLA/DijetISR/Interpretations/DMWG-dark-photon-tools/dark-photon-event-gen/run/MG5_aMC_v${MG_VERSION}_with_dependencies.tar.gz
+echo "Copying MadGraph tarball from ${TARBALL_PATH}..."
+if ! xrdcp root://eosuser.cern.ch/${TARBALL_PATH} .; then
+    echo "ERROR: failed to copy the MadGraph tarball"
+    exit 1
+fi
+
+echo "Unpacking MadGraph tarball..."
+tar -xzf MG5_aMC_v${MG_VERSION}_with_dependencies.tar.gz
+
+# compile the process, run the survey/refine integration and pack
+# the result (the instruction file sets gridpack mode)
+echo "Running MadGraph to build the gridpack..."
+./MG5_aMC_v${MG_VERSION}/bin/mg5_aMC $2
+echo "MadGraph run completed."
+
+echo "ls -altr of MadGraph output directory after the gridpack build:"
+ls -altr generated_events
+
+# the cross-section summary and banner are returned to the submit node
+# with the names used by the event generation jobs (see get_metadata.py)
+cp generated_events/HTML/run_01/results.html results.html || { echo "WARNING: no results.html found"; touch results.html; }
+cp generated_events/Events/run_01/run_01_tag_1_banner.txt banner.txt || { echo "WARNING: no run banner found"; touch banner.txt; }
+
+GRIDPACK=$(find generated_events -maxdepth 1 -name 'run_*_gridpack.tar.gz' | head -n 1)
+if [[ -z "${GRIDPACK}" ]]; then
+    echo "ERROR: no gridpack found in generated_events"
+    exit 1
+fi
+
+echo "Copying ${GRIDPACK} to EOS as ${GRIDPACK_DIR}/${GRIDPACK_FILE}..."
+if ! xrdcp -f --path "${GRIDPACK}" "root://eosuser.cern.ch/${GRIDPACK_DIR}/${GRIDPACK_FILE}"; then
+    echo "ERROR: failed to copy the gridpack to EOS"
+    exit 1
+fi
+echo "Gridpack copied to EOS."
@@ -63,19 +63,82 @@ ls -altr generated_events
 
 EOS_OUTPUT_PATH=$3
 OUTPUT_FILE_PATTERN="$4"
+# optional skim of the Delphes output to the branches listed in $5
+# mode is one of none, skim (only copy the skimmed file) or
+# skim_keep_full (also copy the full file to a full/ subdirectory, so that
+# it is not picked up by the sample file patterns)
+SKIM_BRANCHES="$5"
+SKIM_MODE="${6:-none}"
 
-ROOT_DIR="generated_events/Events/run_01"
-echo "ls -altr of ${ROOT_DIR}:"
-ls -altr $ROOT_DIR
-if [[ -d "$ROOT_DIR" ]]; then
+# optional list of mass points (separated by ':') generated by the
+# successive launches of the MadGraph session, run_01 is the first mass
+# point, run_02 the second and so on. The '<MMED>' in the file pattern is
+# replaced by the mass of each run and the cross-section summary and
+# banner of each run are written to mass_info/ with the names given by
+# the job ID in $8
+MASS_POINTS="$7"
+JOB_ID="$8"
+
+# copy the Delphes outputs of a run directory to EOS
+copy_run_outputs() {
+  local ROOT_DIR="$1"
+  local FILE_PATTERN="$2"
+  echo "ls -altr of ${ROOT_DIR}:"
+  ls -altr $ROOT_DIR
+  if [[ ! -d "$ROOT_DIR" ]]; then
+    echo "Directory $ROOT_DIR not found"
+    return 1
+  fi
   count=0
+  # keep copying the other files if one fails, but report the failure
+  local copy_status=0
   for f in $(find "$ROOT_DIR" -maxdepth 1 -type f -name '*.root'); do
     ((count++))
-    out_name="${OUTPUT_FILE_PATTERN/\*/$count}"   # replace first '*' with count
+    out_name="${FILE_PATTERN/\*/$count}"   # replace first '*' with count
+    if [[ "$SKIM_MODE" != "none" ]]; then
+      skim_file="${f%.root}_skim.root"
+      echo "Skimming $f to branches in ${SKIM_BRANCHES}..."
+      if python3 skim_delphes.py "$f" "$skim_file" --branches-file "$SKIM_BRANCHES"; then
+        echo "Copying $skim_file to EOS as $out_name"
+        if ! xrdcp "$skim_file" "root://eosuser.cern.ch/${EOS_OUTPUT_PATH}/${out_name}"; then
+          echo "ERROR: failed to copy $skim_file to EOS"
+          copy_status=1
+        fi
+        if [[ "$SKIM_MODE" == "skim_keep_full" ]]; then
+          echo "Copying $f to EOS as full/${out_name}"
+          if ! xrdcp --path "$f" "root://eosuser.cern.ch/${EOS_OUTPUT_PATH}/full/${out_name}"; then
+            echo "ERROR: failed to copy $f to EOS"
+            copy_status=1
+          fi
+        fi
+        continue
+      fi
+      # do not lose the events if the skim fails
+      echo "WARNING: skim of $f failed, copying the full file instead"
+    fi
     echo "Copying $f to EOS as $out_name"
-    xrdcp "$f" "root://eosuser.cern.ch/${EOS_OUTPUT_PATH}/${out_name}"
+    if ! xrdcp "$f" "root://eosuser.cern.ch/${EOS_OUTPUT_PATH}/${out_name}"; then
+      echo "ERROR: failed to copy $f to EOS"
+      copy_status=1
+    fi
   done
+  return $copy_status
+}
+
+if [[ -z "$MASS_POINTS" ]]; then
+  copy_run_outputs "generated_events/Events/run_01" "$OUTPUT_FILE_PATTERN" || exit 1
 else
-  echo "Directory $ROOT_DIR not found"
-  exit 1
+  mkdir -p mass_info
+  status=0
+  run=0
+  for mmed in ${MASS_POINTS//:/ }; do
+    ((run++))
+    run_name=$(printf "run_%02d" $run)
+    echo "Collecting the outputs of ${run_name} for mmed = ${mmed}..."
+    # keep going so the other mass points are not lost
+    copy_run_outputs "generated_events/Events/${run_name}" "${OUTPUT_FILE_PATTERN//<MMED>/$mmed}" || status=1
+    cp "generated_events/HTML/${run_name}/results.html" "mass_info/xsec_info_${JOB_ID}_mmed${mmed}.txt" || status=1
+    cp "generated_events/Events/${run_name}/${run_name}_tag_1_banner.txt" "mass_info/mg5_info_${JOB_ID}_mmed${mmed}.txt" || status=1
+  done
+  exit $status
 fi
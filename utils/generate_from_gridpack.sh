@@ -0,0 +1,64 @@
+#!/bin/bash
+
+####################################################
+### Script run to generate events from a MadGraph
+### gridpack via CERN HTCondor
+###
+### The gridpack is unpacked and run with the given number of
+### events and random seed, then the LHE events are showered with
+### Pythia8 and passed to Delphes by run_pythia_generation.sh
+
+echo "Starting gridpack event generation script..."
+
+PROXY_PATH="$1"
+GRIDPACK_PATH="$2"
+NEVENTS="$3"
+SEED="$4"
+SHOWER_CARD="$5"
+EVENT_FILE="$6"
+OUTPUT_PATH="$7"
+
+# Check if we have access to cvfms 
+# use the ATLAS setup to get an LCG release and xrootd
+if [[ -r /cvmfs/atlas.cern.ch/repo/ATLASLocalRootBase ]] ; then
+    echo "Setting up ATLAS environment..."
+    export ATLAS_LOCAL_ROOT_BASE=/cvmfs/atlas.cern.ch/repo/ATLASLocalRootBase
+    source ${ATLAS_LOCAL_ROOT_BASE}/user/atlasLocalSetup.sh -3
+    lsetup "views LCG_106 x86_64-el9-gcc13-opt"
+    lsetup xrootd
+else
+  echo "ERROR: cvmfs not accessible. You need to run on lxplus"
+  exit 1
+fi
+
+export X509_USER_PROXY=${PROXY_PATH}
+
+echo "Copying gridpack from ${GRIDPACK_PATH}..."
+if ! xrdcp root://eosuser.cern.ch/${GRIDPACK_PATH} gridpack.tar.gz; then
+    echo "ERROR: failed to copy the gridpack"
+    exit 1
+fi
+mkdir -p gridpack
+tar -xzf gridpack.tar.gz -C gridpack
+
+# generate the parton-level events, the seed must differ between
+# the jobs using the same gridpack
+echo "Generating ${NEVENTS} events with seed ${SEED}..."
+cd gridpack
+if ! ./run.sh ${NEVENTS} ${SEED} || [[ ! -s events.lhe.gz ]]; then
+    echo "ERROR: gridpack event generation failed"
+    exit 1
+fi
+cd ..
+# the shower card reads events.lhe
+gunzip -c gridpack/events.lhe.gz > events.lhe
+# the number of LHE events replaces the unweighted events of the
+# gridpack build in the filter efficiency (see get_metadata.py)
+grep -c "<event" events.lhe > lhe_events.txt
+echo "Generated $(cat lhe_events.txt) LHE events"
+rm -rf gridpack gridpack.tar.gz
+
+echo "Showering and simulating the detector response..."
+chmod +x run_pythia_generation.sh
+./run_pythia_generation.sh "${PROXY_PATH}" "${SHOWER_CARD}" "${EVENT_FILE}" "${OUTPUT_PATH}" stream
+exit $?
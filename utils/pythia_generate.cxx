@@ -1,5 +1,6 @@
 #include "Pythia8/Pythia.h"
 #include "Pythia8Plugins/HepMC2.h" // Use HepMC2
+#include <csignal>
 #include <fstream>
 #include <string>
 #include <iostream>
@@ -20,19 +21,36 @@ int main(int argc, char* argv[]) {
     pythia.readFile(settingsFile); 
     pythia.init();
 
+    // The output can be a named pipe read by Delphes (see run_pythia_generation.sh),
+    // if the reader exits early the writes fail instead of killing the process
+    std::signal(SIGPIPE, SIG_IGN);
+
     // HepMC2 interface and ASCII output
     HepMC::Pythia8ToHepMC toHepMC;
-    HepMC::IO_GenEvent ascii_io(hepmcFile, std::ios::out);
-
     int nEvent = pythia.mode("Main:numberOfEvents");
-    for (int iEvent = 0; iEvent < nEvent; ++iEvent) {
-        if (!pythia.next()) continue;
-        
-        // Create a HepMC event, fill it from Pythia and write it out
-        HepMC::GenEvent* hepmcEvt = new HepMC::GenEvent();
-        toHepMC.fill_next_event(pythia, hepmcEvt);
-        ascii_io << hepmcEvt;
-        delete hepmcEvt;
+    {
+        HepMC::IO_GenEvent ascii_io(hepmcFile, std::ios::out);
+        if (ascii_io.rdstate() != 0) {
+            std::cerr << "Error: cannot open HepMC output " << hepmcFile << "\n";
+            return 1;
+        }
+
+        for (int iEvent = 0; iEvent < nEvent; ++iEvent) {
+            if (!pythia.next()) continue;
+
+            // Create a HepMC event, fill it from Pythia and write it out
+            HepMC::GenEvent* hepmcEvt = new HepMC::GenEvent();
+            toHepMC.fill_next_event(pythia, hepmcEvt);
+            ascii_io << hepmcEvt;
+            delete hepmcEvt;
+
+            if (ascii_io.rdstate() != 0) {
+                std::cerr << "Error: writing event " << iEvent << " to " << hepmcFile << " failed\n";
+                return 1;
+            }
+        }
+        // the HepMC output is closed here, so that a reader of the pipe
+        // sees the end of the events before the summary is written
     }
 
     // Write cross section summary
@@ -31,21 +31,80 @@ echo "Current working directory: $(pwd)"
 echo "ls -altr"
 ls -altr
 
-# make the Pythia executable
-make
-
-# run the Pythia event generation
-echo "Running Pythia to generate events..."
-./pythia_generate $2 output_events.hepmc output_events_xsec.txt
-echo "Pythia run completed."
-
-echo "Running Delphes to simulate detector response..."
+# HepMC handling: "file" writes the HepMC events to disk before running Delphes,
+# "stream" passes them to Delphes through a named pipe with both programs running
+# concurrently, so the ASCII HepMC file is never stored
+HEPMC_MODE="${5:-file}"
+HEPMC_FILE="output_events.hepmc"
 
 # use LCG_106 DelphesHepMC2 with ATLAS card
 DELPHES_CARD="/cvmfs/sft.cern.ch/lcg/releases/delphes/3.5.1pre09-60e9b/x86_64-el9-gcc13-opt/cards/delphes_card_ATLAS.tcl"
 DELPHES_OUT="$3"
 
-DelphesHepMC2 "${DELPHES_CARD}" "${DELPHES_OUT}" output_events.hepmc
+# make the Pythia executable
+if ! make; then
+    echo "ERROR: failed to build pythia_generate"
+    exit 1
+fi
+
+if [[ "${HEPMC_MODE}" == "stream" ]]; then
+    echo "Running Pythia and Delphes concurrently through the named pipe ${HEPMC_FILE}..."
+    rm -f "${HEPMC_FILE}"
+    if ! mkfifo "${HEPMC_FILE}"; then
+        echo "ERROR: failed to create the named pipe ${HEPMC_FILE}"
+        exit 1
+    fi
+
+    DelphesHepMC2 "${DELPHES_CARD}" "${DELPHES_OUT}" "${HEPMC_FILE}" &
+    DELPHES_PID=$!
+    ./pythia_generate $2 "${HEPMC_FILE}" output_events_xsec.txt &
+    PYTHIA_PID=$!
+
+    # wait for the first program to finish, if it failed stop the other one since
+    # it would otherwise block forever on opening or reading the pipe
+    while kill -0 ${PYTHIA_PID} 2>/dev/null && kill -0 ${DELPHES_PID} 2>/dev/null; do
+        sleep 5
+    done
+    # open and close the pipe once, which releases the other program if it is
+    # still waiting to open it (it then sees the end of the stream)
+    exec 3<>"${HEPMC_FILE}"
+    exec 3>&-
+    if ! kill -0 ${PYTHIA_PID} 2>/dev/null; then
+        wait ${PYTHIA_PID}
+        PYTHIA_STATUS=$?
+        if [[ ${PYTHIA_STATUS} -ne 0 ]]; then kill ${DELPHES_PID} 2>/dev/null; fi
+        wait ${DELPHES_PID}
+        DELPHES_STATUS=$?
+    else
+        wait ${DELPHES_PID}
+        DELPHES_STATUS=$?
+        if [[ ${DELPHES_STATUS} -ne 0 ]]; then kill ${PYTHIA_PID} 2>/dev/null; fi
+        wait ${PYTHIA_PID}
+        PYTHIA_STATUS=$?
+    fi
+    rm -f "${HEPMC_FILE}"
+
+    # the program stopped after the other one failed has exit code 143
+    if [[ ${PYTHIA_STATUS} -ne 0 || ${DELPHES_STATUS} -ne 0 ]]; then
+        echo "ERROR: streaming failed, Pythia exit code ${PYTHIA_STATUS}, Delphes exit code ${DELPHES_STATUS}"
+        exit 1
+    fi
+    echo "Pythia and Delphes runs completed."
+else
+    # run the Pythia event generation
+    echo "Running Pythia to generate events..."
+    if ! ./pythia_generate $2 "${HEPMC_FILE}" output_events_xsec.txt; then
+        echo "ERROR: Pythia failed"
+        exit 1
+    fi
+    echo "Pythia run completed."
+
+    echo "Running Delphes to simulate detector response..."
+    if ! DelphesHepMC2 "${DELPHES_CARD}" "${DELPHES_OUT}" "${HEPMC_FILE}"; then
+        echo "ERROR: Delphes failed"
+        exit 1
+    fi
+fi
 
 echo "Delphes run completed. Output: ${DELPHES_OUT}"
 
@@ -54,5 +113,8 @@ ls -altr
 
 # copy the output file to EOS
 echo "Copying output file to EOS..."
-xrdcp ${DELPHES_OUT} root://eosuser.cern.ch/$4
+if ! xrdcp ${DELPHES_OUT} root://eosuser.cern.ch/$4; then
+    echo "ERROR: failed to copy ${DELPHES_OUT} to EOS"
+    exit 1
+fi
 echo "Output file copied to EOS."
@@ -0,0 +1,79 @@
+"""
+
+Skim a Delphes ROOT file to the branches read by the analyses.
+
+Run on the worker node after Delphes (see generate.sh), so that only the
+skimmed file is copied to EOS. All the sub-branches of the given branch
+collections (e.g. Jet and Event) are kept with the same names, so the
+skimmed file can be read by modules/process_sample.py and the array
+backend like the full Delphes output. The baskets are recompressed with a
+stronger setting than the Delphes default.
+
+The branch collections are listed in a text file, one per line, written
+by submit_jobs.py --skim from the branches used by the analyses.
+
+Example:
+python3 skim_delphes.py tag_1_delphes_events.root tag_1_delphes_events_skim.root --branches-file skim_branches.txt
+
+"""
+import sys
+import argparse
+import os
+import ROOT
+
+# ZSTD level 9 (algorithm * 100 + level) compresses far better than the Delphes
+# default while still decompressing quickly when the files are read
+DEFAULT_COMPRESSION = 509
+
+def skim(input_path:str, output_path:str, collections:list, tree_name:str="Delphes", compression:int=DEFAULT_COMPRESSION)->int:
+    """
+    Write the given branch collections of the Delphes tree to a new file
+    and return the number of entries written.
+    """
+    infile = ROOT.TFile.Open(input_path)
+    tree = infile.Get(tree_name)
+    tree.SetBranchStatus("*", 0)
+    for collection in collections:
+        # the collection itself, its counter and all its members
+        for pattern in [collection, f"{collection}_size", f"{collection}.*"]:
+            tree.SetBranchStatus(pattern, 1)
+
+    outfile = ROOT.TFile.Open(output_path, "RECREATE", "", compression)
+    # a full (not fast) clone so that the baskets are recompressed
+    skimmed = tree.CloneTree(-1)
+    skimmed.Write()
+    n_entries = skimmed.GetEntries()
+    outfile.Close()
+
+    if n_entries != tree.GetEntries():
+        raise RuntimeError(f"skimmed tree has {n_entries} entries instead of {tree.GetEntries()}")
+    infile.Close()
+    return n_entries
+
+def main():
+    parser = argparse.ArgumentParser(description="Skim a Delphes ROOT file to the branches read by the analyses")
+    parser.add_argument("input", type=str, help="Delphes ROOT file")
+    parser.add_argument("output", type=str, help="Skimmed ROOT file to write")
+    parser.add_argument("--branches-file", type=str, required=True, help="Text file listing the branch collections to keep, one per line")
+    parser.add_argument("--tree-name", type=str, default="Delphes", help="Name of the Delphes tree")
+    parser.add_argument("--compression", type=int, default=DEFAULT_COMPRESSION, help="ROOT compression setting (algorithm * 100 + level)")
+    args = parser.parse_args()
+
+    with open(args.branches_file, "r") as f:
+        collections = [line.strip() for line in f if line.strip() != "" and not line.startswith("#")]
+    if len(collections) == 0:
+        print(f"ERROR: no branches listed in {args.branches_file}")
+        return 1
+
+    # needed to read and write the Delphes classes
+    ROOT.gSystem.Load("libDelphes")
+
+    n_entries = skim(args.input, args.output, collections, args.tree_name, args.compression)
+    print(
+        f"Skimmed {n_entries} events with branches {', '.join(collections)}: "
+        f"{os.path.getsize(args.input) / 1024**2:.1f} MB -> {os.path.getsize(args.output) / 1024**2:.1f} MB"
+    )
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -22,6 +22,7 @@ echo "Submitting jobs via submit_pythia.py..."
 MASS_POINTS=()
 NEVENTS=""
 OUTPUT_DIR=""
+STREAM_ARGS=()
 ARGS=()
 while [[ $# -gt 0 ]]; do
     case "$1" in
@@ -41,16 +42,21 @@ while [[ $# -gt 0 ]]; do
             if [[ -n "$2" && "$2" != -* ]]; then NEVENTS="$2"; shift 2; else echo "Error: $1 requires a value"; exit 1; fi;;
         -o|--output-dir)
             if [[ -n "$2" && "$2" != -* ]]; then OUTPUT_DIR="$2"; shift 2; else echo "Error: $1 requires a value"; exit 1; fi;;
+        --stream)
+            STREAM_ARGS+=("$1"); shift;;
+        --events-per-job)
+            if [[ -n "$2" && "$2" != -* ]]; then STREAM_ARGS+=("$1" "$2"); shift 2; else echo "Error: $1 requires a value"; exit 1; fi;;
         --) shift; while [[ $# -gt 0 ]]; do ARGS+=("$1"); shift; done; break;;
         *) ARGS+=("$1"); shift;;
     esac
 done
 
-# rebuild argument list to contain only -m/--mass-points, -n/--nevents and -o/--output-dir (short form used)
+# rebuild argument list to contain only -m/--mass-points, -n/--nevents, -o/--output-dir (short form used), --stream and --events-per-job
 NEWARGS=()
 if [[ ${#MASS_POINTS[@]} -gt 0 ]]; then NEWARGS+=("-m" "${MASS_POINTS[@]}"); fi
 if [[ -n "$NEVENTS" ]]; then NEWARGS+=("-n" "$NEVENTS"); fi
 if [[ -n "$OUTPUT_DIR" ]]; then NEWARGS+=("-o" "$OUTPUT_DIR"); fi
+NEWARGS+=("${STREAM_ARGS[@]}")
 
 echo "Final argument list for submit_pythia.py: ${NEWARGS[@]}"
 # run submit_pythia.py using the NEWARGS array
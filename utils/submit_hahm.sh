@@ -2,11 +2,22 @@
 echo "Copying necessary scripts and templates to run/ directory..."
 cp utils/generate.sh run/generate.sh
 cp utils/submit_jobs.py run/submit_jobs.py
+cp utils/skim_delphes.py run/skim_delphes.py
 cp utils/condor_submit_template.txt run/condor_submit_template.txt
+cp utils/condor_multi_mass_template.txt run/condor_multi_mass_template.txt
 cp utils/generate_hahm_v5_template.txt run/generate_hahm_v5_template.txt
+# gridpack mode files
+cp utils/build_gridpack.sh run/build_gridpack.sh
+cp utils/generate_from_gridpack.sh run/generate_from_gridpack.sh
+cp utils/condor_gridpack_template.txt run/condor_gridpack_template.txt
+cp utils/condor_gridpack_events_template.txt run/condor_gridpack_events_template.txt
+cp utils/generate_gridpack_shower_template.cmnd run/generate_gridpack_shower_template.cmnd
+cp utils/run_pythia_generation.sh run/run_pythia_generation.sh
+cp utils/Makefile run/Makefile
+cp utils/pythia_generate.cxx run/pythia_generate.cxx
 # make the generation script executable
 echo "Making generation script executable..."
-chmod +x run/generate.sh
+chmod +x run/generate.sh run/build_gridpack.sh run/generate_from_gridpack.sh run/run_pythia_generation.sh
 
 # change to run/ directory
 echo "Changing to run/ directory..."
@@ -19,6 +30,10 @@ echo "Submitting jobs via submit_jobs.py..."
 MASS_POINTS=()
 NEVENTS=""
 OUTPUT_DIR=""
+SKIM_ARGS=()
+GRIDPACK_STAGE="none"
+GRIDPACK_ARGS=()
+MASSES_PER_JOB=1
 ARGS=()
 while [[ $# -gt 0 ]]; do
     case "$1" in
@@ -38,26 +53,56 @@ while [[ $# -gt 0 ]]; do
             if [[ -n "$2" && "$2" != -* ]]; then NEVENTS="$2"; shift 2; else echo "Error: $1 requires a value"; exit 1; fi;;
         -o|--output-dir)
             if [[ -n "$2" && "$2" != -* ]]; then OUTPUT_DIR="$2"; shift 2; else echo "Error: $1 requires a value"; exit 1; fi;;
+        --skim|--keep-full)
+            SKIM_ARGS+=("$1"); shift;;
+        --masses-per-job)
+            if [[ -n "$2" && "$2" != -* ]]; then MASSES_PER_JOB="$2"; shift 2; else echo "Error: $1 requires a value"; exit 1; fi;;
+        --gridpack-stage)
+            if [[ -n "$2" && "$2" != -* ]]; then GRIDPACK_STAGE="$2"; GRIDPACK_ARGS+=("$1" "$2"); shift 2; else echo "Error: $1 requires a value"; exit 1; fi;;
+        --gridpack-dir|--jobs-per-point|--events-per-job|--runtime-per-mass)
+            if [[ -n "$2" && "$2" != -* ]]; then GRIDPACK_ARGS+=("$1" "$2"); shift 2; else echo "Error: $1 requires a value"; exit 1; fi;;
         --) shift; while [[ $# -gt 0 ]]; do ARGS+=("$1"); shift; done; break;;
         *) ARGS+=("$1"); shift;;
     esac
 done
 
-# rebuild argument list to contain only -m/--mass-points, -n/--nevents and -o/--output-dir (short form used)
+# rebuild argument list to contain only -m/--mass-points, -n/--nevents, -o/--output-dir (short form used), the skim, multi-mass, job splitting and gridpack options
 NEWARGS=()
 if [[ ${#MASS_POINTS[@]} -gt 0 ]]; then NEWARGS+=("-m" "${MASS_POINTS[@]}"); fi
 if [[ -n "$NEVENTS" ]]; then NEWARGS+=("-n" "$NEVENTS"); fi
 if [[ -n "$OUTPUT_DIR" ]]; then NEWARGS+=("-o" "$OUTPUT_DIR"); fi
+NEWARGS+=("${SKIM_ARGS[@]}")
+NEWARGS+=("--masses-per-job" "$MASSES_PER_JOB")
+NEWARGS+=("${GRIDPACK_ARGS[@]}")
+
+# each gridpack stage has its own condor template
+case "$GRIDPACK_STAGE" in
+    build) CONDOR_TEMPLATE=condor_gridpack_template.txt;;
+    generate) CONDOR_TEMPLATE=condor_gridpack_events_template.txt;;
+    *) CONDOR_TEMPLATE=condor_submit_template.txt;;
+esac
+# jobs generating several mass points return one info file per mass point
+if [[ "$MASSES_PER_JOB" -gt 1 ]]; then CONDOR_TEMPLATE=condor_multi_mass_template.txt; fi
 
 echo "Final argument list for submit_jobs.py: ${NEWARGS[@]}"
 # run submit_jobs.py using the NEWARGS array
-python3 submit_jobs.py --condor-template condor_submit_template.txt -e generate_hahm_v5_template.txt --job-id hahm "${NEWARGS[@]}"
+python3 submit_jobs.py --condor-template "$CONDOR_TEMPLATE" -e generate_hahm_v5_template.txt --job-id hahm "${NEWARGS[@]}"
 # once everything is submitted cleanup the run/ directory
 echo "Cleaning up run/ directory..."
 rm generate.sh
 rm submit_jobs.py
+rm skim_delphes.py
 rm condor_submit_template.txt
+rm condor_multi_mass_template.txt
 rm generate_hahm_v5_template.txt
+rm build_gridpack.sh
+rm generate_from_gridpack.sh
+rm condor_gridpack_template.txt
+rm condor_gridpack_events_template.txt
+rm generate_gridpack_shower_template.cmnd
+rm run_pythia_generation.sh
+rm Makefile
+rm pythia_generate.cxx
 echo "Cleanup completed."
 # return to original directory
 cd ..
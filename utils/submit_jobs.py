@@ -7,11 +7,17 @@ NOTE this script should be run inside the run/ directory!
 
 """
 from modules.logger_setup import logger
+from modules.delphes_branches import DIJET_BRANCHES
+from modules.seed_ledger import SeedLedger, split_events, DEFAULT_LEDGER_NAME
 import argparse
+import math
 import os
 import sys
 import pathlib
 
+# longest MaxRuntime of the CERN batch job flavours (nextweek)
+MAX_CONDOR_RUNTIME = 604800
+
 parser = argparse.ArgumentParser(description="Submit MadGraph event generation jobs")
 parser.add_argument(
     "-m",
@@ -65,6 +71,75 @@ parser.add_argument(
     default=False,
 )
 
+parser.add_argument(
+    "--skim",
+    action="store_true",
+    help="skim the Delphes output on the worker node to the branches read by the analyses and only copy the skimmed file",
+    default=False,
+)
+parser.add_argument(
+    "--keep-full",
+    action="store_true",
+    help="with --skim, also copy the full Delphes output (to a full/ subdirectory of the output directory)",
+    default=False,
+)
+parser.add_argument(
+    "--skim-extra-branches",
+    nargs="*",
+    type=str,
+    help="branch collections to keep in the skim in addition to the ones read by the analyses",
+    default=["Weight"],
+)
+parser.add_argument(
+    "--events-per-job",
+    type=int,
+    help="split the events of each mass point into jobs of this many events, each with its own seed from the seed ledger (by default one job per mass point)",
+    default=None,
+)
+parser.add_argument(
+    "--seed-ledger",
+    type=pathlib.Path,
+    help="JSON ledger of the random seeds allocated to the jobs of split mass points",
+    default=pathlib.Path(DEFAULT_LEDGER_NAME),
+)
+parser.add_argument(
+    "--masses-per-job",
+    type=int,
+    help="number of mass points generated in turn by each job, the process is compiled once per job (use with condor_multi_mass_template.txt if larger than 1)",
+    default=1,
+)
+parser.add_argument(
+    "--runtime-per-mass",
+    type=int,
+    help="with --masses-per-job, maximum runtime in seconds allowed for each mass point of a job, the MaxRuntime of the job scales with its number of mass points",
+    default=14400,
+)
+parser.add_argument(
+    "--gridpack-stage",
+    choices=["none", "build", "generate"],
+    help="gridpack mode: 'build' submits one job per mass point building a MadGraph gridpack (use with condor_gridpack_template.txt), "
+    "'generate' submits jobs generating events from the gridpacks with different seeds (use with condor_gridpack_events_template.txt)",
+    default="none",
+)
+parser.add_argument(
+    "--gridpack-dir",
+    type=pathlib.Path,
+    help="EOS directory of the gridpacks (by default the gridpacks/ subdirectory of the output directory)",
+    default=None,
+)
+parser.add_argument(
+    "--jobs-per-point",
+    type=int,
+    help="with --gridpack-stage generate and without --events-per-job, number of jobs per mass point sharing the events of --nevents",
+    default=1,
+)
+parser.add_argument(
+    "--shower-template",
+    type=pathlib.Path,
+    help="with --gridpack-stage generate, Pythia8 settings template for showering the gridpack events",
+    default=pathlib.Path("generate_gridpack_shower_template.cmnd"),
+)
+
 args = parser.parse_args()
 
 logger.info("starting MadGraph5_aMC@NLO event generation job submission...")
@@ -90,6 +165,51 @@ if len(args.job_id.strip()) == 0:
     logger.error("job ID string cannot be empty!")
     sys.exit(1)
 
+if args.gridpack_stage != "none" and args.output_dir is None and args.gridpack_dir is None:
+    logger.error("the output directory or the gridpack directory must be specified in gridpack mode!")
+    sys.exit(1)
+
+if args.masses_per_job < 1:
+    logger.error("the number of mass points per job must be positive!")
+    sys.exit(1)
+
+if args.masses_per_job > 1 and (args.xsec_info_only or args.gridpack_stage != "none"):
+    logger.error("--masses-per-job is not supported with --xsec-info-only or --gridpack-stage!")
+    sys.exit(1)
+
+if args.runtime_per_mass < 1:
+    logger.error("the runtime per mass point must be positive!")
+    sys.exit(1)
+
+if args.masses_per_job > 1 and args.runtime_per_mass * args.masses_per_job > MAX_CONDOR_RUNTIME:
+    logger.error(
+        "%s mass points per job need a runtime of %s s, longer than the maximum of %s s, use fewer mass points per job!",
+        args.masses_per_job, args.runtime_per_mass * args.masses_per_job, MAX_CONDOR_RUNTIME
+    )
+    sys.exit(1)
+
+if args.events_per_job is not None:
+    if args.events_per_job < 1:
+        logger.error("the number of events per job must be positive!")
+        sys.exit(1)
+    if args.masses_per_job > 1 or args.xsec_info_only or args.gridpack_stage == "build":
+        logger.error("--events-per-job is not supported with --masses-per-job, --xsec-info-only or --gridpack-stage build!")
+        sys.exit(1)
+
+if args.gridpack_stage == "generate":
+    if args.xsec_info_only or args.skim:
+        logger.error("--xsec-info-only and --skim are not supported with --gridpack-stage generate!")
+        sys.exit(1)
+    if args.output_dir is None:
+        logger.error("output directory must be specified with --gridpack-stage generate!")
+        sys.exit(1)
+    if args.jobs_per_point < 1:
+        logger.error("the number of jobs per mass point must be positive!")
+        sys.exit(1)
+    if not args.shower_template.exists():
+        logger.error("Pythia8 shower template file %s does not exist!", args.shower_template)
+        sys.exit(1)
+
 output_path = None
 if args.output_dir is not None:
     output_path = args.output_dir.resolve()
@@ -97,12 +217,22 @@ if args.output_dir is not None:
         output_path = pathlib.Path(f"/eos/user/{os.environ['USER'][0]}/{os.environ['USER']}{str(output_path).split(os.environ['USER'])[1]}")
     logger.info("using output directory: %s", output_path)
 
+gridpack_path = None
+if args.gridpack_stage != "none":
+    gridpack_path = args.gridpack_dir.resolve() if args.gridpack_dir is not None else output_path / "gridpacks"
+    if "home-" + os.environ["USER"][0] in str(gridpack_path):
+        gridpack_path = pathlib.Path(f"/eos/user/{os.environ['USER'][0]}/{os.environ['USER']}{str(gridpack_path).split(os.environ['USER'])[1]}")
+    logger.info("using gridpack directory: %s", gridpack_path)
+
+PROXY_PATH = f"/afs/cern.ch/user/{os.environ['USER'][0]}/{os.environ['USER']}/private/x509up"
+
 MMED_VALUES = args.mass_points
 NEVENTS_PER_POINT = args.nevents
 
 TEMPLATE_FILE = args.event_gen
 MMED_FLAG = "<MMED>"
 NEVENTS_FLAG = "<NEVENTS>"
+SEED_FLAG = "<SEED>"
 
 CONDOR_SUBMISSION_TEMPLATE = args.condor_template
 
@@ -110,6 +240,87 @@ if not os.getcwd().endswith("run"):
     logger.error("This script must be run inside the run/ directory!")
     sys.exit(1)
 
+# write the branch collections kept by the skim, derived from the branches read by the analyses
+# (always written since the condor template transfers it to the worker node)
+skim_collections = sorted(
+    {branch.split(".")[0].removesuffix("_size") for branch in DIJET_BRANCHES}
+    | set(args.skim_extra_branches)
+)
+skim_branches_filename = f"skim_branches_{args.job_id}.txt"
+with open(skim_branches_filename, "w") as skim_branches_file:
+    skim_branches_file.write("\n".join(skim_collections) + "\n")
+skim_mode = "none"
+if args.skim:
+    skim_mode = "skim_keep_full" if args.keep_full else "skim"
+    logger.info("skimming the Delphes output to branches %s", ", ".join(skim_collections))
+
+def multi_mass_instructions(content:str, masses:list, nevents:int)->str:
+    """
+    Return MadGraph instructions that output the process once and then
+    launch one run per mass point, in the given order (run_01, run_02, ...).
+    Everything from the launch command on is repeated for each mass.
+    """
+    lines = content.splitlines()
+    launch = next((i for i, line in enumerate(lines) if line.strip().startswith("launch")), None)
+    if launch is None:
+        raise ValueError("no launch command in the MadGraph instructions")
+    instructions = lines[:launch]
+    for mmed in masses:
+        run_lines = "\n".join(lines[launch:]).replace(MMED_FLAG, str(mmed)).replace(NEVENTS_FLAG, str(int(nevents)))
+        instructions += ["", f"# mass point {mmed}", run_lines]
+    return "\n".join(instructions) + "\n"
+
+def allocate_seeds(ledger:SeedLedger, mmed:int, part_events:list, generator:str, output_pattern:str, xsec_info_pattern:str, lhe_info_pattern:str=None)->list:
+    """
+    Allocate the seeds of the parts of a mass point in the seed ledger and
+    return the ledger entries of the parts. The "{part}" in the patterns
+    is replaced by the part index.
+    """
+    parts = [
+        {
+            "job_id": args.job_id,
+            "mass": mmed,
+            "part": part,
+            "generator": generator,
+            "nevents": nevents,
+            "output_dir": str(output_path),
+            "output": output_pattern.format(part=part),
+            "xsec_info": xsec_info_pattern.format(part=part),
+        }
+        for part, nevents in enumerate(part_events, start=1)
+    ]
+    if lhe_info_pattern is not None:
+        for part in parts:
+            part["lhe_info"] = lhe_info_pattern.format(part=part["part"])
+    try:
+        seeds = ledger.allocate(parts)
+    except ValueError as error:
+        logger.error("failed to allocate the seeds for mmed = %s: %s", mmed, error)
+        sys.exit(1)
+    for part, seed in zip(parts, seeds):
+        part["seed"] = seed
+    logger.info("allocated seeds %s for the %s jobs of mmed = %s", ", ".join(map(str, seeds)), len(parts), mmed)
+    return parts
+
+def gridpack_instructions(content:str)->str:
+    """
+    Turn MadGraph instructions generating events into ones building a
+    gridpack: the shower and detector simulation are switched off (they
+    run in the event generation jobs) and gridpack mode is enabled.
+    """
+    lines = list()
+    for line in content.splitlines():
+        if line.strip().startswith("shower="):
+            line = "shower=OFF"
+        elif line.strip().startswith("detector="):
+            line = "detector=OFF"
+        elif line.strip().endswith(".tcl"):
+            # the Delphes card
+            continue
+        lines.append(line)
+    lines += ["", "# build a gridpack instead of generating events", "set gridpack True"]
+    return "\n".join(lines) + "\n"
+
 # create condor submission file
 condor_content = str()
 with open(CONDOR_SUBMISSION_TEMPLATE, "r") as condor_template:
@@ -118,38 +329,144 @@ with open(CONDOR_SUBMISSION_TEMPLATE, "r") as condor_template:
 # condor_content = condor_content.replace("<USR>", os.environ["USER"])
 
 submission_content = str()
-for mmed in MMED_VALUES:
-    logger.info("setting up submissing for mmed = %s with %s events", mmed, NEVENTS_PER_POINT)
-
-    # create a new submission file from the template
+if args.masses_per_job > 1:
+    # each job generates a group of mass points in one MadGraph session
     with open(TEMPLATE_FILE, "r") as template:
-        submission_content = template.read()
-        submission_content = submission_content.replace(MMED_FLAG, str(mmed))
-        submission_content = submission_content.replace(NEVENTS_FLAG, str(int(NEVENTS_PER_POINT)))
+        template_content = template.read()
+    for first in range(0, len(MMED_VALUES), args.masses_per_job):
+        masses = MMED_VALUES[first:first + args.masses_per_job]
+        logger.info("setting up submission for mmed = %s with %s events each", ", ".join(map(str, masses)), NEVENTS_PER_POINT)
+        try:
+            submission_content = multi_mass_instructions(template_content, masses, NEVENTS_PER_POINT)
+        except ValueError as error:
+            logger.error("failed to write the MadGraph instructions: %s", error)
+            sys.exit(1)
+        submission_filename = f"generate_{args.job_id}_mmed{masses[0]}_to_mmed{masses[-1]}.txt"
+        with open(submission_filename, "w") as submission_file:
+            submission_file.write(submission_content)
+        logger.info("wrote MadGraph instruction file %s", submission_filename)
+
+        condor_content += ( "\n" + "\t" +
+            PROXY_PATH + ", " +
+            submission_filename + ", " +
+            str(output_path) + ", " +
+            f"generated_events_{args.job_id}_mmed{MMED_FLAG}_*.root" + ", " +
+            skim_branches_filename + ", " +
+            skim_mode + ", " +
+            ":".join(map(str, masses)) + ", " +
+            args.job_id + ", " +
+            str(args.runtime_per_mass * len(masses))
+        )
+else:
+    ledger = SeedLedger(args.seed_ledger)
+    for mmed in MMED_VALUES:
+        gridpack_file = f"gridpack_{args.job_id}_mmed{mmed}.tar.gz"
+        if args.gridpack_stage == "generate":
+            # the gridpack of the mass point is shared by all the jobs, each
+            # with its own seed and part of the events
+            events_per_job = args.events_per_job or math.ceil(NEVENTS_PER_POINT / args.jobs_per_point)
+            parts = allocate_seeds(
+                ledger, mmed, split_events(NEVENTS_PER_POINT, events_per_job), "gridpack",
+                f"generated_events_{args.job_id}_mmed{mmed}_part{{part}}.root",
+                # the cross-section comes from the gridpack build
+                f"xsec_info_{args.job_id}_mmed{mmed}.txt",
+                # the number of LHE events of each job
+                f"lhe_info_{args.job_id}_mmed{mmed}_part{{part}}.txt",
+            )
+            with open(args.shower_template, "r") as template:
+                shower_template = template.read()
+            for part in parts:
+                shower_filename = f"shower_{args.job_id}_mmed{mmed}_part{part['part']}.cmnd"
+                with open(shower_filename, "w") as shower_file:
+                    shower_file.write(shower_template.replace(NEVENTS_FLAG, str(part["nevents"])).replace(SEED_FLAG, str(part["seed"])))
+                condor_content += ( "\n" + "\t" +
+                    PROXY_PATH + ", " +
+                    str(gridpack_path / gridpack_file) + ", " +
+                    str(part["nevents"]) + ", " +
+                    str(part["seed"]) + ", " +
+                    shower_filename + ", " +
+                    part["output"] + ", " +
+                    str(output_path) + ", " +
+                    part["lhe_info"]
+                )
+            continue
+
+        if args.events_per_job is not None:
+            # one MadGraph run per part, each with its own seed and
+            # cross-section info files
+            parts = allocate_seeds(
+                ledger, mmed, split_events(NEVENTS_PER_POINT, args.events_per_job), "madgraph",
+                f"generated_events_{args.job_id}_mmed{mmed}_part{{part}}_*.root",
+                f"xsec_info_{args.job_id}_mmed{mmed}_part{{part}}.txt",
+            )
+            with open(TEMPLATE_FILE, "r") as template:
+                template_content = template.read().replace(MMED_FLAG, str(mmed))
+            for part in parts:
+                submission_filename = f"generate_{args.job_id}_mmed{mmed}_part{part['part']}.txt"
+                with open(submission_filename, "w") as submission_file:
+                    submission_file.write(
+                        template_content.replace(NEVENTS_FLAG, str(part["nevents"])) +
+                        f"\n# random seed of this job (see the seed ledger)\nset iseed {part['seed']}\n"
+                    )
+                condor_content += ( "\n" + "\t" +
+                    PROXY_PATH + ", " +
+                    submission_filename + ", " +
+                    str(output_path) + ", " +
+                    part["output"] + ", " +
+                    part["xsec_info"] + ", " +
+                    f"mg5_info_{args.job_id}_mmed{mmed}_part{part['part']}.txt" + ", " +
+                    skim_branches_filename + ", " +
+                    skim_mode
+                )
+            continue
+
+        logger.info("setting up submissing for mmed = %s with %s events", mmed, NEVENTS_PER_POINT)
+
+        # create a new submission file from the template
+        with open(TEMPLATE_FILE, "r") as template:
+            submission_content = template.read()
+            submission_content = submission_content.replace(MMED_FLAG, str(mmed))
+            submission_content = submission_content.replace(NEVENTS_FLAG, str(int(NEVENTS_PER_POINT)))
 
-    # write out the new submission file
-    submission_filename = f"generate_{args.job_id}_mmed{mmed}.txt"
-    with open(submission_filename, "w") as submission_file:
-        submission_file.write(submission_content)
-    logger.info("wrote MadGraph instruction file %s", submission_filename)
+        if args.gridpack_stage == "build":
+            submission_content = gridpack_instructions(submission_content)
 
-    if args.xsec_info_only:
+        # write out the new submission file
+        submission_filename = f"generate_{args.job_id}_mmed{mmed}.txt"
+        with open(submission_filename, "w") as submission_file:
+            submission_file.write(submission_content)
+        logger.info("wrote MadGraph instruction file %s", submission_filename)
+
+        if args.gridpack_stage == "build":
+            condor_content += ( "\n" + "\t" +
+                PROXY_PATH + ", " +
+                submission_filename + ", " +
+                str(gridpack_path) + ", " +
+                gridpack_file + ", " +
+                f"xsec_info_{args.job_id}_mmed{mmed}.txt" + ", " +
+                f"mg5_info_{args.job_id}_mmed{mmed}.txt"
+            )
+            continue
+
+        if args.xsec_info_only:
+            condor_content += ( "\n" + "\t" + 
+                submission_filename + ", " +
+                f"XSEC_CALC_xsec_info_{args.job_id}_mmed{mmed}.txt" + ", " + 
+                f"XSEC_CALC_mg5_info_{args.job_id}_mmed{mmed}.txt"
+            )
+            continue
+
+        # add to condor submission file
         condor_content += ( "\n" + "\t" + 
+            PROXY_PATH + ", " + 
             submission_filename + ", " +
-            f"XSEC_CALC_xsec_info_{args.job_id}_mmed{mmed}.txt" + ", " + 
-            f"XSEC_CALC_mg5_info_{args.job_id}_mmed{mmed}.txt"
+            str(output_path) + ", " +
+            f"generated_events_{args.job_id}_mmed{mmed}_*.root" + ", " + 
+            f"xsec_info_{args.job_id}_mmed{mmed}.txt" + ", " + 
+            f"mg5_info_{args.job_id}_mmed{mmed}.txt" + ", " +
+            skim_branches_filename + ", " +
+            skim_mode
         )
-        continue
-
-    # add to condor submission file
-    condor_content += ( "\n" + "\t" + 
-        f"/afs/cern.ch/user/{os.environ['USER'][0]}/{os.environ['USER']}/private/x509up" + ", " + 
-        submission_filename + ", " +
-        str(output_path) + ", " +
-        f"generated_events_{args.job_id}_mmed{mmed}_*.root" + ", " + 
-        f"xsec_info_{args.job_id}_mmed{mmed}.txt" + ", " + 
-        f"mg5_info_{args.job_id}_mmed{mmed}.txt"
-    )
 
 condor_content += "\n" + ")"
 condor_filename = f"condor_{args.job_id}.sub"
@@ -7,6 +7,7 @@ the reinterpretation method with.
 
 """
 from modules.logger_setup import logger
+from modules.seed_ledger import SeedLedger, split_events, DEFAULT_LEDGER_NAME
 import argparse
 import os
 import sys
@@ -58,6 +59,24 @@ parser.add_argument(
     help="job ID string to identify this submission",
     required=True,
 )
+parser.add_argument(
+    "--stream",
+    action="store_true",
+    help="pass the HepMC events from Pythia to Delphes through a named pipe instead of writing them to disk",
+    default=False,
+)
+parser.add_argument(
+    "--events-per-job",
+    type=int,
+    help="split the events of each mass point into jobs of this many events, each with its own seed from the seed ledger (by default one job per mass point)",
+    default=None,
+)
+parser.add_argument(
+    "--seed-ledger",
+    type=pathlib.Path,
+    help="JSON ledger of the random seeds allocated to the jobs of split mass points",
+    default=pathlib.Path(DEFAULT_LEDGER_NAME),
+)
 
 args = parser.parse_args()
 
@@ -80,6 +99,10 @@ if len(args.job_id.strip()) == 0:
     logger.error("job ID string cannot be empty!")
     sys.exit(1)
 
+if args.events_per_job is not None and args.events_per_job < 1:
+    logger.error("the number of events per job must be positive!")
+    sys.exit(1)
+
 output_path = args.output_dir.resolve()
 if "home-" + os.environ["USER"][0] in str(output_path):
     output_path = pathlib.Path(f"/eos/user/{os.environ['USER'][0]}/{os.environ['USER']}{str(output_path).split(os.environ['USER'])[1]}")
@@ -103,8 +126,51 @@ condor_content = str()
 with open(CONDOR_SUBMISSION_TEMPLATE, "r") as condor_template:
     condor_content = condor_template.read()
 
+ledger = SeedLedger(args.seed_ledger)
+
 submission_content = str()
 for mmed in MMED_VALUES:
+    if args.events_per_job is not None:
+        # one Pythia8 job per part, each with its own seed
+        parts = [
+            {
+                "job_id": args.job_id,
+                "mass": mmed,
+                "part": part,
+                "generator": "pythia8",
+                "nevents": nevents,
+                "output_dir": str(output_path),
+                "output": f"generated_events_{args.job_id}_mmed{mmed}_part{part}.root",
+                "xsec_info": f"xsec_info_{args.job_id}_mmed{mmed}_part{part}.txt",
+            }
+            for part, nevents in enumerate(split_events(NEVENTS_PER_POINT, args.events_per_job), start=1)
+        ]
+        try:
+            seeds = ledger.allocate(parts)
+        except ValueError as error:
+            logger.error("failed to allocate the seeds for mmed = %s: %s", mmed, error)
+            sys.exit(1)
+        logger.info("allocated seeds %s for the %s jobs of mmed = %s", ", ".join(map(str, seeds)), len(parts), mmed)
+
+        with open(TEMPLATE_FILE, "r") as template:
+            template_content = template.read().replace(MMED_FLAG, str(mmed))
+        for part, seed in zip(parts, seeds):
+            submission_filename = f"generate_{args.job_id}_mmed{mmed}_part{part['part']}.cmnd"
+            with open(submission_filename, "w") as submission_file:
+                submission_file.write(
+                    template_content.replace(NEVENTS_FLAG, str(part["nevents"])) +
+                    f"\n! random seed of this job (see the seed ledger)\nRandom:setSeed = on\nRandom:seed = {seed}\n"
+                )
+            condor_content += ( "\n" + "\t" +
+                f"/afs/cern.ch/user/{os.environ['USER'][0]}/{os.environ['USER']}/private/x509up" + ", " +
+                submission_filename + ", " +
+                part["output"] + ", " +
+                str(output_path) + ", " +
+                part["xsec_info"] + ", " +
+                ("stream" if args.stream else "file")
+            )
+        continue
+
     logger.info("setting up submissing for mmed = %s with %s events", mmed, NEVENTS_PER_POINT)
 
     # create a new submission file from the template
@@ -125,7 +191,8 @@ for mmed in MMED_VALUES:
         f"generate_{args.job_id}_mmed{mmed}.cmnd" + ", " +
         f"generated_events_{args.job_id}_mmed{mmed}.root" + ", " +
         str(output_path) + ", " +
-        f"xsec_info_{args.job_id}_mmed{mmed}.txt"
+        f"xsec_info_{args.job_id}_mmed{mmed}.txt" + ", " +
+        ("stream" if args.stream else "file")
     )    
 
 condor_content += "\n" + ")"